@@ -0,0 +1,305 @@
+# communalgrowth-website, the communalgrowth.org website.
+# Copyright (C) 2024  Communal Growth, LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""bulkimport.py
+
+Bulk import of the OpenLibrary and Crossref data dumps into the
+document tables, so that a deployment can be seeded without a lookup
+per ID.
+
+The dumps are read line by line, optionally gzip-compressed, and
+written in batches with INSERT ... ON CONFLICT, so that the memory used
+does not depend on the size of the dump. Documents whose identifiers
+are already in the database are skipped.
+
+OpenLibrary editions name their authors by key, so the authors dump
+must be imported first with :func:`import_openlibrary_authors`, into a
+staging table; then :func:`import_openlibrary_editions` imports the
+editions. Crossref works are imported with :func:`import_crossref`.
+
+"""
+
+import gzip
+import itertools
+import json
+
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from app.cgdb import (
+    Document,
+    OpenLibraryAuthor,
+    author_document_association,
+    identifier_tables,
+    title_and_authors,
+    upsert_authors,
+)
+from app.conf import BULK_IMPORT_BATCH
+from app.docid import normalize_human_name
+from app.idparser import normalize_doi, normalize_isbn
+
+
+def read_lines(path):
+    """Iterate over the lines of the file path, gunzipping a .gz file"""
+    opener = gzip.open if str(path).endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        yield from f
+
+
+def batches(iterable, n):
+    """Iterate over lists of up to n consecutive items of iterable"""
+    it = iter(iterable)
+    while batch := list(itertools.islice(it, n)):
+        yield batch
+
+
+def openlibrary_records(lines, record_type):
+    """Iterate over the JSON records of record_type in an OpenLibrary dump
+
+    Each line of the dump has the tab-separated fields type, key,
+    revision, last modified and JSON record.
+    """
+    for line in lines:
+        fields = line.rstrip("\n").split("\t")
+        if len(fields) != 5 or fields[0] != record_type:
+            continue
+        try:
+            yield json.loads(fields[4])
+        except ValueError:
+            continue
+
+
+def openlibrary_author(record):
+    """Return the (key, name) pair of an OpenLibrary author, or None"""
+    key = record.get("key")
+    name = record.get("name")
+    if not isinstance(key, str) or not isinstance(name, str) or not name.strip():
+        return None
+    return key, name
+
+
+def openlibrary_edition(record):
+    """Return the details of an OpenLibrary edition, or None
+
+    The details are those returned by docid.lookup_isbn(), except for
+    the authors, which are given by key in author_keys.
+    """
+    title = record.get("title")
+    isbn10 = edition_isbn(record, "isbn_10", 10)
+    isbn13 = edition_isbn(record, "isbn_13", 13)
+    if not isinstance(title, str) or not (isbn10 or isbn13):
+        return None
+    author_keys = [
+        a["key"]
+        for a in record.get("authors", [])
+        if isinstance(a, dict) and isinstance(a.get("key"), str)
+    ]
+    return dict(
+        title=title,
+        subtitle=record.get("subtitle", ""),
+        author_keys=author_keys,
+        isbn10=isbn10,
+        isbn13=isbn13,
+    )
+
+
+def edition_isbn(record, key, length):
+    """The first valid ISBN of length digits in the list record[key]
+
+    The ISBN is normalized like the ISBNs parsed from mails. Returns
+    None if there is none.
+    """
+    isbns = record.get(key)
+    if not isinstance(isbns, list):
+        return None
+    for isbn in isbns:
+        if isinstance(isbn, str) and (isbn := normalize_isbn(isbn)):
+            if len(isbn) == length:
+                return isbn
+    return None
+
+
+def crossref_works(lines):
+    """Iterate over the works of a Crossref dump
+
+    Each line is either a work or an object listing works in items.
+    """
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(record.get("items"), list):
+            yield from record["items"]
+        else:
+            yield record
+
+
+def crossref_doc(work):
+    """Return the details of a Crossref work, or None
+
+    The details are those returned by docid.lookup_doi().
+    """
+    doi = work.get("DOI")
+    title = " ".join(work.get("title") or [])
+    if not isinstance(doi, str) or not title:
+        return None
+    authors = []
+    for a in work.get("author", []):
+        person = f"{a.get('given', '')} {a.get('family', '')}".strip()
+        if person:
+            authors.append(normalize_human_name(person))
+        elif a.get("name"):
+            # An organization, whose name is not a human name.
+            authors.append(a["name"])
+    return dict(title=title, authors=authors or ["Unknown"], doi=normalize_doi(doi))
+
+
+# The identifier tables, by the key of the identifier in the document
+# details.
+key_tables = {key: table for table, key in identifier_tables.values()}
+
+
+def insert_docs(session, docs):
+    """Insert documents from their details, skipping known identifiers
+
+    docs is a list of dictionaries with the title, authors and some of
+    the isbn10, isbn13 and doi keys. A document is skipped if one of its
+    identifiers is already in the database or earlier in docs. Returns
+    the number of documents inserted.
+    """
+    known = set()
+    for key, table in key_tables.items():
+        column = getattr(table, key)
+        values = [doc[key] for doc in docs if doc.get(key)]
+        if values:
+            known.update(
+                (key, value)
+                for value in session.scalars(select(column).where(column.in_(values)))
+            )
+    new_docs = []
+    for doc in docs:
+        ids = [(key, doc[key]) for key in key_tables if doc.get(key)]
+        if ids and not known.intersection(ids):
+            known.update(ids)
+            new_docs.append(doc)
+    if not new_docs:
+        return 0
+    doc_ids = (
+        session.execute(
+            insert(Document)
+            .values(
+                title=bindparam("title"),
+                tsv_title=func.to_tsvector("english", bindparam("text")),
+            )
+            .returning(Document.id, sort_by_parameter_order=True),
+            [
+                dict(
+                    title=doc["title"],
+                    text=title_and_authors(doc["title"], doc["authors"]),
+                )
+                for doc in new_docs
+            ],
+        )
+        .scalars()
+        .all()
+    )
+    for key, table in key_tables.items():
+        rows = [
+            {key: doc[key], "id": doc_id}
+            for doc_id, doc in zip(doc_ids, new_docs)
+            if doc.get(key)
+        ]
+        if rows:
+            session.execute(insert(table).on_conflict_do_nothing(), rows)
+    authors = [a for doc in new_docs for a in doc["authors"]]
+    if authors:
+        upsert_authors(session, authors)
+        session.execute(
+            insert(author_document_association).on_conflict_do_nothing(),
+            [
+                dict(doc_id=doc_id, author=a)
+                for doc_id, doc in zip(doc_ids, new_docs)
+                for a in set(doc["authors"])
+            ],
+        )
+    return len(new_docs)
+
+
+def import_openlibrary_authors(Session, lines, batch_size=BULK_IMPORT_BATCH):
+    """Import the authors of an OpenLibrary authors dump into staging
+
+    Returns the number of authors imported.
+    """
+    n = 0
+    records = openlibrary_records(lines, "/type/author")
+    for batch in batches(filter(None, map(openlibrary_author, records)), batch_size):
+        rows = {key: name for key, name in batch}
+        stmt = insert(OpenLibraryAuthor)
+        with Session() as session:
+            session.execute(
+                stmt.on_conflict_do_update(
+                    index_elements=[OpenLibraryAuthor.key],
+                    set_=dict(name=stmt.excluded.name),
+                ),
+                [dict(key=key, name=name) for key, name in rows.items()],
+            )
+            session.commit()
+        n += len(rows)
+    return n
+
+
+def import_openlibrary_editions(Session, lines, batch_size=BULK_IMPORT_BATCH):
+    """Import the editions of an OpenLibrary editions dump
+
+    The authors are named from the staging table filled by
+    import_openlibrary_authors(). Returns the number of documents
+    imported.
+    """
+    n = 0
+    records = openlibrary_records(lines, "/type/edition")
+    for batch in batches(filter(None, map(openlibrary_edition, records)), batch_size):
+        with Session() as session:
+            keys = {key for doc in batch for key in doc["author_keys"]}
+            names = dict(
+                session.execute(
+                    select(OpenLibraryAuthor.key, OpenLibraryAuthor.name).where(
+                        OpenLibraryAuthor.key.in_(keys)
+                    )
+                ).all()
+            )
+            for doc in batch:
+                authors = [names[k] for k in doc["author_keys"] if k in names]
+                doc["authors"] = [normalize_human_name(a) for a in authors] or [
+                    "Unknown"
+                ]
+            n += insert_docs(session, batch)
+            session.commit()
+    return n
+
+
+def import_crossref(Session, lines, batch_size=BULK_IMPORT_BATCH):
+    """Import the works of a Crossref dump
+
+    Returns the number of documents imported.
+    """
+    n = 0
+    docs = filter(None, map(crossref_doc, crossref_works(lines)))
+    for batch in batches(docs, batch_size):
+        with Session() as session:
+            n += insert_docs(session, batch)
+            session.commit()
+    return n
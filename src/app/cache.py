@@ -0,0 +1,137 @@
+# communalgrowth-website, the communalgrowth.org website.
+# Copyright (C) 2024  Communal Growth, LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""cache.py
+
+An in-process cache for the search results of the website.
+
+The cache is :class:`SearchCache` and its keys are built from search
+terms with :func:`normalize_search_term`.
+
+"""
+
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+
+from app.utils import strip_to_alphanum
+
+
+def normalize_search_term(s):
+    """Normalize a search term so that equivalent searches share a key"""
+    return " ".join(strip_to_alphanum(s).lower().split())
+
+
+def sizeof(obj):
+    """Estimate the memory taken by obj in bytes
+
+    Follows tuples, lists and dicts, which is all search results are
+    made of."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list)):
+        size += sum(sizeof(x) for x in obj)
+    elif isinstance(obj, dict):
+        size += sum(sizeof(k) + sizeof(v) for k, v in obj.items())
+    return size
+
+
+class SearchCache:
+    """A TTL and LRU cache of coroutine results, bounded in memory.
+
+    Entries expire ttl seconds after they are stored, and the least
+    recently used entries are evicted once the cached values take more
+    than max_bytes. Concurrent misses of the same key are coalesced
+    into a single call. The cache must only be used from a single
+    event loop.
+
+    """
+
+    def __init__(self, ttl, max_bytes, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.clock = clock
+        # Maps a key to an (expiration time, size, value) triple.
+        self.entries = OrderedDict()
+        # Maps a key to the future of the call computing its value.
+        self.inflight = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    async def get(self, key, call):
+        """Return the value of key, awaiting call() to compute it if missing."""
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, _, value = entry
+            if self.clock() < expires:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.remove(key)
+            self.expirations += 1
+        future = self.inflight.get(key)
+        if future is None:
+            self.misses += 1
+            future = asyncio.ensure_future(call())
+            self.inflight[key] = future
+            future.add_done_callback(lambda f: self.store(key, f))
+        else:
+            self.coalesced += 1
+        # Shield the call so that a cancelled request does not cancel
+        # it for the other requests waiting on it.
+        return await asyncio.shield(future)
+
+    def store(self, key, future):
+        """Store the result of a finished call, evicting entries if needed."""
+        del self.inflight[key]
+        if future.cancelled() or future.exception() is not None:
+            return
+        value = future.result()
+        size = sizeof(value)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (self.clock() + self.ttl, size, value)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        """Remove key from the cache."""
+        _, size, _ = self.entries.pop(key)
+        self.nbytes -= size
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        """Return the counters of the cache as a dictionary."""
+        return dict(
+            entries=len(self.entries),
+            bytes=self.nbytes,
+            max_bytes=self.max_bytes,
+            hits=self.hits,
+            misses=self.misses,
+            coalesced=self.coalesced,
+            expirations=self.expirations,
+            evictions=self.evictions,
+        )
@@ -21,21 +21,31 @@ Provides the ORM class definitions.
 """
 
 from __future__ import annotations
-from typing import List
+from datetime import datetime
+from typing import List, Optional
 
 from nameparser import HumanName
 from sqlalchemy import (
+    any_,
+    bindparam,
+    false,
     func,
+    select,
     event,
     Index,
+    UniqueConstraint,
     Table,
     Column,
+    BigInteger,
     Integer,
     String,
     ForeignKey,
+    DateTime,
 )
 from sqlalchemy.orm import Mapped, mapped_column, DeclarativeBase, relationship
-from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, TSVECTOR, insert
+
+from app.idparser import IDType
 
 
 class Base(DeclarativeBase):
@@ -130,40 +140,174 @@ class Document(Base):
     )
 
 
+def title_and_authors(title, authors):
+    """The text indexed by tsv_title for a title and its author names"""
+    author_last_names = " ".join(map(lambda a: HumanName(a).last, authors))
+    return f"{title} {author_last_names}"
+
+
 @event.listens_for(Document, "before_insert")
 @event.listens_for(Document, "before_update")
 def populate_tsvector(mapper, connection, target):
     del mapper, connection
-    author_last_names = " ".join(
-        map(lambda a: HumanName(a.author).last, target.authors)
-    )
-    title_and_authors = f"{target.title} {author_last_names}"
-    target.tsv_title = func.to_tsvector("english", title_and_authors)
+    text = title_and_authors(target.title, [a.author for a in target.authors])
+    target.tsv_title = func.to_tsvector("english", text)
+
+
+def upsert_authors(session, names):
+    """Return the Author instances of names, creating the missing ones
+
+    Takes a single SELECT ... WHERE author = ANY(:names) and, if some
+    authors are missing, a single INSERT ... ON CONFLICT DO NOTHING
+    RETURNING, whatever the number of names.
+    """
+    names = list(dict.fromkeys(names))
+    if not names:
+        return []
+    authors = {
+        a.author: a
+        for a in session.scalars(
+            select(Author).where(
+                Author.author == any_(bindparam("names", names, type_=ARRAY(String)))
+            )
+        )
+    }
+    missing = [name for name in names if name not in authors]
+    if missing:
+        stmt = insert(Author).on_conflict_do_nothing().returning(Author)
+        for a in session.scalars(stmt, [dict(author=name) for name in missing]):
+            authors[a.author] = a
+        # The authors inserted concurrently by another transaction.
+        raced = [name for name in missing if name not in authors]
+        if raced:
+            for a in session.scalars(select(Author).where(Author.author.in_(raced))):
+                authors[a.author] = a
+    return [authors[name] for name in names]
 
 
 class Isbn10(Base):
     __tablename__ = "isbn10"
     isbn10: Mapped[str] = mapped_column(primary_key=True)
-    id: Mapped[int] = mapped_column(ForeignKey("document.id"))
+    id: Mapped[int] = mapped_column(ForeignKey("document.id"), index=True)
     document: Mapped["Document"] = relationship(back_populates="isbn10")
 
 
 class Isbn13(Base):
     __tablename__ = "isbn13"
     isbn13: Mapped[str] = mapped_column(primary_key=True)
-    id: Mapped[int] = mapped_column(ForeignKey("document.id"))
+    id: Mapped[int] = mapped_column(ForeignKey("document.id"), index=True)
     document: Mapped["Document"] = relationship(back_populates="isbn13")
 
 
 class Arxiv(Base):
     __tablename__ = "arxiv"
     arxiv: Mapped[str] = mapped_column(primary_key=True)
-    id: Mapped[int] = mapped_column(ForeignKey("document.id"))
+    id: Mapped[int] = mapped_column(ForeignKey("document.id"), index=True)
     document: Mapped["Document"] = relationship(back_populates="arxiv")
 
 
 class Doi(Base):
     __tablename__ = "doi"
     doi: Mapped[str] = mapped_column(primary_key=True)
-    id: Mapped[int] = mapped_column(ForeignKey("document.id"))
+    id: Mapped[int] = mapped_column(ForeignKey("document.id"), index=True)
     document: Mapped["Document"] = relationship(back_populates="doi")
+
+
+# The identifier tables by IDType, with the key of the identifier in
+# the document details returned by docid.lookup_doc(), which is also
+# the name of its column.
+identifier_tables = {
+    IDType.ISBN10: (Isbn10, "isbn10"),
+    IDType.ISBN13: (Isbn13, "isbn13"),
+    IDType.DOI: (Doi, "doi"),
+    IDType.ARXIV: (Arxiv, "arxiv"),
+}
+
+
+class DocumentSearch(Base):
+    """The read model of the website, one row per document.
+
+    The rows are kept up to date by maildird in the same transaction as
+    the changes to the subscriptions, so that the website only needs to
+    read this table. emails holds a random sample of up to
+    SEARCH_EMAILS subscribers, drawn anew whenever the subscriptions of
+    the document change.
+
+    """
+
+    __tablename__ = "document_search"
+    __table_args__ = (
+        Index(
+            "idx_document_search_tsv_title",
+            "tsv_title",
+            postgresql_using="gin",
+        ),
+    )
+    doc_id: Mapped[int] = mapped_column(
+        ForeignKey("document.id", ondelete="CASCADE"), primary_key=True
+    )
+    title: Mapped[str] = mapped_column()
+    docid: Mapped[str] = mapped_column()
+    authors: Mapped[List[str]] = mapped_column(ARRAY(String))
+    emails: Mapped[List[str]] = mapped_column(ARRAY(String))
+    subscribers: Mapped[int] = mapped_column()
+    tsv_title = mapped_column(TSVECTOR)
+
+
+class LookupCache(Base):
+    """The results of the online lookups of document IDs.
+
+    payload is the return value of docid.lookup_doc(), or NULL if the
+    lookup failed; failures counts the consecutive failed lookups of
+    the ID. The row is used instead of a new lookup until expires.
+
+    """
+
+    __tablename__ = "lookup_cache"
+    idtype: Mapped[IDType] = mapped_column(primary_key=True)
+    docid: Mapped[str] = mapped_column(primary_key=True)
+    payload: Mapped[Optional[dict]] = mapped_column(JSONB(none_as_null=True))
+    failures: Mapped[int] = mapped_column(default=0)
+    lookups: Mapped[int] = mapped_column(default=0)
+    hits: Mapped[int] = mapped_column(default=0)
+    expires: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+
+
+class MailJob(Base):
+    """The queue of the requests received by mail.
+
+    Each row is the action, subscribe, unsubscribe or forget, of the
+    user email on the document ID (idtype, docid); a forget has no
+    document ID. maildird queues the jobs as the mails arrive and its
+    queue workers process them in order of id, each job being attempted
+    again at next_attempt until it is done, or failed after too many
+    attempts.
+
+    """
+
+    __tablename__ = "mail_job"
+    # The unique index also serves the lookups by email.
+    __table_args__ = (UniqueConstraint("email", "idtype", "docid"),)
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    email: Mapped[str] = mapped_column()
+    action: Mapped[str] = mapped_column()
+    idtype: Mapped[Optional[IDType]] = mapped_column()
+    docid: Mapped[Optional[str]] = mapped_column()
+    attempts: Mapped[int] = mapped_column(default=0)
+    next_attempt: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), server_default=func.now(), index=True
+    )
+    failed: Mapped[bool] = mapped_column(default=False, server_default=false())
+
+
+class OpenLibraryAuthor(Base):
+    """The authors of an OpenLibrary dump, by their OpenLibrary key.
+
+    A staging table for the bulk import of the OpenLibrary editions,
+    which name their authors by key only.
+
+    """
+
+    __tablename__ = "openlibrary_author"
+    key: Mapped[str] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column()
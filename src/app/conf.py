@@ -20,6 +20,9 @@ DB_URL = "postgresql+psycopg://gauss@localhost:5432/communalgrowth-database"
 FQDN = "communalgrowth.org"
 CG_IMAP_PWD_FILE = getenv("CG_IMAP_PWD_FILE") or ""
 CG_TLS_DIR = getenv("CG_TLS_DIR") or ""
+# Directory of the caches of the application, such as the grammar
+# analysis of the identifier parser; nothing is cached if empty.
+CG_CACHE_DIR = getenv("CG_CACHE_DIR") or ""
 # Port to run the quota policy server in.
 CG_POLICY_PORT = getenv("CG_POLICY_PORT") or ""
 # Port to run the SDID Milter server in.
@@ -27,3 +30,112 @@ CG_SDIDMILTER_PORT = getenv("CG_SDIDMILTER_PORT") or ""
 
 # How many document IDs per e-mail are processed.
 RATELIMIT_DOCIDS = 20
+# How many characters of the text of an e-mail are read at most, and
+# how many characters of its encoded body are decoded at a time.
+MAIL_MAX_TEXT = 1 << 18
+MAIL_CHUNK_SIZE = 1 << 16
+
+# How many documents are shown on the front page, and how many
+# subscribers are shown per document.
+RECENT_DOCUMENTS = 10
+SEARCH_EMAILS = 10
+
+# How long the website caches search results, in seconds, and how much
+# memory the cached results may take, in bytes.
+SEARCH_CACHE_TTL = 60
+SEARCH_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Whether the website answers /stats with the counters of its search
+# cache and connection pool; otherwise the route is not found.
+STATS_ENABLED = False
+
+# The connection pool of the website, per worker process. Connections
+# are recycled after DB_POOL_RECYCLE seconds, and checkouts fail after
+# waiting DB_POOL_TIMEOUT seconds for a connection.
+DB_POOL_SIZE = 5
+DB_MAX_OVERFLOW = 5
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 1800
+DB_POOL_PRE_PING = True
+# psycopg prepares a statement on the server once it has been executed
+# this many times on a connection; None disables prepared statements.
+DB_PREPARE_THRESHOLD = 5
+
+# The JSON API answers with a single JSON document up to
+# API_JSON_MAX_RESULTS results, and streams NDJSON beyond that, up to
+# API_MAX_RESULTS results. Streamed rows are fetched from the database
+# SEARCH_YIELD_PER rows at a time.
+API_JSON_MAX_RESULTS = 100
+API_MAX_RESULTS = 100_000
+SEARCH_YIELD_PER = 500
+
+# How many messages maildird fetches and expunges at once per mailbox.
+IMAP_BATCH_SIZE = 100
+# maildird fetches only the text parts of a message, and at most
+# IMAP_PART_MAX_BYTES of each; enough for MAIL_MAX_TEXT characters in
+# base64.
+IMAP_PART_MAX_BYTES = 1 << 19
+# How long maildird waits in IMAP IDLE before reissuing it; RFC 2177
+# asks clients to do so at least every 29 minutes. Without IDLE,
+# maildird polls with a delay between these bounds, in seconds.
+IMAP_IDLE_TIMEOUT = 29 * 60
+IMAP_POLL_MIN_DELAY = 1
+IMAP_POLL_MAX_DELAY = 60
+# A message that fails processing stays in its mailbox and is retried
+# after MAIL_RETRY_DELAY seconds, doubling with each attempt up to
+# MAIL_RETRY_MAX_DELAY. After MAIL_MAX_ATTEMPTS attempts, it is flagged
+# with MAIL_FAILED_FLAG and left for inspection. Each failed attempt
+# is recorded on the message with the keyword MAIL_ATTEMPT_FLAG
+# followed by its number, so that the count survives a restart.
+MAIL_RETRY_DELAY = 60
+MAIL_RETRY_MAX_DELAY = 3600
+MAIL_MAX_ATTEMPTS = 5
+MAIL_FAILED_FLAG = "$CGFailed"
+MAIL_ATTEMPT_FLAG = "$CGAttempt"
+# The maildird supervisor restarts a worker process that exited after
+# WORKER_RESTART_DELAY seconds.
+WORKER_RESTART_DELAY = 5
+
+# How many online lookups maildird runs at once per provider; arXiv
+# asks for a single connection at a time.
+LOOKUP_CONCURRENCY = dict(openlibrary=4, crossref=4, arxiv=1)
+# How many IDs are looked up with a single request to a provider.
+LOOKUP_BATCH_SIZE = 20
+# The (requests per second, burst) allowed per provider; arXiv asks for
+# 3 seconds between requests. A lookup waiting longer than
+# LOOKUP_MAX_WAIT seconds for its turn is deferred.
+LOOKUP_RATES = dict(openlibrary=(1, 3), crossref=(10, 10), arxiv=(1 / 3, 1))
+LOOKUP_MAX_WAIT = 30
+# A provider is not queried for CIRCUIT_RESET_TIMEOUT seconds after
+# CIRCUIT_FAILURES consecutive failed requests.
+CIRCUIT_FAILURES = 5
+CIRCUIT_RESET_TIMEOUT = 60
+
+# How long the result of an online lookup is kept, in seconds. A
+# failed lookup is retried after LOOKUP_FAILURE_TTL seconds, doubling
+# with each consecutive failure up to LOOKUP_FAILURE_MAX_TTL.
+LOOKUP_CACHE_TTL = 90 * 24 * 3600
+LOOKUP_FAILURE_TTL = 3600
+LOOKUP_FAILURE_MAX_TTL = 30 * 24 * 3600
+
+# The HTTP connections of the online lookups: the connect and read
+# timeouts in seconds, and the most connections kept open per host.
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 10
+HTTP_POOL_MAXSIZE = 4
+
+# maildird queues the requests of the mails it receives as jobs in the
+# mail_job table. The queue workers claim up to QUEUE_BATCH due jobs at
+# a time, and poll the queue every QUEUE_POLL_INTERVAL seconds while it
+# is empty. A job whose lookup could not be made, or which failed, is
+# attempted again after QUEUE_RETRY_DELAY seconds, doubling with each
+# attempt up to QUEUE_RETRY_MAX_DELAY. A job still not done after
+# QUEUE_MAX_ATTEMPTS attempts is marked failed and no longer attempted.
+QUEUE_BATCH = 100
+QUEUE_POLL_INTERVAL = 1
+QUEUE_RETRY_DELAY = 300
+QUEUE_RETRY_MAX_DELAY = 6 * 3600
+QUEUE_MAX_ATTEMPTS = 20
+
+# How many records of a dump the bulk import writes per transaction.
+BULK_IMPORT_BATCH = 10_000
@@ -19,19 +19,38 @@
 Lookup functions for DOI, ISBN, and arXiv identifiers.
 
 These functions will query online databases if the local database does
-not already have the data. The main lookup function is :func:`lookup_doc`.
+not already have the data. The main lookup function is :func:`lookup_doc`,
+and :func:`lookup_docs` looks up several documents with as few
+requests as possible, concurrently.
 
 """
 
 import nameparser
 import dateparser
 import requests
+import requests.adapters
 import defusedxml.ElementTree as DET
 
+from concurrent.futures import ThreadPoolExecutor
 from importlib.metadata import version
+import collections
 import datetime
+import re
+from urllib.parse import quote
 
+from app.conf import (
+    LOOKUP_CONCURRENCY,
+    LOOKUP_BATCH_SIZE,
+    LOOKUP_RATES,
+    LOOKUP_MAX_WAIT,
+    CIRCUIT_FAILURES,
+    CIRCUIT_RESET_TIMEOUT,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_POOL_MAXSIZE,
+)
 from app.idparser import IDType
+from app.throttle import TokenBucket, CircuitBreaker
 
 nameparser.config.CONSTANTS.force_mixed_case_capitalization = True
 nameparser.config.CONSTANTS.string_format = "{last}"
@@ -44,9 +63,70 @@ headers = {
 }
 
 
-def get_url(url):
-    """Simple wrapper over requests.get() with header and timeout"""
-    return requests.get(url, headers=headers, timeout=5)
+def create_http_session():
+    """Create a requests session keeping its connections alive
+
+    At most HTTP_POOL_MAXSIZE connections are opened per host; further
+    requests to the host wait for a connection to be free.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_maxsize=HTTP_POOL_MAXSIZE, pool_block=True
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update(headers)
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    return session
+
+
+# The session shared by all lookups, so that their connections are
+# reused instead of opened anew with every request.
+http = create_http_session()
+
+
+def get_url(url, params=None):
+    """Simple wrapper over http.get() with connect and read timeouts"""
+    return http.get(
+        url, params=params, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    )
+
+
+class ProviderUnavailable(Exception):
+    """A provider could not be queried; the lookup should be retried"""
+
+
+class LookupRejected(Exception):
+    """A provider refused a request, e.g. with HTTP 400 or 404"""
+
+
+def provider_get(name, url, params=None):
+    """get_url() within the rate limit and circuit breaker of provider name
+
+    Raises ProviderUnavailable on a transient failure: a network error,
+    a server error or rate limiting by the provider, an open circuit,
+    or more than LOOKUP_MAX_WAIT seconds to wait for the rate limit.
+    Raises LookupRejected on any other status than HTTP 200.
+    """
+    breaker = provider_breakers[name]
+    if not breaker.allow():
+        raise ProviderUnavailable(f"{name}: circuit open")
+    if not provider_buckets[name].acquire(LOOKUP_MAX_WAIT):
+        # The trial call of a half-open circuit is not made.
+        breaker.cancel()
+        raise ProviderUnavailable(f"{name}: rate limited")
+    try:
+        response = get_url(url, params)
+    except requests.RequestException as e:
+        breaker.failure()
+        raise ProviderUnavailable(f"{name}: {e}") from e
+    if response.status_code == 429 or response.status_code >= 500:
+        breaker.failure()
+        raise ProviderUnavailable(f"{name}: HTTP {response.status_code}")
+    breaker.success()
+    if not ok_response(response):
+        raise LookupRejected(f"{name}: HTTP {response.status_code}")
+    return response
 
 
 def ok_response(response):
@@ -116,57 +196,181 @@ def lookup_doi(doi):
     if not ok_response(response):
         return {}
     try:
-        data = response.json()
-        message = data["message"]
-        title = " ".join(message["title"])
-        year, month, day = message.get("published", {}).get(
-            "date-parts", [[1984, 1, 1]]
-        )[0]
-        date = datetime.date(year, month, day).strftime("%Y-%m-%dT%H:%M:%SZ")
-        authors = message.get("author", [dict(given="", family="Unknown")])
-        authors_list = []
-        for d in authors:
-            name = normalize_human_name(f"{d['given']} {d['family']}")
-            authors_list += [name]
-        return dict(title=title, published=date, authors=authors_list, doi=doi)
+        return crossref_work(response.json()["message"], doi)
     except:
         return {}
 
 
+def crossref_work(message, doi):
+    """The document details of doi from its crossref.org work"""
+    title = " ".join(message["title"])
+    year, month, day = message.get("published", {}).get("date-parts", [[1984, 1, 1]])[0]
+    date = datetime.date(year, month, day).strftime("%Y-%m-%dT%H:%M:%SZ")
+    authors = message.get("author", [dict(given="", family="Unknown")])
+    authors_list = []
+    for d in authors:
+        name = normalize_human_name(f"{d['given']} {d['family']}")
+        authors_list += [name]
+    return dict(title=title, published=date, authors=authors_list, doi=doi)
+
+
 # Try with:
 # arXiv: 1708.05919
 def lookup_arxiv(arxiv):
-    namespaces = dict(
-        atom="http://www.w3.org/2005/Atom",
-        opensearch="http://a9.com/-/spec/opensearch/1.1/",
-        arxiv="http://arxiv.org/schemas/atom",
-    )
     arxiv_url = f"http://export.arxiv.org/api/query?id_list={arxiv}"
     response = get_url(arxiv_url)
     if not ok_response(response):
         return {}
     try:
         et = DET.fromstring(response.text)
-        title = et.find("atom:entry/atom:title", namespaces)
-        if title is None:
+        entry = et.find("atom:entry", arxiv_namespaces)
+        if entry is None:
             return {}
-        else:
-            title = title.text
-        published = et.find("atom:entry/atom:published", namespaces)
-        if published is None:
-            published = "1984-01-01T00:00:00Z"
-        else:
-            published = published.text
-        authors = []
-        for author in et.findall("atom:entry/atom:author/atom:name", namespaces):
-            authors += [normalize_human_name(author.text)]
-        if not authors:
-            authors = ["Unknown"]
-        return dict(title=title, published=published, authors=authors, arxiv=arxiv)
+        return arxiv_entry(entry, arxiv)
     except:
         return {}
 
 
+arxiv_namespaces = dict(
+    atom="http://www.w3.org/2005/Atom",
+    opensearch="http://a9.com/-/spec/opensearch/1.1/",
+    arxiv="http://arxiv.org/schemas/atom",
+)
+
+
+def arxiv_entry(entry, arxiv):
+    """The document details of arxiv from its entry in an arXiv feed"""
+    title = entry.find("atom:title", arxiv_namespaces)
+    if title is None:
+        return {}
+    else:
+        title = title.text
+    published = entry.find("atom:published", arxiv_namespaces)
+    if published is None:
+        published = "1984-01-01T00:00:00Z"
+    else:
+        published = published.text
+    authors = []
+    for author in entry.findall("atom:author/atom:name", arxiv_namespaces):
+        authors += [normalize_human_name(author.text)]
+    if not authors:
+        authors = ["Unknown"]
+    return dict(title=title, published=published, authors=authors, arxiv=arxiv)
+
+
+def lookup_isbns(isbns):
+    """Lookup several ISBN-10 or ISBN-13 from openlibrary.org at once
+
+    Returns a dictionary mapping the ISBNs found to their details, as
+    returned by lookup_isbn().
+    """
+    bibkeys = ",".join(f"ISBN:{isbn}" for isbn in isbns)
+    url = f"https://openlibrary.org/api/books?bibkeys={bibkeys}&format=json&jscmd=data"
+    response = provider_get("openlibrary", url)
+    try:
+        books = response.json()
+    except:
+        books = None
+    if not isinstance(books, dict):
+        raise ProviderUnavailable("openlibrary: unreadable response")
+    found = {}
+    for isbn in isbns:
+        try:
+            data = books[f"ISBN:{isbn}"]
+            identifiers = data.get("identifiers", {})
+            isbn10_default = isbn if len(isbn) == 10 else None
+            isbn13_default = isbn if len(isbn) == 13 else None
+            publish_date = data.get("publish_date", "1984-01-01")
+            date = dateparser.parse(publish_date).strftime("%Y-%m-%dT%H:%M:%SZ")
+            names = [a["name"] for a in data.get("authors", [])] or ["Unknown"]
+            found[isbn] = dict(
+                title=data["title"],
+                subtitle=data.get("subtitle", ""),
+                published=date,
+                authors=[normalize_human_name(x) for x in names],
+                isbn10=identifiers.get("isbn_10", [isbn10_default])[0],
+                isbn13=identifiers.get("isbn_13", [isbn13_default])[0],
+            )
+        except:
+            continue
+    return found
+
+
+def lookup_dois(dois):
+    """Lookup several DOIs from crossref.org at once
+
+    Returns a dictionary mapping the DOIs found to their details, as
+    returned by lookup_doi().
+    """
+    found = {}
+    # A comma would split the filter of crossref.org.
+    for doi in dois:
+        if "," not in doi:
+            continue
+        url = f"https://api.crossref.org/works/{quote(doi)}"
+        try:
+            response = provider_get("crossref", url)
+        except LookupRejected:
+            # The DOI alone was refused; it is not found.
+            continue
+        try:
+            found[doi] = crossref_work(response.json()["message"], doi)
+        except:
+            pass
+    dois = {doi.lower(): doi for doi in dois if "," not in doi}
+    if dois:
+        doi_filter = ",".join(f"doi:{doi}" for doi in dois.values())
+        response = provider_get(
+            "crossref",
+            "https://api.crossref.org/works",
+            params=dict(filter=doi_filter, rows=len(dois)),
+        )
+        try:
+            items = response.json()["message"]["items"]
+        except:
+            raise ProviderUnavailable("crossref: unreadable response")
+        for message in items:
+            doi = dois.get(message.get("DOI", "").lower())
+            if doi is None:
+                continue
+            try:
+                found[doi] = crossref_work(message, doi)
+            except:
+                continue
+    return {doi: data for doi, data in found.items() if data}
+
+
+def lookup_arxivs(arxivs):
+    """Lookup several arXiv identifiers from arxiv.org at once
+
+    Returns a dictionary mapping the identifiers found to their
+    details, as returned by lookup_arxiv().
+    """
+    id_list = ",".join(arxivs)
+    url = (
+        f"http://export.arxiv.org/api/query?id_list={id_list}&max_results={len(arxivs)}"
+    )
+    response = provider_get("arxiv", url)
+    try:
+        et = DET.fromstring(response.text)
+    except:
+        raise ProviderUnavailable("arxiv: unreadable response")
+    found = {}
+    for entry in et.findall("atom:entry", arxiv_namespaces):
+        # The entry ID is a URL such as http://arxiv.org/abs/1708.05919v1.
+        entry_id = entry.findtext("atom:id", "", arxiv_namespaces)
+        arxiv = re.sub(r"v\d+$", "", entry_id.split("/abs/")[-1])
+        if arxiv not in arxivs:
+            continue
+        try:
+            data = arxiv_entry(entry, arxiv)
+        except:
+            continue
+        if data:
+            found[arxiv] = data
+    return found
+
+
 def lookup_doc(doctype, docid):
     """Find document details with an internet lookup.
 
@@ -180,3 +384,81 @@ def lookup_doc(doctype, docid):
             return lookup_arxiv(docid)
         case IDType.TITLE:
             return {}
+
+
+def provider(doctype):
+    """Return the name of the online database that looks up doctype"""
+    match doctype:
+        case x if x in [IDType.ISBN10, IDType.ISBN13]:
+            return "openlibrary"
+        case IDType.DOI:
+            return "crossref"
+        case IDType.ARXIV:
+            return "arxiv"
+        case _:
+            return None
+
+
+# The lookups of lookup_docs() run in the threads of their provider, at
+# most LOOKUP_CONCURRENCY[provider] at once; the batches waiting for a
+# busy provider hold no thread.
+lookup_executors = {
+    name: ThreadPoolExecutor(max_workers=n, thread_name_prefix=f"lookup-{name}")
+    for name, n in LOOKUP_CONCURRENCY.items()
+}
+provider_buckets = {
+    name: TokenBucket(rate, burst) for name, (rate, burst) in LOOKUP_RATES.items()
+}
+provider_breakers = {
+    name: CircuitBreaker(CIRCUIT_FAILURES, CIRCUIT_RESET_TIMEOUT)
+    for name in LOOKUP_RATES
+}
+
+
+def lookup_batch(name, docids):
+    """Look up docids, all known to provider name, in a single request
+
+    Returns a dictionary mapping each (doctype, docid) pair of docids
+    to its details, {} if it was not found, or None if the provider was
+    unavailable. If the provider refused the request, the docids are
+    looked up one at a time, and one refused alone is not found.
+    """
+    batch_lookup = dict(
+        openlibrary=lookup_isbns, crossref=lookup_dois, arxiv=lookup_arxivs
+    )[name]
+    try:
+        found = batch_lookup([docid for _, docid in docids])
+    except ProviderUnavailable:
+        return {d: None for d in docids}
+    except LookupRejected:
+        found = None if len(docids) > 1 else {}
+    if found is None:
+        # A single docid may be refusing the whole batch.
+        return {d: x for pair in docids for d, x in lookup_batch(name, [pair]).items()}
+    return {(doctype, docid): found.get(docid, {}) for doctype, docid in docids}
+
+
+def lookup_docs(docids):
+    """Find the details of several documents with internet lookups.
+
+    docids is an iterable of (doctype, docid) pairs. The pairs are
+    grouped by provider and looked up in batches of up to
+    LOOKUP_BATCH_SIZE per request, running concurrently. Returns a
+    dictionary mapping each pair to its details, {} if it was not
+    found, or None if its provider was unavailable and the lookup
+    should be retried later."""
+    docids = list(dict.fromkeys(docids))
+    batches = collections.defaultdict(list)
+    for d in docids:
+        name = provider(d[0])
+        if name is not None:
+            batches[name].append(d)
+    futures = [
+        lookup_executors[name].submit(lookup_batch, name, ds[i : i + LOOKUP_BATCH_SIZE])
+        for name, ds in batches.items()
+        for i in range(0, len(ds), LOOKUP_BATCH_SIZE)
+    ]
+    found = {d: {} for d in docids}
+    for future in futures:
+        found.update(future.result())
+    return found
@@ -16,12 +16,17 @@
 
 """idparser.py
 
-The parser function :func:`idparse` for identifiers found in e-mails.
+The parser function :func:`idparse` for identifiers found in e-mails,
+and the validation and conversion of ISBNs.
 
 """
 
 import lark
 import enum
+import os
+import re
+
+from app.conf import CG_CACHE_DIR
 
 
 class IDType(enum.Enum):
@@ -32,6 +37,80 @@ class IDType(enum.Enum):
     TITLE = enum.auto()
 
 
+def isbn10_check_digit(digits):
+    """The check digit of the first 9 digits of an ISBN-10"""
+    total = sum((10 - i) * int(d) for i, d in enumerate(digits[:9]))
+    check = -total % 11
+    return "X" if check == 10 else str(check)
+
+
+def isbn13_check_digit(digits):
+    """The check digit of the first 12 digits of an ISBN-13"""
+    total = sum((3 if i % 2 else 1) * int(d) for i, d in enumerate(digits[:12]))
+    return str(-total % 10)
+
+
+def valid_isbn(isbn):
+    """Whether isbn is an ISBN-10 or ISBN-13 with a correct check digit"""
+    if len(isbn) == 10 and isbn[:9].isdigit():
+        return isbn[9] == isbn10_check_digit(isbn)
+    if len(isbn) == 13 and isbn.isdigit():
+        return isbn[12] == isbn13_check_digit(isbn)
+    return False
+
+
+def isbn10_to_13(isbn10):
+    """Convert a valid ISBN-10 to its ISBN-13"""
+    digits = "978" + isbn10[:9]
+    return digits + isbn13_check_digit(digits)
+
+
+def isbn13_to_10(isbn13):
+    """Convert a valid ISBN-13 to its ISBN-10, or None if it has none
+
+    Only the ISBN-13 with the 978 prefix have an ISBN-10.
+    """
+    if not isbn13.startswith("978"):
+        return None
+    digits = isbn13[3:12]
+    return digits + isbn10_check_digit(digits)
+
+
+def normalize_isbn(isbn):
+    """The ISBN-10 or ISBN-13 isbn as stored, or None if it is invalid
+
+    Hyphens and spaces are removed and the check digit X is
+    upper-cased, as idparse() does.
+    """
+    isbn = re.sub(r"[-\s]", "", isbn).upper()
+    return isbn if valid_isbn(isbn) else None
+
+
+def normalize_doi(doi):
+    """The DOI doi as stored; DOIs are case-insensitive"""
+    return doi.strip().lower()
+
+
+def normalize_docid(doctype, docid):
+    """The (IDType, str) pair of an identifier as stored in the database"""
+    if doctype == IDType.DOI:
+        return (doctype, normalize_doi(docid))
+    return (doctype, docid)
+
+
+def isbn_twin(doctype, docid):
+    """The (IDType, str) pair of the other form of an ISBN
+
+    Returns None if the pair is not an ISBN or has no other form.
+    """
+    match doctype:
+        case IDType.ISBN10:
+            return (IDType.ISBN13, isbn10_to_13(docid))
+        case IDType.ISBN13 if (isbn10 := isbn13_to_10(docid)) is not None:
+            return (IDType.ISBN10, isbn10)
+    return None
+
+
 class MyTransformer(lark.Transformer):
     def doi(self, xs):
         return (IDType.DOI, xs[-1])
@@ -55,32 +134,18 @@ class MyTransformer(lark.Transformer):
         return "".join(xs)
 
     def isbn(self, xs):
-        x = xs[-1]
+        x = xs[-1].upper()
+        # Numbers that are not ISBNs are left to be parsed as titles.
+        if not valid_isbn(x):
+            raise ValueError(f"invalid ISBN {x}")
         if len(x) == 10:
             return (IDType.ISBN10, x)
         else:
             return (IDType.ISBN13, x)
 
 
-def idparse(s: str):
-    """Identify the type of format followed by s
-
-    Can be one of:
-    1. ISBN (ISBN-10 or ISBN-13)
-    3. DOI
-    4. arXiv
-    5. Title (book or article)
-
-    Returns an (IDType, str) pair, where the string is the normalized
-    version of the identifier.
-
-    """
-    if not hasattr(idparse, "p"):
-        setattr(
-            idparse,
-            "p",
-            lark.Lark(
-                r"""
+# The grammar of the identifiers parsed by idparse().
+GRAMMAR = r"""
 ?start: isbn
       | arxiv
       | doi
@@ -111,10 +176,11 @@ ARXIV_VERSION: "v" INT
 
 isbn: ISBN_PREFIX? isbn_code
 
-isbn_code: INT ("-"? INT)*
+isbn_code: INT ("-"? INT)* ("-"? ISBN_CHECK_X)?
 ISBN_PREFIX: ISBN_LITERAL (/[-_]/? ("10" | "13") (" " | ":"))? ":"?
 
 ISBN_LITERAL: /ISBN/i
+ISBN_CHECK_X: /x/i
 
 // Common tokens.
 HTTP: /https?:\/\//i
@@ -126,16 +192,117 @@ ALNUM: DIGIT | LETTER
 %import common.INT
 %import common.WORD
 %ignore " "
-""",
-                parser="lalr",
-            ).parse,
-        )
-    s = s.strip()
+"""
+
+
+def parser_cache(cache_dir=CG_CACHE_DIR):
+    """The path of the cache of the grammar analysis in cache_dir, or False
+
+    Lark unpickles the cache, so it is only kept in a directory that
+    belongs to the user and that no one else may write to.
+    """
+    if not cache_dir:
+        return False
     try:
-        tree = idparse.p(s)
-        return MyTransformer().transform(tree)
-    except:
-        if "/" in s:
-            return (IDType.DOI, s)
-        else:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        st = os.stat(cache_dir)
+    except OSError:
+        return False
+    if st.st_uid != os.getuid() or st.st_mode & 0o022:
+        return False
+    return os.path.join(cache_dir, "idparser.lark")
+
+
+# The parser is built once, with its grammar analysis cached on disk
+# across runs, and transforms the parse tree while parsing.
+parser = lark.Lark(
+    GRAMMAR, parser="lalr", transformer=MyTransformer(), cache=parser_cache()
+)
+
+
+# Anchored regular expressions of the common shapes of identifiers,
+# tried by idparse() before the grammar. Each alternative accepts a
+# subset of what the grammar accepts for the same identifier, with the
+# same case-insensitivity.
+FAST_ID = re.compile(
+    "|".join(
+        [
+            r"(?:(?i:isbn)(?:[-_]?1[03][ :])?:?[ ]*)?"
+            r"(?P<isbn>[0-9](?:-?[0-9])*(?:-?(?i:x))?)",
+            r"(?i:doi:)[ ]*(?P<doi>DOI_PART/DOI_PART)",
+            r"(?i:https?://)?(?:www\.)?(?i:doi\.org/)(?P<doi_link>DOI_PART/DOI_PART)/?",
+            r"(?P<bare_doi>10\.[0-9]+/.*)",
+            r"(?i:https?://)?(?:www\.)?(?:(?i:arxiv\.org/(?:abs|pdf)/)|(?i:arxiv:))[ ]*"
+            r"(?P<arxiv>[0-9]+)\.(?P<arxiv_number>[0-9]+)(?:v[0-9]+)?"
+            r"(?:[ ]*\[[A-Za-z]+(?:[-.][A-Za-z]+)*\])?/?",
+        ]
+    ).replace("DOI_PART", r"[A-Za-z0-9]+(?:[-.][A-Za-z0-9]+)*"),
+    re.DOTALL,
+)
+
+# Without a digit nor a slash, the grammar parses nothing.
+GRAMMAR_NEEDED = re.compile(r"[0-9/]")
+
+
+def fast_idparse(s):
+    """Identify s with FAST_ID, like idparse() on a stripped s
+
+    Returns None if s must be left to the grammar.
+    """
+    m = FAST_ID.fullmatch(s)
+    if m is None:
+        return None if GRAMMAR_NEEDED.search(s) else (IDType.TITLE, s)
+    if (isbn := m["isbn"]) is not None:
+        isbn = isbn.replace("-", "").upper()
+        if not valid_isbn(isbn):
             return (IDType.TITLE, s)
+        return (IDType.ISBN10 if len(isbn) == 10 else IDType.ISBN13, isbn)
+    if m["arxiv"] is not None:
+        return (IDType.ARXIV, f"{m['arxiv']}.{m['arxiv_number']}")
+    if m["bare_doi"] is not None:
+        return (IDType.DOI, s)
+    return (IDType.DOI, m["doi"] or m["doi_link"])
+
+
+def grammar_idparse(s):
+    """Identify a stripped s with the grammar alone"""
+    try:
+        return parser.parse(s)
+    except:
+        return unparsed(s)
+
+
+def idparse(s: str):
+    """Identify the type of format followed by s
+
+    Can be one of:
+    1. ISBN (ISBN-10 or ISBN-13, with a correct check digit)
+    3. DOI
+    4. arXiv
+    5. Title (book or article)
+
+    Returns an (IDType, str) pair, where the string is the normalized
+    version of the identifier. The common shapes of identifiers are
+    recognized by :func:`fast_idparse`, and the rest by the grammar.
+
+    """
+    s = s.strip()
+    return fast_idparse(s) or grammar_idparse(s)
+
+
+def unparsed(s):
+    """Identify s that the grammar does not parse as a DOI or a title"""
+    if "/" in s:
+        return (IDType.DOI, s)
+    else:
+        return (IDType.TITLE, s)
+
+
+def idparse_many(strings):
+    """Return the list of idparse() of each of strings"""
+    fast, slow = fast_idparse, grammar_idparse
+    results = []
+    for s in strings:
+        s = s.strip()
+        results.append(fast(s) or slow(s))
+    return results
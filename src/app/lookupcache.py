@@ -0,0 +1,165 @@
+# communalgrowth-website, the communalgrowth.org website.
+# Copyright (C) 2024  Communal Growth, LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""lookupcache.py
+
+A cache of the online lookups of document IDs, kept in the database.
+
+Successful lookups are kept for LOOKUP_CACHE_TTL seconds. Failed
+lookups are kept too, so that a bad ID does not send a request to the
+online databases with every mail; they expire after an exponential
+backoff starting at LOOKUP_FAILURE_TTL seconds.
+
+Lookups that could not be made because their provider was unavailable
+are not cached; their jobs stay in the mail_job queue to be attempted
+again, see mailqueue.py.
+
+"""
+
+from sqlalchemy import case, delete, func, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+
+from app.cgdb import LookupCache
+from app.conf import (
+    LOOKUP_CACHE_TTL,
+    LOOKUP_FAILURE_TTL,
+    LOOKUP_FAILURE_MAX_TTL,
+)
+
+
+def seconds(n):
+    """The SQL interval of n seconds"""
+    return func.make_interval(0, 0, 0, 0, 0, 0, n)
+
+
+def key_in(docids):
+    """The SQL condition that the cache key is one of docids"""
+    return tuple_(LookupCache.idtype, LookupCache.docid).in_(docids)
+
+
+def cached_lookups(session, docids):
+    """Return the unexpired lookups of docids in the cache
+
+    docids is a list of (doctype, docid) pairs. Returns a dictionary
+    mapping the pairs found in the cache to their lookup result, which
+    is {} for a failed lookup.
+    """
+    if not docids:
+        return {}
+    rows = session.execute(
+        select(LookupCache.idtype, LookupCache.docid, LookupCache.payload).where(
+            key_in(docids), LookupCache.expires > func.now()
+        )
+    )
+    return {(idtype, docid): payload or {} for idtype, docid, payload in rows}
+
+
+def count_hits(session, docids):
+    """Count a use of the cached lookups of docids"""
+    if not docids:
+        return
+    session.execute(
+        update(LookupCache)
+        .where(key_in(docids))
+        .values(hits=LookupCache.hits + 1)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def store_lookups(session, results):
+    """Store the results of online lookups in the cache
+
+    results maps (doctype, docid) pairs to the return value of
+    docid.lookup_doc(). A failure extends the backoff of the ID and a
+    success resets it. The rows are written in the order of their keys,
+    so that concurrent writers lock them in the same order.
+    """
+    if not results:
+        return
+    stmt = insert(LookupCache).values(
+        [
+            dict(
+                idtype=doctype,
+                docid=docid,
+                payload=payload or None,
+                failures=0 if payload else 1,
+                lookups=1,
+                hits=0,
+                expires=func.now()
+                + seconds(LOOKUP_CACHE_TTL if payload else LOOKUP_FAILURE_TTL),
+            )
+            for (doctype, docid), payload in sorted(
+                results.items(), key=lambda item: (item[0][0].name, item[0][1])
+            )
+        ]
+    )
+    failed = stmt.excluded.payload.is_(None)
+    backoff = func.least(
+        LOOKUP_FAILURE_TTL * func.power(2, LookupCache.failures),
+        LOOKUP_FAILURE_MAX_TTL,
+    )
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[LookupCache.idtype, LookupCache.docid],
+            set_=dict(
+                payload=stmt.excluded.payload,
+                failures=case((failed, LookupCache.failures + 1), else_=0),
+                lookups=LookupCache.lookups + 1,
+                expires=func.now()
+                + case((failed, seconds(backoff)), else_=seconds(LOOKUP_CACHE_TTL)),
+            ),
+        )
+    )
+
+
+def invalidate_lookups(session, docids=None, failures_only=False):
+    """Remove lookups from the cache
+
+    Removes the lookups of the (doctype, docid) pairs in docids, or all
+    of them if docids is None; only the failed ones if failures_only.
+    Returns the number of removed lookups.
+    """
+    stmt = delete(LookupCache)
+    if docids is not None:
+        stmt = stmt.where(key_in(docids))
+    if failures_only:
+        stmt = stmt.where(LookupCache.payload.is_(None))
+    return session.execute(stmt).rowcount
+
+
+def lookup_cache_stats(session):
+    """Return the statistics of the cache as a dictionary
+
+    hits counts the lookups answered by the cache and lookups those
+    sent to the online databases.
+    """
+    row = session.execute(
+        select(
+            func.count(),
+            func.count().filter(LookupCache.payload.is_(None)),
+            func.count().filter(LookupCache.expires <= func.now()),
+            func.coalesce(func.sum(LookupCache.hits), 0),
+            func.coalesce(func.sum(LookupCache.lookups), 0),
+        )
+    ).one()
+    entries, failures, expired, hits, lookups = row
+    return dict(
+        entries=entries,
+        failures=failures,
+        expired=expired,
+        hits=hits,
+        lookups=lookups,
+    )
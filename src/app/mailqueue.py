@@ -0,0 +1,191 @@
+# communalgrowth-website, the communalgrowth.org website.
+# Copyright (C) 2024  Communal Growth, LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""mailqueue.py
+
+The queue of the requests received by mail, kept in the mail_job table.
+
+maildird queues the jobs of a mail with enqueue_jobs() and deletes the
+mail once they are committed. The queue workers claim the due jobs
+with claim_jobs(), any number of workers sharing the queue, and remove
+them with finish_jobs() once done. A claimed job that is not finished,
+because its worker failed or its lookup could not be made, is due again
+after a backoff starting at QUEUE_RETRY_DELAY seconds, until it is
+marked failed by fail_jobs() after QUEUE_MAX_ATTEMPTS attempts.
+
+"""
+
+from sqlalchemy import delete, func, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import aliased
+
+from app.cgdb import MailJob
+from app.conf import QUEUE_MAX_ATTEMPTS, QUEUE_RETRY_DELAY, QUEUE_RETRY_MAX_DELAY
+from app.lookupcache import seconds
+
+
+def enqueue_jobs(session, email, action, docids=()):
+    """Queue the action of the user email on docids
+
+    action is "subscribe" or "unsubscribe", and docids a list of
+    (doctype, docid) pairs; a request for an ID already queued for
+    email replaces it. action may also be "forget", which replaces all
+    the jobs queued for email. A failed job requested again is
+    attempted again.
+    """
+    if action == "forget":
+        session.execute(delete(MailJob).where(MailJob.email == email))
+        session.execute(insert(MailJob).values(email=email, action=action))
+        return
+    if not docids:
+        return
+    stmt = insert(MailJob).values(
+        [
+            dict(email=email, action=action, idtype=doctype, docid=docid)
+            for doctype, docid in dict.fromkeys(docids)
+        ]
+    )
+    session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[MailJob.email, MailJob.idtype, MailJob.docid],
+            set_=dict(
+                action=stmt.excluded.action,
+                attempts=0,
+                next_attempt=func.now(),
+                failed=False,
+            ),
+        )
+    )
+
+
+def fail_jobs(session):
+    """Mark failed the due jobs attempted QUEUE_MAX_ATTEMPTS times
+
+    These are no longer claimed, but kept for inspection until their
+    user requests them again or is forgotten. Returns the number of
+    jobs marked failed.
+    """
+    return session.execute(
+        update(MailJob)
+        .where(
+            MailJob.next_attempt <= func.now(),
+            MailJob.attempts >= QUEUE_MAX_ATTEMPTS,
+            MailJob.failed.is_(False),
+        )
+        .values(failed=True)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+
+def claim_jobs(session, limit):
+    """Claim up to limit due jobs, the oldest first
+
+    The failed jobs are skipped, see fail_jobs(), as are the jobs
+    locked by another worker and the jobs queued after a forget of
+    their user that is not done yet. The claimed jobs are due again
+    after a delay doubling with every attempt, from QUEUE_RETRY_DELAY
+    up to QUEUE_RETRY_MAX_DELAY seconds, unless finished before. The
+    claim must be committed before the jobs are processed.
+
+    Returns (id, email, action, idtype, docid) rows.
+    """
+    job, forget = aliased(MailJob), aliased(MailJob)
+    forgetting = (
+        select(forget.id)
+        .where(
+            forget.email == job.email,
+            forget.action == "forget",
+            forget.failed.is_(False),
+            forget.id < job.id,
+        )
+        .exists()
+    )
+    due = (
+        select(job.id)
+        .where(job.next_attempt <= func.now(), job.failed.is_(False), ~forgetting)
+        .order_by(job.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    backoff = func.least(
+        QUEUE_RETRY_DELAY * func.power(2, MailJob.attempts), QUEUE_RETRY_MAX_DELAY
+    )
+    return session.execute(
+        update(MailJob)
+        .where(MailJob.id.in_(due))
+        .values(
+            attempts=MailJob.attempts + 1,
+            next_attempt=func.now() + seconds(backoff),
+        )
+        .returning(
+            MailJob.id, MailJob.email, MailJob.action, MailJob.idtype, MailJob.docid
+        )
+        .execution_options(synchronize_session=False)
+    ).all()
+
+
+def lock_jobs(session, jobs):
+    """Lock the claimed jobs and their users until the end of the transaction
+
+    The users are locked so that the jobs of a user are processed by
+    one worker at a time. Returns the ids of the jobs still queued
+    with the same action; the others were replaced or dropped since
+    they were claimed.
+    """
+    for email in sorted({job.email for job in jobs}):
+        session.execute(select(func.pg_advisory_xact_lock(func.hashtext(email))))
+    return set(
+        session.scalars(
+            select(MailJob.id)
+            .where(
+                tuple_(MailJob.id, MailJob.action).in_(
+                    [(job.id, job.action) for job in jobs]
+                )
+            )
+            .order_by(MailJob.id)
+            .with_for_update()
+        )
+    )
+
+
+def finish_jobs(session, ids):
+    """Remove the jobs ids, which are done, from the queue"""
+    if not ids:
+        return
+    session.execute(delete(MailJob).where(MailJob.id.in_(ids)))
+
+
+def mail_queue_stats(session):
+    """Return the statistics of the queue as a dictionary
+
+    retried counts the jobs attempted more than once, and failed the
+    jobs no longer attempted.
+    """
+    row = session.execute(
+        select(
+            func.count(),
+            func.count().filter(
+                MailJob.next_attempt <= func.now(), MailJob.failed.is_(False)
+            ),
+            func.count().filter(MailJob.attempts > 1),
+            func.count().filter(MailJob.failed),
+            func.coalesce(func.max(MailJob.attempts), 0),
+        )
+    ).one()
+    jobs, due, retried, failed, attempts = row
+    return dict(
+        jobs=jobs, due=due, retried=retried, failed=failed, max_attempts=attempts
+    )
@@ -14,6 +14,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import json
 import os
 from importlib.resources import files, as_file
 from contextlib import asynccontextmanager
@@ -24,20 +25,42 @@ import psycopg
 from litestar import Controller, Litestar, MediaType, Request, Response, get
 from litestar.contrib.jinja import JinjaTemplateEngine
 from litestar.datastructures import CacheControlHeader, State
-from litestar.exceptions import HTTPException
-from litestar.response import Template
+from litestar.connection import ASGIConnection
+from litestar.exceptions import HTTPException, NotFoundException
+from litestar.handlers.base import BaseRouteHandler
+from litestar.response import Stream, Template
 from litestar.static_files import create_static_files_router
 from litestar.status_codes import HTTP_404_NOT_FOUND, HTTP_500_INTERNAL_SERVER_ERROR
 from litestar.template.config import TemplateConfig
 from litestar.params import Parameter
 
-from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker
 
-from app.search import search_documents, search_recent
+from app.cache import SearchCache, normalize_search_term
+from app.conf import (
+    API_JSON_MAX_RESULTS,
+    API_MAX_RESULTS,
+    RECENT_DOCUMENTS,
+    SEARCH_CACHE_MAX_BYTES,
+    SEARCH_CACHE_TTL,
+    STATS_ENABLED,
+)
+from app.dbpool import InstrumentedPool, create_engine
+from app.search import (
+    parse_after,
+    search_documents,
+    search_recent,
+    stream_documents,
+    stream_recent,
+)
 from app.utils import parse_pgpass
 
 global_ctx = {"website_name": "Communal Growth"}
 
+NDJSON = "application/x-ndjson"
+
+search_cache = SearchCache(ttl=SEARCH_CACHE_TTL, max_bytes=SEARCH_CACHE_MAX_BYTES)
+
 with as_file(files("app").joinpath("static")) as static_dir:
     static_router = create_static_files_router(path="/static", directories=[static_dir])
 
@@ -64,6 +87,12 @@ def server_error_404(router: Request, exc: Exception) -> Template:
     )
 
 
+def stats_enabled(_: ASGIConnection, __: BaseRouteHandler) -> None:
+    """Guard hiding the /stats route unless STATS_ENABLED."""
+    if not STATS_ENABLED:
+        raise NotFoundException()
+
+
 class MyController(Controller):
     cache_control = CacheControlHeader(max_age=86_400, public=True)
 
@@ -77,23 +106,45 @@ class MyController(Controller):
 
     @get("/", cache_control=CacheControlHeader(no_store=True))
     async def search(
-        self, state: State, s: str = Parameter(default="", max_length=300)
+        self,
+        state: State,
+        s: str = Parameter(default="", max_length=300),
+        after: str = Parameter(default="", max_length=64),
     ) -> Template:
         d = dict(
             search_value=s,
             results=[],
+            after=None,
         )
         if s:
-            Session = async_sessionmaker(bind=state.engine)
-            results = await search_documents(Session, s)
+            term = normalize_search_term(s)
+            results, next_after = await search_cache.get(
+                ("search", term, after),
+                lambda: search_documents(state.Session, term, after=parse_after(after)),
+            )
             d["results"] = results
+            d["after"] = next_after
         else:
-            Session = async_sessionmaker(bind=state.engine)
-            results = await search_recent(Session)
+            results = await search_cache.get(
+                ("recent",), lambda: search_recent(state.Session)
+            )
             d["results"] = results
         ctx = global_ctx | d
         return Template(template_name="search.html.jinja2", context=ctx)
 
+    @get(
+        "/stats",
+        cache_control=CacheControlHeader(no_store=True),
+        include_in_schema=False,
+        guards=[stats_enabled],
+    )
+    async def stats(self, state: State) -> dict:
+        d = dict(search_cache=search_cache.stats())
+        pool = state.engine.pool
+        if isinstance(pool, InstrumentedPool):
+            d["db_pool"] = pool.stats()
+        return d
+
     @get("/subscribe")
     async def subscribe(self) -> Template:
         return Template(template_name="subscribe.html.jinja2", context=global_ctx)
@@ -103,6 +154,62 @@ class MyController(Controller):
         return Template(template_name="contact.html.jinja2", context=global_ctx)
 
 
+def wants_ndjson(request: Request, limit: int) -> bool:
+    """Whether to stream the results of the JSON API as NDJSON."""
+    accept = request.headers.get("accept", "")
+    return limit > API_JSON_MAX_RESULTS or NDJSON in accept
+
+
+async def ndjson_lines(items):
+    """Encode each item of an async iterable as a line of NDJSON."""
+    async for item in items:
+        yield (json.dumps(item, separators=(",", ":")) + "\n").encode()
+
+
+class ApiController(Controller):
+    path = "/api"
+    cache_control = CacheControlHeader(no_store=True)
+
+    @get("/search")
+    async def search(
+        self,
+        request: Request,
+        state: State,
+        s: str = Parameter(max_length=300),
+        limit: int = Parameter(default=API_JSON_MAX_RESULTS, ge=1, le=API_MAX_RESULTS),
+        after: str = Parameter(default="", max_length=64),
+    ) -> Response:
+        items = stream_documents(
+            state.Session,
+            normalize_search_term(s),
+            limit=limit,
+            after=parse_after(after),
+        )
+        if wants_ndjson(request, limit):
+            return Stream(
+                ndjson_lines(item async for _, item in items), media_type=NDJSON
+            )
+        results = []
+        next_after = None
+        async for cursor, item in items:
+            results.append(item)
+            if len(results) == limit:
+                next_after = cursor
+        return Response(dict(results=results, after=next_after))
+
+    @get("/recent")
+    async def recent(
+        self,
+        request: Request,
+        state: State,
+        limit: int = Parameter(default=RECENT_DOCUMENTS, ge=1, le=RECENT_DOCUMENTS),
+    ) -> Response:
+        items = stream_recent(state.Session, limit=limit)
+        if wants_ndjson(request, limit):
+            return Stream(ndjson_lines(items), media_type=NDJSON)
+        return Response(dict(results=[item async for item in items]))
+
+
 @asynccontextmanager
 async def db_connection(app: Litestar) -> AsyncGenerator[None, None]:
     engine = getattr(app.state, "engine", None)
@@ -111,8 +218,10 @@ async def db_connection(app: Litestar) -> AsyncGenerator[None, None]:
         # bug preventing me from doing so; see the documentation of
         # parse_pgpass.
         db_url = parse_pgpass(os.environ["PGPASSFILE"])
-        engine = create_async_engine(db_url)
+        engine = create_engine(db_url)
         setattr(app.state, "engine", engine)
+    # The session factory is shared by all requests.
+    setattr(app.state, "Session", async_sessionmaker(bind=engine))
     try:
         yield
     finally:
@@ -120,7 +229,7 @@ async def db_connection(app: Litestar) -> AsyncGenerator[None, None]:
 
 
 app = Litestar(
-    route_handlers=[MyController, static_router],
+    route_handlers=[MyController, ApiController, static_router],
     template_config=TemplateConfig(directory=templates_dir, engine=JinjaTemplateEngine),
     openapi_config=None,
     exception_handlers={
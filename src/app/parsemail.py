@@ -23,33 +23,118 @@ The main function is :func:`mail_to_docid`.
 
 """
 
+import binascii
+import codecs
 import email
 import email.utils
 import email.policy
 from email.message import EmailMessage
 import html.parser
-from itertools import islice
+import re
+from itertools import chain, islice
 from app import utils
 from app import idparser
-from app.conf import RATELIMIT_DOCIDS
+from app.conf import MAIL_CHUNK_SIZE, MAIL_MAX_TEXT, RATELIMIT_DOCIDS
+
+# The elements that start a new line of text, the elements whose
+# content is not text of the mail, and the classes of the elements
+# quoting an earlier mail.
+BLOCK_TAGS = {
+    "address", "article", "aside", "blockquote", "br", "caption", "dd", "div",
+    "dl", "dt", "fieldset", "figcaption", "figure", "footer", "form", "h1",
+    "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main", "nav", "ol",
+    "p", "pre", "section", "table", "tbody", "td", "tfoot", "th", "thead",
+    "tr", "ul",
+}  # fmt: skip
+SKIPPED_TAGS = {"blockquote", "head", "noscript", "script", "style", "template"}
+QUOTE_CLASSES = {"gmail_quote", "moz-cite-prefix"}
+
+
+def enough_lines(lines, tokens, max_lines, max_tokens):
+    """Whether lines holding tokens comma-separated tokens are enough"""
+    return (max_lines is not None and lines >= max_lines) or (
+        max_tokens is not None and tokens >= max_tokens
+    )
+
+
+class EnoughText(Exception):
+    """Raised by MyHTMLParser once it has all the text it needs"""
 
 
 class MyHTMLParser(html.parser.HTMLParser):
-    """Keep the HTML tag content while stripping all tags."""
+    """Keep the text of an HTML e-mail, one line per block of text.
+
+    The content of non-text elements and of quoted mails is dropped,
+    and so is the signature. Lines are stripped and blank lines skipped
+    like those of a text e-mail. Once max_lines lines or max_tokens
+    comma-separated tokens are kept, or the signature is reached,
+    :class:`EnoughText` is raised; :meth:`end_line` keeps the text fed
+    after the last block.
+
+    """
 
-    def __init__(self):
+    def __init__(self, max_lines=None, max_tokens=None):
         super().__init__()
+        self.max_lines = max_lines
+        self.max_tokens = max_tokens
         self.data = []
+        self.tokens = 0
         self.signature = False
+        self.line = []
+        # The skipped element and how many elements of its tag are open.
+        self.skipped = None
+        self.skipped_depth = 0
+        self.pre_depth = 0
 
     def handle_data(self, data):
-        """Strips email signature"""
-        if self.signature:
+        if self.skipped is not None:
             return
-        if data == "-- ":
+        if self.pre_depth:
+            *lines, data = data.split("\n")
+            for line in lines:
+                self.line.append(line)
+                self.end_line()
+        self.line.append(data)
+
+    def end_line(self):
+        """Keep the text of the current line, stripping email signature"""
+        line = " ".join("".join(self.line).split())
+        self.line.clear()
+        if not line:
+            return
+        if line == "--":
             self.signature = True
-        elif data and not data.isspace():
-            self.data.append(data)
+            raise EnoughText
+        self.data.append(line)
+        self.tokens += line.count(",") + 1
+        if enough_lines(len(self.data), self.tokens, self.max_lines, self.max_tokens):
+            raise EnoughText
+
+    def handle_starttag(self, tag, attrs):
+        if self.skipped is not None:
+            if tag == self.skipped:
+                self.skipped_depth += 1
+            return
+        if tag in BLOCK_TAGS:
+            self.end_line()
+        classes = set((dict(attrs).get("class") or "").split())
+        if tag in SKIPPED_TAGS or classes & QUOTE_CLASSES:
+            self.skipped = tag
+            self.skipped_depth = 1
+        elif tag == "pre":
+            self.pre_depth += 1
+
+    def handle_endtag(self, tag):
+        if self.skipped is not None:
+            if tag == self.skipped:
+                self.skipped_depth -= 1
+                if self.skipped_depth == 0:
+                    self.skipped = None
+            return
+        if tag in BLOCK_TAGS:
+            self.end_line()
+        if tag == "pre" and self.pre_depth:
+            self.pre_depth -= 1
 
 
 def parse_address(mail: EmailMessage):
@@ -58,56 +143,154 @@ def parse_address(mail: EmailMessage):
     return addr
 
 
-def parse_mail(mail: EmailMessage):
+def text_parts(mail: EmailMessage, subtype):
+    """The text/subtype parts of the body of an e-mail, without attachments"""
+    return [
+        part
+        for part in mail.walk()
+        if part.get_content_type() == f"text/{subtype}" and not part.is_attachment()
+    ]
+
+
+NOT_BASE64 = re.compile(r"[^A-Za-z0-9+/=]")
+
+
+def decoded_chunks(payload, cte, size):
+    """Yield the bytes of a base64 or quoted-printable payload
+
+    The payload is decoded size characters at a time.
+    """
+    rest = ""
+    for i in range(0, len(payload), size):
+        chunk = rest + payload[i : i + size]
+        if cte == "base64":
+            chunk = NOT_BASE64.sub("", chunk)
+            n = len(chunk) - len(chunk) % 4
+            chunk, rest = chunk[:n], chunk[n:]
+            yield binascii.a2b_base64(chunk)
+        else:
+            # Decode whole lines, so that no escape is cut in two.
+            n = chunk.rfind("\n") + 1 or chunk.find("=", len(chunk) - 2)
+            if n < 0:
+                n = len(chunk)
+            chunk, rest = chunk[:n], chunk[n:]
+            yield binascii.a2b_qp(chunk.encode("ascii", "replace"))
+    if rest and cte == "base64":
+        try:
+            yield binascii.a2b_base64(rest + "=" * (-len(rest) % 4))
+        except binascii.Error:
+            pass
+    elif rest:
+        yield binascii.a2b_qp(rest.encode("ascii", "replace"))
+
+
+def payload_text(part, size):
+    """Yield the decoded text of part, size characters of its payload at a time"""
+    payload = part.get_payload()
+    cte = str(part.get("content-transfer-encoding", "")).lower()
+    if cte not in ("base64", "quoted-printable"):
+        # The payload of the other encodings is already text.
+        for i in range(0, len(payload), size):
+            yield payload[i : i + size]
+        return
+    charset = part.get_content_charset() or "utf-8"
+    # Parts fetched from IMAP may be cut in the middle of a character.
+    decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+    for chunk in decoded_chunks(payload, cte, size):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def text_chunks(parts, max_text):
+    """Yield the decoded text of parts in chunks, up to about max_text characters"""
+    for part in parts:
+        for text in payload_text(part, MAIL_CHUNK_SIZE):
+            yield text
+            max_text -= len(text)
+            if max_text <= 0:
+                return
+
+
+# The characters str.splitlines() splits at.
+LINE_BREAK = re.compile(r"[\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029]")
+
+
+def clean_lines(chunks):
+    """Yield the lines of the text in chunks, like utils.splitlines_clean()"""
+    pending = []
+    for chunk in chunks:
+        if not LINE_BREAK.search(chunk):
+            pending.append(chunk)
+            continue
+        lines = "".join(pending + [chunk]).splitlines(keepends=True)
+        # Keep the last line for the next chunk unless it ended, and a
+        # "\r" in case the next chunk starts with "\n".
+        last = lines[-1]
+        ended = LINE_BREAK.match(last[-1]) and not last.endswith("\r")
+        pending = [] if ended else [lines.pop()]
+        for line in lines:
+            if not line.isspace():
+                yield line.strip()
+    line = "".join(pending)
+    if line and not line.isspace():
+        yield line.strip()
+
+
+def parse_mail(mail: EmailMessage, max_lines=None, max_tokens=None):
     """Retrieve the sender address and content body from an e-mail.
 
     Returns a pair of the sender address and a list of sentences,
-    stripped of HTML if present.
+    stripped of HTML if present. Attachments are skipped, and the text
+    is decoded incrementally, stopping at max_lines sentences, at
+    max_tokens comma-separated tokens or at MAIL_MAX_TEXT characters.
 
     """
     # Grab the sender address.
     _, addr = email.utils.parseaddr(mail["From"])
     # Grab the body (stripped of HTML, if present.)
-    plain_body = ""
-    html_body = ""
-    for part in mail.walk():
-        charset = part.get_content_charset() or "utf-8"
-        match part.get_content_type():
-            case "text/plain":
-                plain_body += part.get_payload(decode=True).decode(charset)
-            case "text/html":
-                html_body += part.get_payload(decode=True).decode(charset)
-    if plain_body:
-        body = utils.splitlines_clean(plain_body)
+    chunks = text_chunks(text_parts(mail, "plain"), MAIL_MAX_TEXT)
+    first = next((chunk for chunk in chunks if chunk), "")
+    body = []
+    tokens = 0
+    for line in clean_lines(chain([first], chunks)):
+        if line == "--" or enough_lines(len(body), tokens, max_lines, max_tokens):
+            break
+        body.append(line)
+        tokens += line.count(",") + 1
+    if not first:
+        parser = MyHTMLParser(max_lines, max_tokens)
         try:
-            i = body.index("--")
-            body = body[:i]
-        except ValueError:
+            for chunk in text_chunks(text_parts(mail, "html"), MAIL_MAX_TEXT):
+                parser.feed(chunk)
+            parser.end_line()
+        except EnoughText:
             pass
-    else:
-        parser = MyHTMLParser()
-        parser.feed(html_body)
         body = parser.data
     return addr, body
 
 
 def mail_to_docid(mail: EmailMessage):
     """Retrieve the sender address and document IDs in the body of the e-mail."""
-    addr, body = parse_mail(mail)
+    addr, body = parse_mail(
+        mail, max_lines=RATELIMIT_DOCIDS, max_tokens=RATELIMIT_DOCIDS
+    )
     # We only split a certain amount of lines; and then we only split
     # a certain amount of comma-separated document IDs from
     # each. Finally, we use islice() to only read a certain amount of
     # items. This prevents users from putting too many \n characters
     # or , characters in their e-mails and slowing down parsing.
-    ids = islice(
+    tokens = islice(
         (
-            idparser.idparse(token)
-            for line in body[:RATELIMIT_DOCIDS]
+            token
+            for line in body
             for token in line.split(",", maxsplit=RATELIMIT_DOCIDS)[:RATELIMIT_DOCIDS]
         ),
         RATELIMIT_DOCIDS,
     )
+    ids = idparser.idparse_many(tokens)
     ids = [
-        (doctype, docid) for (doctype, docid) in ids if doctype != idparser.IDType.TITLE
+        idparser.normalize_docid(doctype, docid)
+        for (doctype, docid) in ids
+        if doctype != idparser.IDType.TITLE
     ]
     return addr, ids
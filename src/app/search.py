@@ -20,145 +20,267 @@ The module enabling the search functionality on the website.
 
 """
 
-from collections import defaultdict
-
-from sqlalchemy import select, desc, func
-from sqlalchemy.orm import selectinload
-from app.cgdb import Document, CGUser, cguser_document_association
+from sqlalchemy import (
+    select,
+    desc,
+    func,
+    cast,
+    literal,
+    literal_column,
+    tuple_,
+    true,
+    REAL,
+    String,
+)
+from sqlalchemy.dialects.postgresql import insert
+from app.cgdb import (
+    Arxiv,
+    Doi,
+    Document,
+    DocumentSearch,
+    Isbn10,
+    Isbn13,
+    author_document_association,
+    cguser_document_association,
+)
+from app.conf import RECENT_DOCUMENTS, SEARCH_EMAILS, SEARCH_YIELD_PER
 from app.utils import strip_to_alphanum
 
 
-def doc_stringify_id(doc):
-    """Return a string containing the document ID.
+def parse_after(after):
+    """Parse the keyset pagination cursor of :func:`search_documents`.
 
-    ISBN-13 takes precedence over ISBN-10."""
-    if doc.isbn13:
-        return f"ISBN-13:{doc.isbn13.isbn13}"
-    elif doc.isbn10:
-        return f"ISBN-10:{doc.isbn10.isbn10}"
-    elif doc.doi:
-        return f"doi:{doc.doi.doi}"
-    elif doc.arxiv:
-        return f"arXiv:{doc.arxiv.arxiv}"
-    else:
-        return ""
+    The cursor is the string "rank:id" of the last row of the previous
+    page. Returns a (rank, id) pair, or None if after is empty or
+    malformed."""
+    try:
+        rank, doc_id = after.split(":")
+        return float(rank), int(doc_id)
+    except ValueError:
+        return None
 
 
-def doc_to_result(doc, cgusers):
-    """Convert a document to a search result."""
-    return (
-        doc.title,
-        doc_stringify_id(doc),
-        ", ".join(a.author for a in doc.authors),
-        ", ".join(u.email for u in cgusers),
+def doc_id_expr(doc_id):
+    """Return the SQL expression of the string ID of the document doc_id.
+
+    ISBN-13 takes precedence over ISBN-10, then DOI, then arXiv."""
+
+    def prefixed(prefix, column, id_column):
+        # fmt: off
+        return (
+            select(literal(prefix, String) + column)
+            .where(id_column == doc_id)
+            .limit(1)
+            .scalar_subquery()
+        )
+        # fmt: on
+
+    return func.coalesce(
+        prefixed("ISBN-13:", Isbn13.isbn13, Isbn13.id),
+        prefixed("ISBN-10:", Isbn10.isbn10, Isbn10.id),
+        prefixed("doi:", Doi.doi, Doi.id),
+        prefixed("arXiv:", Arxiv.arxiv, Arxiv.id),
+        "",
     )
 
 
-async def search_documents(Session, search_term, limit=100, email_limit=10):
-    """Search database documents (title and author last names)
+def doc_authors_expr(doc_id):
+    """Return the SQL expression of the array of authors of the document doc_id."""
+    authors = func.array_agg(author_document_association.c.author)
+    # fmt: off
+    return (
+        select(func.coalesce(authors, literal_column("'{}'::varchar[]")))
+        .where(author_document_association.c.doc_id == doc_id)
+        .scalar_subquery()
+    )
+    # fmt: on
 
-    Limits results up to 'limit' rows.
-    Session must be created by async_sessionmaker()."""
-    stripped = strip_to_alphanum(search_term)
+
+def sample_emails(doc_id, email_limit=SEARCH_EMAILS):
+    """Return a lateral subquery of up to email_limit random subscribers of doc_id."""
     # fmt: off
-    top_docs_subq = (
-        select(Document.id)
-        .order_by(desc(Document.id))
-        .limit(limit)
-        .subquery()
+    return (
+        select(cguser_document_association.c.email)
+        .where(cguser_document_association.c.doc_id == doc_id)
+        .order_by(func.random())
+        .limit(email_limit)
+        .lateral()
     )
-    row_number = (
-        func.row_number().over(
-            partition_by=cguser_document_association.c.doc_id,
-            order_by=func.random()
-        ).label("rn")
+    # fmt: on
+
+
+def document_search_upsert(doc_ids):
+    """Return the statement updating the document_search rows of doc_ids.
+
+    The rows are computed from the document tables, and inserted or
+    replaced. It must be executed in the transaction that changes the
+    documents or their subscriptions, after a flush."""
+    emails = sample_emails(Document.id)
+    subscribers = (
+        select(func.count())
+        .select_from(cguser_document_association)
+        .where(cguser_document_association.c.doc_id == Document.id)
+        .scalar_subquery()
     )
-    subq = (
+    # fmt: off
+    rows = (
         select(
-            cguser_document_association.c.doc_id,
-            cguser_document_association.c.email,
-            row_number,
+            Document.id,
+            Document.title,
+            doc_id_expr(Document.id),
+            doc_authors_expr(Document.id),
+            func.array_remove(func.array_agg(emails.c.email), None),
+            subscribers,
+            Document.tsv_title,
         )
-        .where(cguser_document_association.c.doc_id.in_(select(top_docs_subq.c.id)))
-        .subquery()
+        .select_from(Document)
+        .outerjoin(emails, true())
+        .where(Document.id.in_(doc_ids))
+        .group_by(Document.id)
+    )
+    # fmt: on
+    columns = ["title", "docid", "authors", "emails", "subscribers", "tsv_title"]
+    stmt = insert(DocumentSearch).from_select(["doc_id"] + columns, rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[DocumentSearch.doc_id],
+        set_={column: stmt.excluded[column] for column in columns},
     )
+
+
+def search_stmt(search_term, limit=100, after=None):
+    """Return the statement used by :func:`search_documents`.
+
+    The matching documents are found through the GIN index of the
+    document_search table and ranked with ts_rank_cd(); the cost thus
+    grows with the number of matches and not with the size of the
+    table. Each row is a (doc_id, rank, title, docid, authors, emails)
+    tuple of plain values."""
+    stripped = strip_to_alphanum(search_term)
+    query = func.plainto_tsquery(stripped)
+    rank = func.ts_rank_cd(DocumentSearch.tsv_title, query)
+    # fmt: off
     stmt = (
-        select(Document, CGUser)
-        .options(
-            selectinload(Document.authors),
-            selectinload(Document.isbn10),
-            selectinload(Document.isbn13),
-            selectinload(Document.doi),
-            selectinload(Document.arxiv),
+        select(
+            DocumentSearch.doc_id,
+            rank.label("rank"),
+            DocumentSearch.title,
+            DocumentSearch.docid,
+            DocumentSearch.authors,
+            DocumentSearch.emails,
         )
-        .filter(Document.tsv_title.match(stripped))
-        .select_from(
-            subq
-            .join(Document, Document.id == subq.c.doc_id)
-            .join(CGUser, CGUser.email == subq.c.email)
+        .where(
+            DocumentSearch.tsv_title.bool_op("@@")(query),
+            DocumentSearch.subscribers > 0,
+        )
+    )
+    if after is not None:
+        after_rank, after_id = after
+        # The rank is a real; cast the cursor back to it so that ties
+        # with the last row of the previous page compare equal.
+        stmt = stmt.where(
+            tuple_(rank, DocumentSearch.doc_id)
+            < tuple_(cast(after_rank, REAL), after_id)
         )
-        .where(subq.c.rn <= email_limit)
-        .order_by(desc(subq.c.doc_id))
+    stmt = (
+        stmt
+        .order_by(desc(rank), desc(DocumentSearch.doc_id))
+        .limit(limit)
     )
     # fmt: on
+    return stmt
+
+
+def row_to_result(row):
+    """Convert a row of document_search to a search result."""
+    return (
+        row.title,
+        row.docid,
+        ", ".join(row.authors),
+        ", ".join(row.emails),
+    )
+
+
+def row_to_json(row):
+    """Convert a row of document_search to a search result of the JSON API."""
+    return dict(
+        title=row.title,
+        id=row.docid,
+        authors=row.authors,
+        subscribers=row.emails,
+    )
+
+
+def row_cursor(row):
+    """Return the pagination cursor of a row of :func:`search_stmt`."""
+    return f"{row.rank!r}:{row.doc_id}"
+
+
+async def search_documents(Session, search_term, limit=100, after=None):
+    """Search database documents (title and author last names)
+
+    Results are ordered by relevance and limited up to 'limit' rows;
+    'after' is the (rank, id) cursor of the previous page, see
+    :func:`parse_after`. Returns a pair of the results and the cursor
+    of the next page, the latter being None on the last page.
+    Session must be created by async_sessionmaker()."""
     async with Session() as session:
-        result = await session.execute(stmt)
-    d = defaultdict(list)
-    for doc, cguser in result.all():
-        d[doc].append(cguser)
-    return [doc_to_result(doc, d[doc]) for doc in d.keys()]
+        rows = (await session.execute(search_stmt(search_term, limit, after))).all()
+    next_after = row_cursor(rows[-1]) if len(rows) == limit else None
+    return [row_to_result(row) for row in rows], next_after
 
 
-async def search_recent(Session, limit=10, email_limit=10):
-    """Search database for the most recent documents.
+async def stream_documents(
+    Session, search_term, limit=100, after=None, yield_per=SEARCH_YIELD_PER
+):
+    """Stream the documents matching search_term
 
-    Skips the books with no subscribers. Displays `limit` documents
-    with `email_limit` emails.
+    The same as :func:`search_documents`, except that the rows are
+    fetched from a server-side cursor, yield_per at a time. Yields
+    pairs of the pagination cursor of each document and its JSON
+    result."""
+    stmt = search_stmt(search_term, limit, after)
+    stmt = stmt.execution_options(yield_per=yield_per)
+    async with Session() as session:
+        result = await session.stream(stmt)
+        async for row in result:
+            yield row_cursor(row), row_to_json(row)
 
-    """
+
+def search_recent_stmt(limit=RECENT_DOCUMENTS):
+    """Return the statement used by :func:`search_recent`."""
     # fmt: off
-    top_docs_subq = (
-        select(Document.id)
-        .order_by(desc(Document.id))
-        .limit(limit)
-        .subquery()
-    )
-    row_number = (
-        func.row_number().over(
-            partition_by=cguser_document_association.c.doc_id,
-            order_by=func.random()
-        ).label("rn")
-    )
-    subq = (
-        select(
-            cguser_document_association.c.doc_id,
-            cguser_document_association.c.email,
-            row_number,
-        )
-        .where(cguser_document_association.c.doc_id.in_(select(top_docs_subq.c.id)))
-        .subquery()
-    )
     stmt = (
-        select(Document, CGUser)
-        .options(
-            selectinload(Document.authors),
-            selectinload(Document.isbn10),
-            selectinload(Document.isbn13),
-            selectinload(Document.doi),
-            selectinload(Document.arxiv),
-        )
-        .select_from(
-            subq
-            .join(Document, Document.id == subq.c.doc_id)
-            .join(CGUser, CGUser.email == subq.c.email)
+        select(
+            DocumentSearch.title,
+            DocumentSearch.docid,
+            DocumentSearch.authors,
+            DocumentSearch.emails,
         )
-        .where(subq.c.rn <= email_limit)
-        .order_by(desc(subq.c.doc_id))
+        .where(DocumentSearch.subscribers > 0)
+        .order_by(desc(DocumentSearch.doc_id))
+        .limit(limit)
     )
     # fmt: on
+    return stmt
+
+
+async def search_recent(Session, limit=RECENT_DOCUMENTS):
+    """Search database for the most recent documents.
+
+    Skips the books with no subscribers. Displays up to `limit`
+    documents.
+
+    """
+    async with Session() as session:
+        result = await session.execute(search_recent_stmt(limit))
+    return [row_to_result(row) for row in result.all()]
+
+
+async def stream_recent(Session, limit=RECENT_DOCUMENTS):
+    """Stream the most recent documents as JSON results
+
+    See :func:`search_recent`."""
     async with Session() as session:
-        result = await session.execute(stmt)
-    d = defaultdict(list)
-    for doc, cguser in result.all():
-        d[doc].append(cguser)
-    return [doc_to_result(doc, d[doc]) for doc in d.keys()]
+        result = await session.stream(search_recent_stmt(limit))
+        async for row in result:
+            yield row_to_json(row)
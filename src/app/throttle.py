@@ -0,0 +1,125 @@
+# communalgrowth-website, the communalgrowth.org website.
+# Copyright (C) 2024  Communal Growth, LLC
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""throttle.py
+
+Client-side protections for the online databases queried by maildird.
+
+:class:`TokenBucket` limits the rate of requests to a provider and
+:class:`CircuitBreaker` stops sending requests to an unhealthy one.
+
+"""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """A thread-safe token bucket allowing rate calls per second.
+
+    Up to burst calls can be made at once after a quiet period.
+
+    """
+
+    def __init__(self, rate, burst, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.updated = clock()
+
+    def acquire(self, timeout=None):
+        """Take a token, waiting up to timeout seconds for one.
+
+        Returns whether a token was taken."""
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            wait = max(0, (1 - self.tokens) / self.rate)
+            if timeout is not None and wait > timeout:
+                return False
+            # Reserve the token now, so that the waiting calls are
+            # served in order.
+            self.tokens -= 1
+        if wait:
+            self.sleep(wait)
+        return True
+
+
+class CircuitBreaker:
+    """A thread-safe circuit breaker.
+
+    The circuit opens after threshold consecutive failures, and calls
+    are then refused for reset_timeout seconds. After that, a single
+    trial call is allowed: the circuit closes if it succeeds and opens
+    again if it fails.
+
+    """
+
+    def __init__(self, threshold, reset_timeout, clock=time.monotonic):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+
+    @property
+    def state(self):
+        """One of "closed", "open" or "half-open"."""
+        if self.opened is None:
+            return "closed"
+        if self.trial or self.clock() - self.opened < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow(self):
+        """Whether a call may be made now."""
+        with self.lock:
+            match self.state:
+                case "closed":
+                    return True
+                case "half-open":
+                    self.trial = True
+                    return True
+                case _:
+                    return False
+
+    def cancel(self):
+        """Give back a call allowed but not made."""
+        with self.lock:
+            self.trial = False
+
+    def success(self):
+        """Record the success of a call."""
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        """Record the failure of a call."""
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.threshold:
+                self.opened = self.clock()
@@ -18,19 +18,26 @@
 
 
 import click
+import collections
 import email
 import email.policy
 from email.parser import BytesParser
 import imaplib
+import itertools
 import logging
+import multiprocessing
 import pathlib
 import psycopg
+import re
+import select
 import sqlalchemy
 import sqlalchemy.orm
+from sqlalchemy.dialects.postgresql import ARRAY, aggregate_order_by, insert
 import ssl
+import threading
 import time
+import uuid
 from app.cgdb import (
-    Author,
     Base,
     CGUser,
     Document,
@@ -38,12 +45,65 @@ from app.cgdb import (
     Isbn13,
     Doi,
     Arxiv,
+    LookupCache,
     cguser_document_association,
+    identifier_tables,
+    upsert_authors,
+)
+from app.conf import (
+    DB_URL,
+    FQDN,
+    CG_IMAP_PWD_FILE,
+    CG_TLS_DIR,
+    IMAP_BATCH_SIZE,
+    IMAP_PART_MAX_BYTES,
+    IMAP_IDLE_TIMEOUT,
+    IMAP_POLL_MIN_DELAY,
+    IMAP_POLL_MAX_DELAY,
+    MAIL_RETRY_DELAY,
+    MAIL_RETRY_MAX_DELAY,
+    MAIL_MAX_ATTEMPTS,
+    MAIL_FAILED_FLAG,
+    MAIL_ATTEMPT_FLAG,
+    WORKER_RESTART_DELAY,
+    QUEUE_BATCH,
+    QUEUE_POLL_INTERVAL,
+    BULK_IMPORT_BATCH,
 )
-from app.conf import DB_URL, FQDN, CG_IMAP_PWD_FILE, CG_TLS_DIR
 from app.parsemail import mail_to_docid, parse_address
-from app.idparser import IDType
-from app.docid import lookup_doc
+from app.idparser import (
+    IDType,
+    idparse,
+    isbn_twin,
+    normalize_docid,
+    isbn10_to_13,
+    isbn13_to_10,
+    valid_isbn,
+)
+from app.docid import lookup_docs
+from app.search import document_search_upsert
+from app.bulkimport import (
+    batches,
+    read_lines,
+    import_openlibrary_authors,
+    import_openlibrary_editions,
+    import_crossref,
+)
+from app.lookupcache import (
+    cached_lookups,
+    count_hits,
+    store_lookups,
+    invalidate_lookups,
+    lookup_cache_stats,
+)
+from app.mailqueue import (
+    enqueue_jobs,
+    fail_jobs,
+    claim_jobs,
+    lock_jobs,
+    finish_jobs,
+    mail_queue_stats,
+)
 
 logging.basicConfig(format="maildirdaemon: %(message)s")
 logger = logging.getLogger(__name__)
@@ -71,10 +131,16 @@ def make_doc(session, doctype, docdata):
     match doctype:
         case x if x in [IDType.ISBN10, IDType.ISBN13]:
             doc = Document(title=docdata["title"], authors=[])
-            if docdata["isbn10"]:
-                doc.isbn10 = Isbn10(isbn10=docdata["isbn10"])
-            if docdata["isbn13"]:
-                doc.isbn13 = Isbn13(isbn13=docdata["isbn13"])
+            isbn10, isbn13 = docdata["isbn10"], docdata["isbn13"]
+            # Fill in the ISBN missing from the lookup by conversion.
+            if isbn10 and not isbn13 and valid_isbn(isbn10):
+                isbn13 = isbn10_to_13(isbn10)
+            elif isbn13 and not isbn10 and valid_isbn(isbn13):
+                isbn10 = isbn13_to_10(isbn13)
+            if isbn10:
+                doc.isbn10 = Isbn10(isbn10=isbn10)
+            if isbn13:
+                doc.isbn13 = Isbn13(isbn13=isbn13)
         case IDType.DOI:
             doi = Doi(doi=docdata["doi"])
             doc = Document(title=docdata["title"], doi=doi, authors=[])
@@ -83,47 +149,55 @@ def make_doc(session, doctype, docdata):
             doc = Document(title=docdata["title"], arxiv=arxiv, authors=[])
         case _:
             return None
-    for a in docdata["authors"]:
-        result = session.query(Author).where(Author.author == a).one_or_none()
-        # The author does not exist in the database, create an entry.
-        if not result:
-            result = Author(author=a)
-        doc.authors.append(result)
+    doc.authors.extend(upsert_authors(session, docdata["authors"]))
     return doc
 
 
-def db_select_doc(session, doctype, docid):
-    """Query the database for the particular (doctype, docid) combination
+def db_resolve_docs(session, docids):
+    """Query the database for the documents of docids with one query
 
-    Returns None if not found, otherwise returns a Document instance.
+    docids is a list of (doctype, docid) pairs. An ISBN is also found
+    under its other form, ISBN-10 or ISBN-13. Returns a dictionary
+    mapping the pairs found to the IDs of their documents.
     """
-    result = None
-    match doctype:
-        case IDType.ISBN10:
-            result = (
-                session.query(Document)
-                .where(Document.isbn10.has(Isbn10.isbn10 == docid))
-                .one_or_none()
-            )
-        case IDType.ISBN13:
-            result = (
-                session.query(Document)
-                .where(Document.isbn13.has(Isbn13.isbn13 == docid))
-                .one_or_none()
-            )
-        case IDType.DOI:
-            result = (
-                session.query(Document)
-                .where(Document.doi.has(Doi.doi == docid))
-                .one_or_none()
-            )
-        case IDType.ARXIV:
-            result = (
-                session.query(Document)
-                .where(Document.arxiv.has(Arxiv.arxiv == docid))
-                .one_or_none()
+    twins = {d: isbn_twin(*d) for d in docids}
+    by_type = collections.defaultdict(list)
+    for doctype, docid in list(docids) + [t for t in twins.values() if t]:
+        if doctype in identifier_tables:
+            by_type[doctype].append(docid)
+    if not by_type:
+        return {}
+    selects = []
+    for doctype, ids in by_type.items():
+        table, key = identifier_tables[doctype]
+        column = getattr(table, key)
+        selects.append(
+            sqlalchemy.select(
+                sqlalchemy.literal(doctype.name).label("idtype"),
+                column.label("docid"),
+                table.id,
+            ).where(
+                column
+                == sqlalchemy.any_(sqlalchemy.literal(ids, ARRAY(sqlalchemy.String)))
             )
-    return result
+        )
+    rows = session.execute(sqlalchemy.union_all(*selects))
+    found = {(IDType[idtype], docid): doc_id for idtype, docid, doc_id in rows}
+    resolved = {}
+    for d in docids:
+        doc_id = found.get(d, found.get(twins[d]))
+        if doc_id is not None:
+            resolved[d] = doc_id
+    return resolved
+
+
+def doc_identifiers(docdata):
+    """The (doctype, docid) pairs of the identifiers in docdata"""
+    return [
+        (doctype, docdata[key])
+        for doctype, (_, key) in identifier_tables.items()
+        if docdata.get(key)
+    ]
 
 
 def db_select_user(session, addr):
@@ -135,61 +209,158 @@ def db_select_user(session, addr):
     return result
 
 
+def db_update_search(session, doc_ids):
+    """Bring the document_search rows of doc_ids up to date
+
+    Must be called in the same transaction as the changes to the
+    documents doc_ids or to their subscriptions.
+    """
+    if not doc_ids:
+        return
+    session.flush()
+    session.execute(document_search_upsert(doc_ids))
+
+
+def lookup_missing(Session, docids):
+    """Look up the docids missing from the database
+
+    The lookup cache is queried first and the remaining docids are then
+    looked up on the internet all at once, without holding a
+    transaction open while waiting on the online databases.
+
+    Returns a pair of dictionaries mapping (doctype, docid) pairs to
+    their details: the lookups found in the cache and those made
+    online, as returned by docid.lookup_docs().
+    """
+    with Session() as session:
+        found = db_resolve_docs(session, docids)
+        missing = [d for d in docids if d not in found]
+        cached = cached_lookups(session, missing)
+    fetched = lookup_docs([d for d in missing if d not in cached])
+    return cached, fetched
+
+
+def db_store_lookups(session, cached, fetched):
+    """Record the lookups of lookup_missing() in the lookup cache"""
+    count_hits(session, list(cached))
+    # The lookups that could not be made are not cached.
+    store_lookups(session, {d: x for d, x in fetched.items() if x is not None})
+
+
+def db_subscribe_docs(session, email, docids, looked_up):
+    """Subscribe the user email to docids
+
+    Documents missing from the database are created from their details
+    in looked_up. Returns the docids that could not be looked up and
+    must be retried.
+    """
+    user = db_select_user(session, email)
+    if not user:
+        user = CGUser(email=email)
+        session.add(user)
+    resolved = db_resolve_docs(session, docids)
+    # The looked up documents may already be in the database under
+    # another of their identifiers.
+    known = db_resolve_docs(
+        session,
+        [
+            pair
+            for d in docids
+            if d not in resolved and looked_up.get(d)
+            for pair in doc_identifiers(looked_up[d])
+        ],
+    )
+    # The IDs of the documents whose subscriptions change, and the
+    # documents created here by their identifiers.
+    doc_ids = set()
+    created = {}
+    deferred = []
+    for doctype, docid in docids:
+        d = (doctype, docid)
+        if d in resolved:
+            doc_ids.add(resolved[d])
+            continue
+        if d in created:
+            continue
+        docdata = looked_up.get(d)
+        if docdata is None:
+            # The provider was unavailable; retry the lookup.
+            deferred.append(d)
+            continue
+        if not docdata:
+            # Internet lookup failure; just ignore this. The
+            # failure is remembered by the lookup cache.
+            continue
+        known_ids = [known[p] for p in doc_identifiers(docdata) if p in known]
+        if known_ids:
+            doc_ids.add(known_ids[0])
+            continue
+        # If the document simply did not exist, then create a document
+        # and add it.
+        doc = make_doc(session, doctype, docdata)
+        if not doc:
+            continue
+        session.add(doc)
+        for pair in [d, isbn_twin(*d)] + doc_identifiers(docdata):
+            if pair:
+                created[pair] = doc
+    # Assign IDs to the new documents.
+    session.flush()
+    doc_ids.update(doc.id for doc in created.values())
+    if doc_ids:
+        session.execute(
+            insert(cguser_document_association)
+            .values([dict(doc_id=doc_id, email=email) for doc_id in doc_ids])
+            .on_conflict_do_nothing()
+        )
+    db_update_search(session, list(doc_ids))
+    return deferred
+
+
+def db_unsubscribe_docs(session, email, docids):
+    """Unsubscribe the user email from docids
+
+    If the user ends up with no subscriptions, the user is removed
+    from the database.
+    """
+    user = db_select_user(session, email)
+    if not user:
+        return
+    doc_ids = list(set(db_resolve_docs(session, docids).values()))
+    session.query(cguser_document_association).filter(
+        cguser_document_association.c.email == email,
+        cguser_document_association.c.doc_id.in_(doc_ids),
+    ).delete(synchronize_session="fetch")
+    # Delete the user if their subscriptions are empty.
+    if not user.documents:
+        session.delete(user)
+    db_update_search(session, doc_ids)
+
+
+def db_forget_user(session, email):
+    """Delete the user email and their subscriptions"""
+    user = db_select_user(session, email)
+    if not user:
+        return
+    doc_ids = [doc.id for doc in user.documents]
+    session.delete(user)
+    db_update_search(session, doc_ids)
+
+
 def db_subscribe(Session, mail):
     """Subscribe user to document IDs.
 
     mail denotes an EmailMessage sent by the user to the subscribe
     address. It contains in its body a list of document IDs, such as
-    ISBN, doi, arXiv IDs. These IDs will be looked up online if they
-    are not found in the database, and the user will be subscribed to
-    these IDs.
+    ISBN, doi, arXiv IDs. The subscriptions are queued, and the queue
+    workers look up these IDs online if they are not found in the
+    database and subscribe the user to them, see db_process_jobs().
 
     """
     # Parse the sender address and textual body of the e-mail.
     sender_addr, docids = mail_to_docid(mail)
-    # For each requested ID, check if it already exists in the
-    # database; if not, look it up on the internet first. Then proceed
-    # to subscribing the user to the document.
     with Session() as session:
-        user = db_select_user(session, sender_addr)
-        if not user:
-            user = CGUser(email=sender_addr)
-            session.add(user)
-        for doctype, docid in docids:
-            doc = db_select_doc(session, doctype, docid)
-            if not doc:
-                # We need to lookup the document online because docid
-                # does not have an entry in the database.
-                docdata = lookup_doc(doctype, docid)
-                if not docdata:
-                    # Internet lookup failure; just ignore this.
-                    # TODO: here I should be inserting the failure in
-                    # a table in the database along with a timestamp
-                    # to avoid performing the same mistake too often.
-                    continue
-                if doctype == IDType.ISBN10:
-                    # The subscriber requested an ISBN10 document;
-                    # first check that there is no corresponding
-                    # ISBN13 already in the database.
-                    doc = db_select_doc(session, IDType.ISBN13, docdata["isbn13"])
-                    if doc:
-                        doc.isbn10 = Isbn10(isbn10=docdata["isbn10"])
-                elif doctype == IDType.ISBN13:
-                    # The subscriber requested an ISBN13 document;
-                    # first check that there is no corresponding
-                    # ISBN10 already in the database.
-                    doc = db_select_doc(session, IDType.ISBN10, docdata["isbn10"])
-                    if doc:
-                        doc.isbn13 = Isbn13(isbn13=docdata["isbn13"])
-                # If the document simply did not exist, then create a
-                # document and add it.
-                if not doc:
-                    doc = make_doc(session, doctype, docdata)
-                    if not doc:
-                        continue
-                    session.add(doc)
-            if not any(sender_addr == user.email for user in doc.cgusers):
-                doc.cgusers.append(user)
+        enqueue_jobs(session, sender_addr, "subscribe", docids)
         session.commit()
 
 
@@ -198,46 +369,124 @@ def db_unsubscribe(Session, mail):
 
     mail is an EmailMessage sent by the user to the subscribe
     address. It contains in its body a list of document IDs, such as
-    ISBN, doi, arXiv IDs. The user will be unsubscribed from these
-    IDs. If the user ends up with no subscriptions, the user is
-    removed from the database.
+    ISBN, doi, arXiv IDs. The unsubscriptions are queued, and the
+    queue workers unsubscribe the user from these IDs, see
+    db_unsubscribe_docs().
     """
     sender_addr, docids = mail_to_docid(mail)
     with Session() as session:
-        user = db_select_user(session, sender_addr)
-        if not user:
-            return
-        # TODO instead of this loop the deletion can be issued
-        # directly to the database...  delete ... where user == myuser
-        # and docid == mydocid ...
-        docids = [
-            doc.id for doc in map(lambda d: db_select_doc(session, *d), docids) if doc
-        ]
-        session.query(cguser_document_association).filter(
-            cguser_document_association.c.email == sender_addr,
-            cguser_document_association.c.doc_id.in_(docids),
-        ).delete(synchronize_session="fetch")
-        # Delete the user if their subscriptions are empty.
-        if not user.documents:
-            session.delete(user)
+        enqueue_jobs(session, sender_addr, "unsubscribe", docids)
         session.commit()
 
 
 def db_forget(Session, mail):
     """Delete all mentions of user from database
 
-    mail is an EmailMessage and the sender address and all mentions of
-    that address are removed from the database.
+    mail is an EmailMessage, and the removal of the sender address and
+    of all mentions of that address from the database is queued. The
+    jobs of the sender queued before are dropped.
     """
     sender_addr = parse_address(mail)
     with Session() as session:
-        user = db_select_user(session, sender_addr)
-        if not user:
-            return
-        session.delete(user)
+        enqueue_jobs(session, sender_addr, "forget")
         session.commit()
 
 
+def db_apply_jobs(session, email, action, jobs, looked_up):
+    """Do the jobs of the user email, which all have action
+
+    Returns the jobs done; the subscriptions whose lookup could not be
+    made are left to be attempted again.
+    """
+    docids = [(job.idtype, job.docid) for job in jobs]
+    match action:
+        case "subscribe":
+            deferred = set(db_subscribe_docs(session, email, docids, looked_up))
+            return [job for job in jobs if (job.idtype, job.docid) not in deferred]
+        case "unsubscribe":
+            db_unsubscribe_docs(session, email, docids)
+        case "forget":
+            db_forget_user(session, email)
+    return jobs
+
+
+def db_process_jobs(Session, limit=QUEUE_BATCH):
+    """Process up to limit due jobs of the mail_job queue
+
+    The jobs are claimed first, see claim_jobs(), and the IDs to
+    subscribe to are looked up once for all the users requesting them,
+    without holding a transaction open. The jobs are then done in one
+    transaction, in the order they were queued, each user in its own
+    savepoint so that a failing user does not hold back the others.
+    The jobs not done stay queued to be attempted again, up to
+    QUEUE_MAX_ATTEMPTS times. Returns the number of jobs claimed.
+    """
+    with Session() as session:
+        failed = fail_jobs(session)
+        jobs = sorted(claim_jobs(session, limit), key=lambda job: job.id)
+        session.commit()
+    if failed:
+        logger.error(f"mail queue: {failed} jobs failed too many times")
+    if not jobs:
+        return 0
+    docids = list(
+        dict.fromkeys(
+            (job.idtype, job.docid) for job in jobs if job.action == "subscribe"
+        )
+    )
+    cached, fetched = lookup_missing(Session, docids) if docids else ({}, {})
+    # The lookups are cached in their own transaction, so that the
+    # jobs are not held back by the workers caching the same IDs.
+    try:
+        with Session() as session:
+            db_store_lookups(session, cached, fetched)
+            session.commit()
+    except sqlalchemy.exc.SQLAlchemyError as e:
+        logger.error(f"mail queue: lookup cache: {e}")
+    with Session() as session:
+        live = lock_jobs(session, jobs)
+        queued = sorted(
+            (job for job in jobs if job.id in live), key=lambda job: (job.email, job.id)
+        )
+        done = []
+        for (email, action), group in itertools.groupby(
+            queued, key=lambda job: (job.email, job.action)
+        ):
+            try:
+                with session.begin_nested():
+                    group = db_apply_jobs(
+                        session, email, action, list(group), cached | fetched
+                    )
+            except Exception as e:
+                logger.error(f"{email}: {action}: {e}")
+                continue
+            done.extend(job.id for job in group)
+        finish_jobs(session, done)
+        session.commit()
+    return len(jobs)
+
+
+def process_jobs(Session, stop=None):
+    """Process the jobs of the mail_job queue as they come due
+
+    Polls the queue every QUEUE_POLL_INTERVAL seconds while no job is
+    due. Runs until the threading.Event stop is set.
+    """
+    while not (stop and stop.is_set()):
+        try:
+            n = db_process_jobs(Session)
+        except Exception as e:
+            logger.error(f"mail queue: {e}")
+            n = 0
+        if n == QUEUE_BATCH:
+            # There is a backlog, keep draining it.
+            continue
+        if stop:
+            stop.wait(QUEUE_POLL_INTERVAL)
+        else:
+            time.sleep(QUEUE_POLL_INTERVAL)
+
+
 class ProcessMaildir:
     def __init__(self, Session):
         super().__init__()
@@ -300,13 +549,14 @@ class ProcessMaildir:
         return procedure(self.Session, mail)
 
 
-def maildirdaemon(imap_pwd: bytes):
-    """The entry point to the Maildir processing daemon."""
+def create_session(connections=4):
+    """Create the session factory of the database."""
     # Create the SQLAlchemy engine; the password is specified in
     # the .pgpass file.
     engine = sqlalchemy.create_engine(
         DB_URL,
-        pool_size=1,
+        # One connection per watched mailbox and per queue worker.
+        pool_size=connections,
         max_overflow=1,
         pool_pre_ping=True,
         connect_args={"sslmode": "require"},
@@ -315,50 +565,796 @@ def maildirdaemon(imap_pwd: bytes):
     # tables.
     Base.metadata.create_all(engine)
     # Create a session factory.
-    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+    return sqlalchemy.orm.sessionmaker(bind=engine)
+
+
+def uid_set(uids):
+    """Format a list of UIDs as a compact IMAP sequence set, e.g. 1:3,5"""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(f"{a}:{b}" if a != b else f"{a}" for a, b in ranges)
+
+
+# The tokens of an IMAP response: parentheses, quoted strings, literal
+# markers, and atoms with their [section] and <origin>.
+IMAP_TOKEN = re.compile(
+    rb'(\()|(\))|"((?:[^"\\]|\\.)*)"|\{(\d+)\}|([^\s()"{\[]+(?:\[[^\]]*\](?:<\d+>)?)?)'
+)
+
+
+def parse_imap(response):
+    """Parse an IMAP response into nested lists
+
+    response is a list of (text, literal) pairs, the literal being
+    None after the last text. Atoms, strings and literals are bytes,
+    NIL is None and parenthesized lists are lists.
+    """
+    stack = [[]]
+    for text, literal in response:
+        for m in IMAP_TOKEN.finditer(text):
+            opening, closing, quoted, size, atom = m.groups()
+            if opening:
+                stack.append([])
+            elif closing:
+                value = stack.pop()
+                stack[-1].append(value)
+            elif quoted is not None:
+                stack[-1].append(re.sub(rb"\\(.)", rb"\1", quoted))
+            elif size is not None:
+                stack[-1].append(literal)
+            else:
+                stack[-1].append(None if atom.upper() == b"NIL" else atom)
+    return stack[0]
+
+
+def fetch_items(data):
+    """The data items of each message in the data imaplib returns for FETCH
+
+    Returns a list of dictionaries from the upper-case item names,
+    such as b"UID" or b"BODY[1]<0>", to their values.
+    """
+    responses, response = [], []
+    for item in data:
+        if isinstance(item, tuple):
+            response.append(item)
+        elif item is not None:
+            response.append((item, None))
+            responses.append(response)
+            response = []
+    messages = []
+    for response in responses:
+        values = parse_imap(response)
+        items = next((x for x in values if isinstance(x, list)), [])
+        messages.append(
+            {key.upper(): value for key, value in zip(items[::2], items[1::2])}
+        )
+    return messages
+
+
+def stored_attempts(flags):
+    """The number of failed attempts recorded in the flags of a message
+
+    See Mailbox.retry_later().
+    """
+    prefix = MAIL_ATTEMPT_FLAG.encode()
+    return max(
+        (
+            int(flag[len(prefix) :])
+            for flag in flags
+            if flag.startswith(prefix) and flag[len(prefix) :].isdigit()
+        ),
+        default=0,
+    )
+
+
+def text_sections(structure, section=()):
+    """The text parts of a message from its BODYSTRUCTURE
+
+    Returns a list of (section, subtype, charset, encoding, size)
+    tuples of the text/plain and text/html parts that are not
+    attachments, not looking into attached messages.
+    """
+    if isinstance(structure[0], list):
+        # The parts come before the subtype and the extension data.
+        parts = itertools.takewhile(lambda x: isinstance(x, list), structure)
+        return [
+            text
+            for i, part in enumerate(parts, start=1)
+            for text in text_sections(part, section + (i,))
+        ]
+    kind, subtype, params, _, _, encoding, size, *extension = structure
+    subtype = (subtype or b"").lower().decode()
+    if (kind or b"").lower() != b"text" or subtype not in ("plain", "html"):
+        return []
+    # The extension data of a text part starts with its lines and MD5.
+    disposition = extension[2] if len(extension) > 2 else None
+    if (
+        isinstance(disposition, list)
+        and (disposition[0] or b"").lower() == b"attachment"
+    ):
+        return []
+    params = params or []
+    params = {k.lower(): v for k, v in zip(params[::2], params[1::2])}
+    charset = (params.get(b"charset") or b"utf-8").decode("ascii", "replace")
+    encoding = (encoding or b"7bit").decode("ascii", "replace")
+    number = ".".join(str(i) for i in section) or "1"
+    return [(number, subtype, charset, encoding, int(size))]
+
+
+def wanted_sections(structure):
+    """The text parts of a message that parse_mail() reads
+
+    These are the plain text parts, or the HTML parts if there is no
+    plain text.
+    """
+    sections = text_sections(structure)
+    plain = [s for s in sections if s[1] == "plain"]
+    if any(size for *_, size in plain):
+        return plain
+    return [s for s in sections if s[1] == "html"]
+
+
+def text_message(header, sections, bodies):
+    """Build a raw message from its From header and its text parts
+
+    sections are the text parts as returned by text_sections(), and
+    bodies maps their section numbers to their, maybe truncated,
+    contents.
+    """
+    boundary = f"cg-{uuid.uuid4().hex}".encode()
+    lines = [
+        header.rstrip(b"\r\n"),
+        b"MIME-Version: 1.0",
+        b'Content-Type: multipart/mixed; boundary="' + boundary + b'"',
+        b"",
+    ]
+    for number, subtype, charset, encoding, _ in sections:
+        charset = charset.replace("\\", "").replace('"', "")
+        lines += [
+            b"--" + boundary,
+            f'Content-Type: text/{subtype}; charset="{charset}"'.encode(),
+            f"Content-Transfer-Encoding: {encoding}".encode(),
+            b"",
+            bodies.get(number) or b"",
+        ]
+    lines += [b"--" + boundary + b"--", b""]
+    return b"\r\n".join(lines)
+
+
+class Mailbox:
+    """A long-lived, authenticated IMAP connection to the mailbox of user
+
+    connect is a callable returning a new imaplib.IMAP4 instance; the
+    connection is opened on first use and reopened after an error. The
+    messages that failed processing are kept in failures, mapping their
+    UID to the number of attempts and the time of the next attempt; the
+    attempts are also recorded on the messages, and read back by fetch()
+    after a restart.
+    """
+
+    def __init__(self, connect, user, imap_pwd: bytes, clock=time.monotonic):
+        self.connect = connect
+        self.user = user
+        self.imap_pwd = imap_pwd
+        self.imap = None
+        self.clock = clock
+        self.failures = {}
+
+    def open(self):
+        """Return the IMAP connection, logging in and selecting INBOX if needed."""
+        if self.imap is None:
+            imap = self.connect()
+            imap.login(
+                f"{self.user}@communalgrowth.org*vmail",
+                str(self.imap_pwd, encoding="utf-8"),
+            )
+            imap.select()
+            self.imap = imap
+        return self.imap
+
+    def close(self):
+        """Drop the IMAP connection."""
+        if self.imap is None:
+            return
+        try:
+            self.imap.logout()
+        except:
+            pass
+        self.imap = None
+
+    def search(self):
+        """Return the sorted UIDs of the messages left to process
+
+        These are the messages neither deleted nor flagged with
+        MAIL_FAILED_FLAG, and not waiting to be retried.
+        """
+        status, data = self.open().uid(
+            "SEARCH", "UNDELETED", "UNKEYWORD", MAIL_FAILED_FLAG
+        )
+        uids = sorted(int(uid) for uid in data[0].split())
+        self.failures = {
+            uid: self.failures[uid] for uid in uids if uid in self.failures
+        }
+        now = self.clock()
+        return [uid for uid in uids if self.failures.get(uid, (0, now))[1] <= now]
+
+    def fetch(self, uids):
+        """Fetch the sender and the text of the messages uids
+
+        The structure and the From header of the messages are fetched
+        with a single FETCH command, and then the text parts that
+        parse_mail() reads, up to IMAP_PART_MAX_BYTES each, with one
+        FETCH command per layout of parts. A message whose structure
+        cannot be read is fetched whole. The unsolicited FETCH
+        responses, which report the flags of other messages, are
+        skipped. The failed attempts recorded on the messages that are
+        not in failures, as after a restart, are added to it.
+
+        Returns a list of (uid, raw message) pairs.
+        """
+        imap = self.open()
+        status, data = imap.uid(
+            "FETCH",
+            uid_set(uids),
+            "(UID FLAGS BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM)])",
+        )
+        headers, sections, whole = {}, {}, []
+        layouts = collections.defaultdict(list)
+        for items in fetch_items(data):
+            if b"UID" not in items or b"BODYSTRUCTURE" not in items:
+                continue
+            uid = int(items[b"UID"])
+            attempts = stored_attempts(items.get(b"FLAGS") or [])
+            if attempts and uid not in self.failures:
+                self.failures[uid] = (attempts, self.clock())
+            try:
+                sections[uid] = wanted_sections(items[b"BODYSTRUCTURE"])
+            except (KeyError, IndexError, TypeError, ValueError):
+                whole.append(uid)
+                continue
+            headers[uid] = (
+                next((v for k, v in items.items() if k.startswith(b"BODY[HEADER")), b"")
+                or b""
+            )
+            layouts[tuple(number for number, *_ in sections[uid])].append(uid)
+        bodies = collections.defaultdict(dict)
+        for layout, layout_uids in layouts.items():
+            if not layout:
+                continue
+            parts = " ".join(
+                f"BODY.PEEK[{number}]<0.{IMAP_PART_MAX_BYTES}>" for number in layout
+            )
+            status, data = imap.uid("FETCH", uid_set(layout_uids), f"(UID {parts})")
+            for items in fetch_items(data):
+                if b"UID" not in items:
+                    continue
+                for key, value in items.items():
+                    if m := re.fullmatch(rb"BODY\[([\d.]+)\](?:<\d+>)?", key):
+                        bodies[int(items[b"UID"])][m[1].decode()] = value
+        messages = [
+            (uid, text_message(headers[uid], sections[uid], bodies[uid]))
+            for uid in headers
+        ]
+        if whole:
+            messages += self.fetch_whole(whole)
+        return sorted(messages)
+
+    def fetch_whole(self, uids):
+        """Fetch the messages uids whole with a single FETCH command
+
+        Returns a list of (uid, raw message) pairs.
+        """
+        status, data = self.open().uid("FETCH", uid_set(uids), "(UID RFC822)")
+        return [
+            (int(items[b"UID"]), items[b"RFC822"])
+            for items in fetch_items(data)
+            if b"UID" in items and b"RFC822" in items
+        ]
+
+    def delete(self, uids):
+        """Delete the messages uids with a single STORE and EXPUNGE."""
+        imap = self.open()
+        imap.uid("STORE", uid_set(uids), "+FLAGS.SILENT", "(\\Deleted)")
+        imap.expunge()
+
+    def retry_later(self, uids):
+        """Postpone the messages uids that failed processing
+
+        Each attempt is recorded on the message with a keyword, see
+        MAIL_ATTEMPT_FLAG. The messages that failed MAIL_MAX_ATTEMPTS
+        times are flagged with MAIL_FAILED_FLAG instead, so that they
+        are no longer processed.
+        """
+        flags = collections.defaultdict(list)
+        for uid in uids:
+            attempts, _ = self.failures.get(uid, (0, None))
+            attempts += 1
+            if attempts >= MAIL_MAX_ATTEMPTS:
+                flags[MAIL_FAILED_FLAG].append(uid)
+                self.failures.pop(uid, None)
+                continue
+            delay = min(MAIL_RETRY_DELAY * 2 ** (attempts - 1), MAIL_RETRY_MAX_DELAY)
+            self.failures[uid] = (attempts, self.clock() + delay)
+            flags[f"{MAIL_ATTEMPT_FLAG}{attempts}"].append(uid)
+        for flag, flagged in flags.items():
+            self.open().uid("STORE", uid_set(flagged), "+FLAGS.SILENT", f"({flag})")
+
+    def next_retry(self):
+        """The seconds until the next failed message is due, or None"""
+        if not self.failures:
+            return None
+        due = min(due for _, due in self.failures.values())
+        return max(0, due - self.clock())
+
+    def supports_idle(self):
+        """Whether the server supports the IDLE command."""
+        return "IDLE" in self.open().capabilities
+
+    def idle(self, timeout):
+        """Wait with the IDLE command for up to timeout seconds
+
+        Returns whether the server announced new messages.
+        """
+        imap = self.open()
+        tag = b"CGIDLE"
+        imap.send(tag + b" IDLE\r\n")
+        line = imap.readline()
+        if not line.startswith(b"+"):
+            raise imaplib.IMAP4.error(f"IDLE refused: {line!r}")
+        new_mail = False
+        deadline = time.monotonic() + timeout
+        while not new_mail:
+            line = readline_within(imap, deadline - time.monotonic())
+            if line is None:
+                break
+            new_mail = re.match(rb"\* \d+ (EXISTS|RECENT)", line) is not None
+        imap.send(b"DONE\r\n")
+        while not (line := imap.readline()).startswith(tag):
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed during IDLE")
+            new_mail = new_mail or re.match(rb"\* \d+ EXISTS", line) is not None
+        return new_mail
+
+
+def readline_within(imap, timeout):
+    """Read a line from the IMAP server, waiting up to timeout seconds
+
+    Returns None if no data arrived in time.
+    """
+    sock = imap.sock
+    deadline = time.monotonic() + timeout
+    while True:
+        # Look for data already buffered by imaplib or by TLS without
+        # blocking; a timeout on the socket would break imaplib.
+        blocking = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            buffered = imap.file.peek(1)
+        except (BlockingIOError, ssl.SSLWantReadError):
+            buffered = b""
+        finally:
+            sock.settimeout(blocking)
+        if buffered:
+            return imap.readline()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        select.select([sock], [], [], remaining)
+
+
+def fetch_messages(mailbox, uids):
+    """Fetch the messages uids of mailbox, see Mailbox.fetch()
+
+    If the fetch fails other than with an IMAP or network error, the
+    messages are fetched one at a time to set apart the ones failing.
+    Returns the list of (uid, raw message) pairs and the list of the
+    UIDs that could not be fetched.
+    """
+    try:
+        return mailbox.fetch(uids), []
+    except (imaplib.IMAP4.error, OSError):
+        raise
+    except Exception as e:
+        logger.error(f"{mailbox.user}: messages {uid_set(uids)}: {e}")
+        # The connection may be left in the middle of a response.
+        mailbox.close()
+        if len(uids) == 1:
+            return [], uids
+    fetched, failed = [], []
+    for uid in uids:
+        messages, errors = fetch_messages(mailbox, [uid])
+        fetched += messages
+        failed += errors
+    return fetched, failed
+
+
+def process_mailbox(mailbox, action, Session, batch_size=IMAP_BATCH_SIZE, shard=(0, 1)):
+    """Process up to batch_size messages of mailbox with action
+
+    Only the sender and the text of the messages are fetched, see
+    Mailbox.fetch(). The messages processed are deleted with a single
+    expunge, and the ones that failed, or could not be fetched, are
+    kept to be retried, see Mailbox.retry_later(). A shard (k, n)
+    processes only the messages whose UID is k modulo n. Returns the
+    number of messages fetched.
+    """
+    k, n = shard
+    uids = [uid for uid in mailbox.search() if uid % n == k][:batch_size]
+    if not uids:
+        return 0
+    parser = BytesParser(policy=email.policy.EmailPolicy())
+    fetched, failed = fetch_messages(mailbox, uids)
+    done = []
+    for uid, raw in fetched:
+        try:
+            action(Session, parser.parsebytes(raw))
+        except Exception as e:
+            logger.error(f"{mailbox.user}: message {uid}: {e}")
+            failed.append(uid)
+        else:
+            done.append(uid)
+    # Delete the processed messages; a message processed again after a
+    # crash has no further effect, as every action is idempotent.
+    if done:
+        mailbox.delete(done)
+    mailbox.retry_later(failed)
+    return len(uids)
+
+
+def process_emails(mailboxes, Session, batch_size=IMAP_BATCH_SIZE):
+    """Process a batch of every mailbox
+
+    mailboxes is a list of (Mailbox, action) pairs. Returns whether
+    any mailbox had a full batch, i.e. whether there is a backlog.
+    """
+    backlog = False
+    for mailbox, action in mailboxes:
+        try:
+            n = process_mailbox(mailbox, action, Session, batch_size)
+        except Exception as e:
+            # Reconnect at the next batch, whatever the error.
+            logger.error(f"{mailbox.user}: {e}")
+            mailbox.close()
+            continue
+        backlog = backlog or n == batch_size
+    return backlog
+
+
+def watch_mailbox(
+    mailbox,
+    action,
+    Session,
+    batch_size=IMAP_BATCH_SIZE,
+    idle_timeout=IMAP_IDLE_TIMEOUT,
+    stop=None,
+    shard=(0, 1),
+    idle=True,
+):
+    """Process the messages of mailbox as soon as they arrive
+
+    Waits for new messages with IMAP IDLE if idle and the server
+    supports it, otherwise polls with a delay that doubles from IMAP_POLL_MIN_DELAY
+    to IMAP_POLL_MAX_DELAY while the mailbox stays empty, and wakes up
+    when a failed message is due to be retried. Only the
+    messages of shard are processed, see process_mailbox(). Runs until
+    the threading.Event stop is set.
+    """
+    delay = IMAP_POLL_MIN_DELAY
+    while not (stop and stop.is_set()):
+        try:
+            n = process_mailbox(mailbox, action, Session, batch_size, shard)
+            if n == batch_size:
+                # There is a backlog, keep draining it.
+                continue
+            retry = mailbox.next_retry()
+            if idle and mailbox.supports_idle():
+                # Wake up when the failed messages are due again.
+                mailbox.idle(
+                    idle_timeout if retry is None else min(idle_timeout, retry)
+                )
+                continue
+            delay = IMAP_POLL_MIN_DELAY if n else min(2 * delay, IMAP_POLL_MAX_DELAY)
+            if retry is not None:
+                delay = min(delay, retry)
+        except Exception as e:
+            # Reconnect after any error rather than ending the watch.
+            logger.error(f"{mailbox.user}: {e}")
+            mailbox.close()
+            delay = min(2 * delay, IMAP_POLL_MAX_DELAY)
+        if stop:
+            stop.wait(delay)
+        else:
+            time.sleep(delay)
+    mailbox.close()
+
+
+# The action processing the messages of each account.
+ACCOUNTS = dict(subscribe=db_subscribe, unsubscribe=db_unsubscribe, forget=db_forget)
+
+
+def imap_connector():
+    """Return a function opening a new connection to the IMAP server"""
     # Create a TLS context.
     ctx = create_tls_context(
         ca=f"{CG_TLS_DIR}/ca-cert.pem",
         cert=f"{CG_TLS_DIR}/cg-message-daemon-tls-cert.pem",
         key=f"{CG_TLS_DIR}/cg-message-daemon-tls-key.pem",
     )
-    while True:
-        process_emails(ctx, Session, imap_pwd)
-        time.sleep(10)
 
+    def connect():
+        return imaplib.IMAP4_SSL(host="localhost", port=37419, ssl_context=ctx)
 
-def process_emails(ctx, Session, imap_pwd: bytes, batch_size=10):
-    actions = [
-        ("subscribe", db_subscribe),
-        ("unsubscribe", db_unsubscribe),
-        ("forget", db_forget),
+    return connect
+
+
+def maildirdaemon(
+    imap_pwd: bytes, batch_size=IMAP_BATCH_SIZE, idle=True, workers=0, queue_workers=1
+):
+    """The entry point to the Maildir processing daemon.
+
+    The mailboxes are watched and their mails queued as jobs, which
+    queue_workers threads process. With workers, runs as a supervisor
+    of worker processes instead, see supervise().
+    """
+    if workers:
+        supervise(worker_specs(imap_pwd, batch_size, workers, queue_workers, idle))
+        return
+    Session = create_session(len(ACCOUNTS) + queue_workers)
+    connect = imap_connector()
+    mailboxes = [
+        (Mailbox(connect, user, imap_pwd), action) for user, action in ACCOUNTS.items()
     ]
-    for user, action in actions:
-        with imaplib.IMAP4_SSL(host="localhost", port=37419, ssl_context=ctx) as imap:
-            imap.login(
-                f"{user}@communalgrowth.org*vmail", str(imap_pwd, encoding="utf-8")
+    for k in range(queue_workers):
+        threading.Thread(
+            target=process_jobs, args=(Session,), name=f"queue/{k}", daemon=True
+        ).start()
+    if idle:
+        # Watch every mailbox in its own thread, so that a slow action
+        # in one account does not delay the others.
+        threads = [
+            threading.Thread(
+                target=watch_mailbox,
+                args=(mailbox, action, Session, batch_size),
+                name=mailbox.user,
             )
-            imap.select()
-            status, data = imap.uid("SEARCH", "ALL")
-            email_ids = sorted(data[0].split(), key=int)[:batch_size]
-            for num in email_ids:
-                try:
-                    status, data = imap.uid("FETCH", num, "(RFC822)")
-                    mail = BytesParser(policy=email.policy.EmailPolicy()).parsebytes(
-                        data[0][1]
-                    )
-                    action(Session, mail)
-                except:
-                    pass
-                # Delete the processed file.
-                imap.uid("STORE", num, "+FLAGS", "\\Deleted")
-                imap.expunge()
-            imap.close()
+            for mailbox, action in mailboxes
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return
+    while True:
+        # Keep draining the mailboxes while there is a backlog.
+        if not process_emails(mailboxes, Session, batch_size):
+            time.sleep(10)
 
 
-@click.command(context_settings=dict(help_option_names=["-h", "--help"]))
+def mailbox_worker(user, imap_pwd: bytes, batch_size, shard, idle=True):
+    """Watch the shard of the mailbox of user, in a worker process"""
+    mailbox = Mailbox(imap_connector(), user, imap_pwd)
+    watch_mailbox(
+        mailbox, ACCOUNTS[user], create_session(1), batch_size, shard=shard, idle=idle
+    )
+
+
+def queue_worker():
+    """Process the jobs of the mail_job queue, in a worker process"""
+    process_jobs(create_session(1))
+
+
+def queue_specs(queue_workers):
+    """The queue worker processes of the supervisor, see worker_specs()"""
+    return {f"queue/{k}": (queue_worker, ()) for k in range(queue_workers)}
+
+
+def worker_specs(imap_pwd: bytes, batch_size, workers, queue_workers=1, idle=True):
+    """The worker processes of the supervisor
+
+    Returns a dictionary from the name of each worker to its target
+    function and arguments.
+    """
+    specs = {
+        f"{user}/{k}": (
+            mailbox_worker,
+            (user, imap_pwd, batch_size, (k, workers), idle),
+        )
+        for user in ACCOUNTS
+        for k in range(workers)
+    }
+    return specs | queue_specs(queue_workers)
+
+
+def supervise(specs):
+    """Run maildird as a supervisor of worker processes
+
+    specs maps the name of each worker to its target function and
+    arguments, see worker_specs(). Typically every account is watched
+    by several processes, each processing the messages of its shard of
+    UIDs, and the queue by others. Each worker has its own IMAP and
+    database connections, and is restarted if it exits.
+    """
+    context = multiprocessing.get_context("spawn")
+    processes = {}
+    try:
+        while True:
+            for name, (target, args) in specs.items():
+                process = processes.get(name)
+                if process is not None and process.is_alive():
+                    continue
+                if process is not None:
+                    logger.error(f"{name}: exited with {process.exitcode}, restarting")
+                process = context.Process(
+                    target=target, args=args, name=name, daemon=True
+                )
+                process.start()
+                processes[name] = process
+            time.sleep(WORKER_RESTART_DELAY)
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.join()
+
+
+def db_backfill_search(Session, batch_size=10_000):
+    """Populate the document_search table from the document tables
+
+    Processes the documents in batches of batch_size, committing after
+    each batch.
+    """
+    last_id = 0
+    while True:
+        with Session() as session:
+            doc_ids = (
+                session.execute(
+                    sqlalchemy.select(Document.id)
+                    .where(Document.id > last_id)
+                    .order_by(Document.id)
+                    .limit(batch_size)
+                )
+                .scalars()
+                .all()
+            )
+            if not doc_ids:
+                return
+            db_update_search(session, doc_ids)
+            session.commit()
+        last_id = doc_ids[-1]
+        logger.info(f"document_search backfilled up to document {last_id}.")
+
+
+def db_merge_docs(session, keep, dups):
+    """Merge the documents dups into the document keep
+
+    The subscribers of dups are subscribed to keep, which also takes
+    the identifiers of dups of the types it lacks. The documents dups
+    are then removed.
+    """
+    assoc = cguser_document_association
+    session.execute(
+        insert(assoc)
+        .from_select(
+            ["doc_id", "email"],
+            sqlalchemy.select(sqlalchemy.literal(keep), assoc.c.email).where(
+                assoc.c.doc_id.in_(dups)
+            ),
+        )
+        .on_conflict_do_nothing()
+    )
+    for table, _ in identifier_tables.values():
+        other = sqlalchemy.orm.aliased(table)
+        for dup in dups:
+            session.execute(
+                sqlalchemy.update(table)
+                .where(
+                    table.id == dup,
+                    ~sqlalchemy.select(other.id).where(other.id == keep).exists(),
+                )
+                .values(id=keep)
+                .execution_options(synchronize_session=False)
+            )
+        session.execute(sqlalchemy.delete(table).where(table.id.in_(dups)))
+    session.execute(sqlalchemy.delete(Document).where(Document.id.in_(dups)))
+
+
+def db_backfill_dois(Session, batch_size=1_000):
+    """Lowercase the DOIs stored before they were normalized
+
+    The documents whose DOIs differ only by case are merged into the
+    one with the lowercase DOI, or else the oldest, see db_merge_docs().
+    The cached lookups of the DOIs not in lowercase are removed, as the
+    DOIs are now looked up in lowercase. Processes batch_size DOIs at
+    a time, committing after each batch. Returns the number of
+    documents merged into others.
+    """
+    lower = sqlalchemy.func.lower(Doi.doi)
+    with Session() as session:
+        session.execute(
+            sqlalchemy.delete(LookupCache).where(
+                LookupCache.idtype == IDType.DOI,
+                LookupCache.docid != sqlalchemy.func.lower(LookupCache.docid),
+            )
+        )
+        # The documents of each DOI, the one to keep first.
+        groups = session.scalars(
+            sqlalchemy.select(
+                sqlalchemy.func.array_agg(
+                    aggregate_order_by(Doi.id, (Doi.doi != lower), Doi.id)
+                )
+            )
+            .group_by(lower)
+            .having(
+                sqlalchemy.or_(
+                    sqlalchemy.func.count() > 1,
+                    sqlalchemy.func.bool_or(Doi.doi != lower),
+                )
+            )
+        ).all()
+        session.commit()
+    merged = 0
+    for batch in batches(groups, batch_size):
+        with Session() as session:
+            for keep, *dups in batch:
+                if dups:
+                    db_merge_docs(session, keep, dups)
+                    merged += len(dups)
+            keeps = [keep for keep, *_ in batch]
+            session.execute(
+                sqlalchemy.update(Doi)
+                .where(Doi.id.in_(keeps))
+                .values(doi=lower)
+                .execution_options(synchronize_session=False)
+            )
+            db_update_search(session, keeps)
+            session.commit()
+        logger.info(f"{len(batch)} DOIs lowercased.")
+    return merged
+
+
+@click.group(
+    invoke_without_command=True,
+    context_settings=dict(help_option_names=["-h", "--help"]),
+)
 @click.version_option(None, "-v", "--version", package_name="webserver")
-def main():
+@click.option(
+    "--batch-size",
+    default=IMAP_BATCH_SIZE,
+    show_default=True,
+    help="Number of messages fetched and expunged at once per mailbox.",
+)
+@click.option(
+    "--idle/--poll",
+    default=True,
+    show_default=True,
+    help="Wait for new messages with IMAP IDLE, or poll every 10 seconds.",
+)
+@click.option(
+    "--workers",
+    default=0,
+    show_default=True,
+    help="Run as a supervisor of this many worker processes per mailbox,"
+    " sharding its messages by UID; 0 runs a single process.",
+)
+@click.option(
+    "--queue-workers",
+    default=1,
+    show_default=True,
+    help="Number of workers processing the queued jobs, threads or, with"
+    " --workers, processes; 0 leaves the queue to process-queue.",
+)
+@click.pass_context
+def main(ctx, batch_size, idle, workers, queue_workers):
+    """Process the subscribe, unsubscribe and forget mailboxes.
+
+    Runs the daemon unless a command is given.
+    """
+    if ctx.invoked_subcommand is not None:
+        return
     try:
         with open(CG_IMAP_PWD_FILE, "rb") as f:
             imap_pwd = f.read()
@@ -368,7 +1364,128 @@ def main():
     except Exception as e:
         logger.error(f"{e}")
         exit(1)
-    maildirdaemon(imap_pwd)
+    maildirdaemon(imap_pwd, batch_size, idle, workers, queue_workers)
+
+
+@main.command("backfill-search")
+@click.option(
+    "--batch-size",
+    default=10_000,
+    show_default=True,
+    help="Number of documents per transaction.",
+)
+def backfill_search(batch_size):
+    """Populate the document_search table of the website."""
+    logger.setLevel(logging.INFO)
+    db_backfill_search(create_session(), batch_size)
+
+
+@main.command("backfill-dois")
+@click.option(
+    "--batch-size",
+    default=1_000,
+    show_default=True,
+    help="Number of DOIs per transaction.",
+)
+def backfill_dois(batch_size):
+    """Lowercase the stored DOIs, merging their duplicate documents."""
+    logger.setLevel(logging.INFO)
+    n = db_backfill_dois(create_session(), batch_size)
+    click.echo(f"Merged {n} duplicate documents.")
+
+
+@main.command("process-queue")
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    help="Number of worker processes.",
+)
+def process_queue(workers):
+    """Process the queued jobs, without watching the mailboxes."""
+    supervise(queue_specs(workers))
+
+
+@main.group("queue")
+def mail_queue():
+    """Inspect the queue of the requests received by mail."""
+
+
+@mail_queue.command("stats")
+def mail_queue_stats_command():
+    """Print the statistics of the queue."""
+    with create_session()() as session:
+        stats = mail_queue_stats(session)
+    for key, value in stats.items():
+        click.echo(f"{key}: {value}")
+
+
+@main.group("lookup-cache")
+def lookup_cache():
+    """Inspect or invalidate the cache of online lookups."""
+
+
+@lookup_cache.command("stats")
+def lookup_cache_stats_command():
+    """Print the statistics of the lookup cache."""
+    with create_session()() as session:
+        stats = lookup_cache_stats(session)
+    for key, value in stats.items():
+        click.echo(f"{key}: {value}")
+    total = stats["hits"] + stats["lookups"]
+    if total:
+        click.echo(f"hit ratio: {stats['hits'] / total:.2%}")
+
+
+@lookup_cache.command("invalidate")
+@click.option("--failures", is_flag=True, help="Only invalidate failed lookups.")
+@click.option("--all", "everything", is_flag=True, help="Invalidate every lookup.")
+@click.argument("ids", nargs=-1)
+def lookup_cache_invalidate(failures, everything, ids):
+    """Invalidate the cached lookups of IDS, such as arXiv:1708.05919.
+
+    With --all or --failures and no IDS, invalidates every lookup or
+    every failed lookup."""
+    docids = [normalize_docid(*idparse(x)) for x in ids]
+    if not docids and not (everything or failures):
+        raise click.UsageError("Give IDS, --all or --failures.")
+    with create_session()() as session:
+        n = invalidate_lookups(session, docids or None, failures)
+        session.commit()
+    click.echo(f"Invalidated {n} lookups.")
+
+
+@main.group("import")
+def bulk_import():
+    """Import the OpenLibrary and Crossref data dumps.
+
+    The dumps may be gzip-compressed. The OpenLibrary authors must be
+    imported before the OpenLibrary editions."""
+
+
+def import_command(name, import_dump, what):
+    """Add the command name importing its dumps with import_dump"""
+
+    @bulk_import.command(name, help=f"Import the {what} of the dumps PATHS.")
+    @click.option(
+        "--batch-size",
+        default=BULK_IMPORT_BATCH,
+        show_default=True,
+        help="Number of records per transaction.",
+    )
+    @click.argument("paths", nargs=-1, type=click.Path(exists=True, dir_okay=False))
+    def command(batch_size, paths):
+        Session = create_session()
+        for path in paths:
+            n = import_dump(Session, read_lines(path), batch_size)
+            click.echo(f"{path}: imported {n} {what}.")
+
+    return command
+
+
+import_command("openlibrary-authors", import_openlibrary_authors, "authors")
+import_command("openlibrary-editions", import_openlibrary_editions, "editions")
+import_command("crossref", import_crossref, "works")
 
 
 if __name__ == "__main__":
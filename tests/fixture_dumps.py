@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import gzip
+import json
+import pytest
+
+from app.idparser import isbn10_check_digit, isbn10_to_13
+
+
+def openlibrary_line(record_type, record):
+    return f"{record_type}\t{record['key']}\t1\t2024-01-01T00:00:00\t{json.dumps(record)}\n"
+
+
+def write_gzip(path, lines):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.writelines(lines)
+    return path
+
+
+def isbn10(n):
+    """The valid ISBN-10 "1000000nnc" of edition n"""
+    digits = f"1000000{n:02}"
+    return digits + isbn10_check_digit(digits)
+
+
+@pytest.fixture
+def openlibrary_dumps(tmp_path):
+    """Small synthetic OpenLibrary authors and editions dumps
+
+    Yields the paths of the authors and the editions dumps. The
+    editions are numbered; edition n has the ISBN-10 isbn10(n) and its
+    ISBN-13.
+    """
+    authors = [
+        openlibrary_line("/type/author", dict(key="/authors/OL1A", name="Roald Dahl")),
+        openlibrary_line(
+            "/type/author", dict(key="/authors/OL2A", name="Quentin Blake")
+        ),
+        "/type/author\t/authors/OL3A\t1\t2024-01-01T00:00:00\tnot json\n",
+    ]
+    editions = [
+        openlibrary_line(
+            "/type/edition",
+            dict(
+                key=f"/books/OL{n}M",
+                title=f"Edition {n}",
+                isbn_10=[isbn10(n)],
+                isbn_13=[isbn10_to_13(isbn10(n))],
+                authors=[dict(key="/authors/OL1A"), dict(key="/authors/OL2A")],
+            ),
+        )
+        for n in range(25)
+    ]
+    # Records that are skipped: no ISBN, no title, and a work.
+    editions.append(
+        openlibrary_line("/type/edition", dict(key="/books/OL99M", title="No ISBN"))
+    )
+    editions.append(
+        openlibrary_line("/type/edition", dict(key="/books/OL98M", isbn_10=["1"]))
+    )
+    editions.append(openlibrary_line("/type/work", dict(key="/works/OL1W", title="W")))
+    yield (
+        write_gzip(tmp_path / "ol_dump_authors.txt.gz", authors),
+        write_gzip(tmp_path / "ol_dump_editions.txt.gz", editions),
+    )
+
+
+@pytest.fixture
+def crossref_dump(tmp_path):
+    """A small synthetic Crossref dump of works 10.1000/n for n < 25"""
+    works = [
+        dict(
+            DOI=f"10.1000/{n}",
+            title=[f"Work {n}"],
+            author=[
+                dict(given="Stephen", family="Hawking"),
+                dict(name="The Collaboration"),
+            ],
+        )
+        for n in range(25)
+    ]
+    lines = [json.dumps(work) + "\n" for work in works[:20]]
+    lines.append(json.dumps(dict(items=works[20:])) + "\n")
+    # Works that are skipped: no title, and a repeated DOI.
+    lines.append(json.dumps(dict(DOI="10.1000/untitled")) + "\n")
+    lines.append(json.dumps(works[0]) + "\n")
+    yield write_gzip(tmp_path / "crossref.jsonl.gz", lines)
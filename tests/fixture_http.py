@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import gzip
+import http.server
+import threading
+import pytest
+
+
+class HTTPHandler(http.server.BaseHTTPRequestHandler):
+    """Answer every GET with the body registered for its path
+
+    Bodies are gzip-compressed when the client accepts it.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        body = self.server.bodies.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HTTPServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address):
+        super().__init__(address, HTTPHandler)
+        self.lock = threading.Lock()
+        self.bodies = {}
+        self.requests = []
+        self.connections = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return f"http://{host}:{port}"
+
+
+@pytest.fixture
+def http_server():
+    """Run a local HTTP stand-in server
+
+    Register the body of a path with server.bodies[path] = b"...";
+    server.connections counts the accepted connections.
+    """
+    server = HTTPServer(("127.0.0.1", 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,310 @@
+from __future__ import annotations
+
+import collections
+import email
+import email.policy
+import imaplib
+import re
+import select
+import socketserver
+import threading
+import pytest
+
+
+def parse_uid_set(s, uids):
+    """Return the members of uids in the IMAP sequence set s"""
+    last = max(uids, default=0)
+    selected = set()
+    for part in s.split(","):
+        a, _, b = part.partition(":")
+        a = last if a == "*" else int(a)
+        b = a if not b else last if b == "*" else int(b)
+        selected.update(uid for uid in uids if min(a, b) <= uid <= max(a, b))
+    return sorted(selected)
+
+
+def quoted(s):
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"' if s else "NIL"
+
+
+def body_structure(part):
+    """The BODYSTRUCTURE of an email.message.Message"""
+    if part.is_multipart():
+        parts = "".join(body_structure(p) for p in part.get_payload())
+        return f"({parts} {quoted(part.get_content_subtype().upper())})"
+    kind, subtype = part.get_content_maintype(), part.get_content_subtype()
+    params = " ".join(
+        f"{quoted(k.upper())} {quoted(v)}" for k, v in (part.get_params() or [])[1:]
+    )
+    params = f"({params})" if params else "NIL"
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_filename()
+        filename = f"({quoted('FILENAME')} {quoted(filename)})" if filename else "NIL"
+        disposition = f"({quoted(disposition.upper())} {filename})"
+    encoding = part.get("content-transfer-encoding", "7bit").upper()
+    body = part_body(part)
+    lines = " %d" % body.count(b"\n") if kind == "text" else ""
+    return (
+        f"({quoted(kind.upper())} {quoted(subtype.upper())} {params} NIL NIL"
+        f" {quoted(encoding)} {len(body)}{lines} NIL {disposition or 'NIL'} NIL NIL)"
+    )
+
+
+def part_body(part):
+    """The encoded body of a non-multipart part"""
+    _, _, body = part.as_bytes().partition(b"\n\n")
+    return body
+
+
+def section_body(message, section):
+    """The encoded body of the part numbered section, e.g. 1.2"""
+    part = message
+    for number in section.split("."):
+        if part.is_multipart():
+            part = part.get_payload()[int(number) - 1]
+    return part_body(part)
+
+
+class IMAPStandIn:
+    """The mailboxes of a local IMAP stand-in server
+
+    Each user has a list of [uid, flags, message] entries; the login
+    name, without its domain, selects the user. Every command received
+    is counted in commands, and the size of the messages and message
+    parts sent in sent. The IDLE command is advertised only when idle
+    is true.
+    """
+
+    def __init__(self, idle=True):
+        self.idle = idle
+        self.lock = threading.Lock()
+        self.mailboxes = collections.defaultdict(list)
+        self.next_uid = collections.defaultdict(lambda: 1)
+        self.commands = collections.Counter()
+        self.sent = 0
+        self.logins = 0
+        # Send unsolicited FETCH responses, as a server does to report
+        # the flags changed by another session, with every UID FETCH.
+        self.unsolicited = False
+
+    def append(self, user, message: bytes):
+        with self.lock:
+            uid = self.next_uid[user]
+            self.next_uid[user] += 1
+            self.mailboxes[user].append([uid, set(), message])
+        return uid
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        if isinstance(line, str):
+            line = line.encode()
+        self.wfile.write(line + b"\r\n")
+
+    def handle(self):
+        server = self.server.standin
+        self.user = None
+        self.send("* OK IMAP4rev1 stand-in ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, command, *args = line.decode().rstrip("\r\n").split(" ", 2)
+            command = command.upper()
+            if command == "UID":
+                command, _, args = args[0].partition(" ")
+                command = "UID " + command.upper()
+                args = [args]
+            with server.lock:
+                server.commands[command] += 1
+            handler = getattr(self, "do_" + command.replace(" ", "_"), None)
+            if handler is None:
+                self.send(f"{tag} BAD unknown command")
+                continue
+            if handler(tag, args[0] if args else "") is False:
+                return
+
+    @property
+    def mailbox(self):
+        return self.server.standin.mailboxes[self.user]
+
+    def do_CAPABILITY(self, tag, args):
+        idle = " IDLE" if self.server.standin.idle else ""
+        self.send(f"* CAPABILITY IMAP4rev1{idle}")
+        self.send(f"{tag} OK CAPABILITY completed")
+
+    def do_NOOP(self, tag, args):
+        self.send(f"{tag} OK NOOP completed")
+
+    def do_LOGIN(self, tag, args):
+        login = args.split(" ")[0].strip('"')
+        self.user = login.split("@")[0]
+        with self.server.standin.lock:
+            self.server.standin.logins += 1
+        self.send(f"{tag} OK LOGIN completed")
+
+    def do_SELECT(self, tag, args):
+        with self.server.standin.lock:
+            self.send(f"* {len(self.mailbox)} EXISTS")
+        self.send("* OK [UIDVALIDITY 1] UIDs valid")
+        self.send(f"{tag} OK [READ-WRITE] SELECT completed")
+
+    def do_IDLE(self, tag, args):
+        with self.server.standin.lock:
+            exists = len(self.mailbox)
+        self.send("+ idling")
+        self.wfile.flush()
+        while not select.select([self.connection], [], [], 0.01)[0]:
+            with self.server.standin.lock:
+                n = len(self.mailbox)
+            if n > exists:
+                exists = n
+                self.send(f"* {n} EXISTS")
+                self.wfile.flush()
+        if self.rfile.readline().strip().upper() != b"DONE":
+            self.send(f"{tag} BAD expected DONE")
+            return
+        self.send(f"{tag} OK IDLE terminated")
+
+    def do_UID_SEARCH(self, tag, args):
+        # Only the ALL, UNDELETED and UNKEYWORD criteria are supported.
+        criteria = args.split()
+        excluded = {
+            criteria[i + 1]
+            for i, criterion in enumerate(criteria)
+            if criterion.upper() == "UNKEYWORD"
+        }
+        if "UNDELETED" in (criterion.upper() for criterion in criteria):
+            excluded.add("\\Deleted")
+        with self.server.standin.lock:
+            uids = " ".join(
+                str(uid) for uid, flags, _ in self.mailbox if not flags & excluded
+            )
+        self.send(f"* SEARCH {uids}".rstrip())
+        self.send(f"{tag} OK SEARCH completed")
+
+    def do_UID_FETCH(self, tag, args):
+        uids, _, items = args.partition(" ")
+        items = re.findall(r"BODY\.PEEK\[[^\]]*\](?:<[\d.]+>)?|[^\s()]+", items.upper())
+        with self.server.standin.lock:
+            entries = list(enumerate(self.mailbox, start=1))
+            selected = parse_uid_set(uids, [uid for _, (uid, _, _) in entries])
+            if self.server.standin.unsolicited:
+                for seq, _ in entries:
+                    self.send(f"* {seq} FETCH (FLAGS (\\Deleted))")
+            for seq, (uid, flags, raw) in entries:
+                if uid not in selected:
+                    continue
+                message = email.message_from_bytes(raw, policy=email.policy.compat32)
+                response = f"* {seq} FETCH (UID {uid}".encode()
+                for item in items:
+                    if item == "RFC822":
+                        key, literal = "RFC822", raw
+                    elif item == "FLAGS":
+                        response += f" FLAGS ({' '.join(sorted(flags))})".encode()
+                        continue
+                    elif item == "BODYSTRUCTURE":
+                        response += f" BODYSTRUCTURE {body_structure(message)}".encode()
+                        continue
+                    elif item.startswith("BODY.PEEK[HEADER.FIELDS"):
+                        key = "BODY" + item.removeprefix("BODY.PEEK")
+                        names = re.search(r"\((.*)\)", key)[1].split()
+                        literal = (
+                            b"".join(
+                                f"{name.title()}: {message[name]}\r\n".encode()
+                                for name in names
+                                if message[name] is not None
+                            )
+                            + b"\r\n"
+                        )
+                    elif m := re.fullmatch(
+                        r"BODY\.PEEK\[([\d.]+)\](?:<0\.(\d+)>)?", item
+                    ):
+                        section, cap = m[1], m[2]
+                        literal = section_body(message, section)
+                        key = f"BODY[{section}]"
+                        if cap is not None:
+                            literal, key = literal[: int(cap)], key + "<0>"
+                    else:
+                        continue
+                    self.server.standin.sent += len(literal)
+                    self.wfile.write(
+                        response + f" {key} {{{len(literal)}}}\r\n".encode()
+                    )
+                    self.wfile.write(literal)
+                    response = b""
+                self.send(response + b")")
+            if self.server.standin.unsolicited:
+                for seq, (uid, _, _) in entries:
+                    self.send(f"* {seq} FETCH (UID {uid} FLAGS (\\Seen))")
+        self.send(f"{tag} OK FETCH completed")
+
+    def do_UID_STORE(self, tag, args):
+        uids, _, rest = args.partition(" ")
+        action, _, flags = rest.partition(" ")
+        flags = set(flags.strip("()").split())
+        with self.server.standin.lock:
+            entries = list(enumerate(self.mailbox, start=1))
+            selected = parse_uid_set(uids, [uid for _, (uid, _, _) in entries])
+            for seq, (uid, entry_flags, _) in entries:
+                if uid not in selected:
+                    continue
+                if action.upper().startswith("+FLAGS"):
+                    entry_flags |= flags
+                elif action.upper().startswith("-FLAGS"):
+                    entry_flags -= flags
+                if not action.upper().endswith(".SILENT"):
+                    flags_str = " ".join(sorted(entry_flags))
+                    self.send(f"* {seq} FETCH (UID {uid} FLAGS ({flags_str}))")
+        self.send(f"{tag} OK STORE completed")
+
+    def expunge(self, untagged):
+        with self.server.standin.lock:
+            seq = 1
+            for entry in list(self.mailbox):
+                if "\\Deleted" in entry[1]:
+                    self.mailbox.remove(entry)
+                    if untagged:
+                        self.send(f"* {seq} EXPUNGE")
+                else:
+                    seq += 1
+
+    def do_EXPUNGE(self, tag, args):
+        self.expunge(untagged=True)
+        self.send(f"{tag} OK EXPUNGE completed")
+
+    def do_CLOSE(self, tag, args):
+        self.expunge(untagged=False)
+        self.send(f"{tag} OK CLOSE completed")
+
+    def do_LOGOUT(self, tag, args):
+        self.send("* BYE logging out")
+        self.send(f"{tag} OK LOGOUT completed")
+        return False
+
+
+class IMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+@pytest.fixture
+def imap_server():
+    """Run a local IMAP stand-in server
+
+    Yields a pair of the IMAPStandIn and a function returning a new
+    imaplib.IMAP4 connection to the server.
+    """
+    server = IMAPServer(("127.0.0.1", 0), IMAPHandler)
+    server.standin = IMAPStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+
+    def connect():
+        return imaplib.IMAP4(host=host, port=port)
+
+    yield server.standin, connect
+    server.shutdown()
+    server.server_close()
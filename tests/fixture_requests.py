@@ -138,3 +138,108 @@ def arxiv_response():
             arxiv="1708.05919",
         ),
     )
+
+
+@pytest.fixture
+def arxivs_response():
+    return (
+        MockResponse(
+            200,
+            text="""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom">
+  <entry>
+      <id>http://arxiv.org/abs/1708.05919v2</id>
+      <published>2017-08-20T01:41:17Z</published>
+      <title>Rigidity, graphs and Hausdorff dimension</title>
+      <author>
+        <name>N. Chatzikonstantinou</name>
+      </author>
+  </entry>
+  <entry>
+      <id>http://arxiv.org/abs/1403.0001v1</id>
+      <published>2014-02-28T21:00:00Z</published>
+      <title>Another title</title>
+  </entry>
+</feed>
+""",
+        ),
+        {
+            "1708.05919": dict(
+                title="Rigidity, graphs and Hausdorff dimension",
+                published="2017-08-20T01:41:17Z",
+                authors=["N. Chatzikonstantinou"],
+                arxiv="1708.05919",
+            ),
+            "1403.0001": dict(
+                title="Another title",
+                published="2014-02-28T21:00:00Z",
+                authors=["Unknown"],
+                arxiv="1403.0001",
+            ),
+        },
+    )
+
+
+@pytest.fixture
+def isbns_response():
+    return (
+        MockResponse(
+            200,
+            {
+                "ISBN:0140328726": dict(
+                    title="Fantastic Mr. Fox",
+                    publish_date="October 1, 1988",
+                    authors=[dict(name="Roald Dahl")],
+                    identifiers=dict(isbn_10=["0140328726"], isbn_13=["9780140328721"]),
+                ),
+                "ISBN:9780000000002": dict(title="No authors"),
+            },
+        ),
+        {
+            "0140328726": dict(
+                title="Fantastic Mr. Fox",
+                subtitle="",
+                published="1988-10-01T00:00:00Z",
+                authors=["R. Dahl"],
+                isbn10="0140328726",
+                isbn13="9780140328721",
+            ),
+            "9780000000002": dict(
+                title="No authors",
+                subtitle="",
+                published="1984-01-01T00:00:00Z",
+                authors=["Unknown"],
+                isbn10=None,
+                isbn13="9780000000002",
+            ),
+        },
+    )
+
+
+@pytest.fixture
+def dois_response():
+    return (
+        MockResponse(
+            200,
+            dict(
+                message=dict(
+                    items=[
+                        {
+                            "DOI": "10.1038/248030A0",
+                            "title": ["Letter"],
+                            "published": {"date-parts": [[1974, 3, 1]]},
+                            "author": [dict(given="Stephen", family="Hawking")],
+                        }
+                    ]
+                )
+            ),
+        ),
+        {
+            "10.1038/248030a0": dict(
+                title="Letter",
+                published="1974-03-01T00:00:00Z",
+                authors=["S. Hawking"],
+                doi="10.1038/248030a0",
+            ),
+        },
+    )
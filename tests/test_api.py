@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import json
+import pytest
+from litestar.testing import TestClient
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from app import main
+
+DOCUMENTS = [
+    dict(
+        title="Black holes and thermodynamics",
+        id="doi:10.1103/PhysRevD.13.191",
+        authors=["S. W. Hawking"],
+        subscribers=["mark@communalgrowth.example"],
+    ),
+    dict(
+        title="Advanced Classical Electromagnetism",
+        id="ISBN-13:9780691220390",
+        authors=["R. Wald"],
+        subscribers=["mary@communalgrowth.example"],
+    ),
+]
+
+
+@pytest.fixture
+def client(mocker):
+    async def stream_documents(Session, search_term, limit, after):
+        for i, doc in enumerate(DOCUMENTS[:limit]):
+            yield f"0.1:{i}", doc
+
+    async def stream_recent(Session, limit):
+        for doc in DOCUMENTS[:limit]:
+            yield doc
+
+    mocker.patch("app.main.stream_documents", stream_documents)
+    mocker.patch("app.main.stream_recent", stream_recent)
+    # The engine never connects, it is only needed by the lifespan.
+    engine = create_async_engine("postgresql+psycopg://user@localhost:1/db")
+    main.app.state.engine = engine
+    with TestClient(app=main.app) as client:
+        yield client
+    del main.app.state.engine
+
+
+def test_api_search_json(client):
+    response = client.get("/api/search", params=dict(s="hawking", limit=1))
+    assert response.json() == dict(results=DOCUMENTS[:1], after="0.1:0")
+    response = client.get("/api/search", params=dict(s="hawking"))
+    assert response.json() == dict(results=DOCUMENTS, after=None)
+
+
+def test_api_search_ndjson(client):
+    headers = {"Accept": main.NDJSON}
+    response = client.get("/api/search", params=dict(s="hawking"), headers=headers)
+    assert response.headers["content-type"].startswith(main.NDJSON)
+    lines = response.text.splitlines()
+    assert [json.loads(line) for line in lines] == DOCUMENTS
+    # Asking for more results than fit in a JSON document streams them.
+    limit = main.API_JSON_MAX_RESULTS + 1
+    response = client.get("/api/search", params=dict(s="hawking", limit=limit))
+    assert response.headers["content-type"].startswith(main.NDJSON)
+
+
+def test_api_recent(client):
+    response = client.get("/api/recent")
+    assert response.json() == dict(results=DOCUMENTS)
+    response = client.get("/api/recent", headers={"Accept": main.NDJSON})
+    assert [json.loads(line) for line in response.text.splitlines()] == DOCUMENTS
+
+
+def test_stats_disabled(client):
+    assert client.get("/stats").status_code == 404
+
+
+def test_stats(client, mocker):
+    mocker.patch("app.main.STATS_ENABLED", True)
+    response = client.get("/stats")
+    assert response.status_code == 200
+    assert "search_cache" in response.json()
@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import pytest
+import sqlalchemy
+import time
+import sqlalchemy.orm
+
+from app.bulkimport import (
+    batches,
+    crossref_doc,
+    crossref_works,
+    import_crossref,
+    import_openlibrary_authors,
+    import_openlibrary_editions,
+    openlibrary_edition,
+    openlibrary_records,
+    read_lines,
+)
+from app.cgdb import Document
+from app.idparser import IDType
+from maildird.maildird import db_resolve_docs, make_doc
+from fixture_dumps import *
+from fixture_database import *
+
+
+def test_batches():
+    assert list(batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(batches([], 2)) == []
+
+
+def test_openlibrary_records(openlibrary_dumps):
+    authors, editions = openlibrary_dumps
+    records = list(openlibrary_records(read_lines(authors), "/type/author"))
+    assert [r["name"] for r in records] == ["Roald Dahl", "Quentin Blake"]
+    docs = [
+        doc
+        for doc in map(
+            openlibrary_edition,
+            openlibrary_records(read_lines(editions), "/type/edition"),
+        )
+        if doc
+    ]
+    assert len(docs) == 25
+    assert docs[3] == dict(
+        title="Edition 3",
+        subtitle="",
+        author_keys=["/authors/OL1A", "/authors/OL2A"],
+        isbn10="1000000036",
+        isbn13="9781000000030",
+    )
+
+
+def test_openlibrary_edition_isbns():
+    record = dict(
+        title="A title",
+        isbn_10=["1-000-00000-0", "0-8044-2957-x"],
+        isbn_13=["978 0 8044 2957 3"],
+    )
+    doc = openlibrary_edition(record)
+    # The ISBN-10 with a wrong check digit is skipped.
+    assert (doc["isbn10"], doc["isbn13"]) == ("080442957X", "9780804429573")
+    record = dict(title="Wrong", isbn_10=["1000000000"], isbn_13=["0140328726"])
+    assert openlibrary_edition(record) is None
+
+
+def test_crossref_doc_doi_case():
+    doc = crossref_doc(dict(DOI="10.1000/ABC", title=["Work"]))
+    assert doc["doi"] == "10.1000/abc"
+
+
+def test_crossref_docs(crossref_dump):
+    docs = [
+        doc
+        for doc in map(crossref_doc, crossref_works(read_lines(crossref_dump)))
+        if doc
+    ]
+    assert len(docs) == 26
+    assert docs[21] == dict(
+        title="Work 21",
+        authors=["S. Hawking", "The Collaboration"],
+        doi="10.1000/21",
+    )
+
+
+@pytest.mark.test_podman_compose
+@pytest.mark.test_slow
+def test_bulk_import(postgresql, openlibrary_dumps, crossref_dump):
+    authors, editions = openlibrary_dumps
+    engine = sqlalchemy.create_engine(postgresql)
+    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+    assert import_openlibrary_authors(Session, read_lines(authors), 10) == 2
+    assert import_openlibrary_editions(Session, read_lines(editions), 10) == 25
+    assert import_crossref(Session, read_lines(crossref_dump), 10) == 25
+    # Importing again finds every document already in the database.
+    assert import_openlibrary_editions(Session, read_lines(editions), 10) == 0
+    assert import_crossref(Session, read_lines(crossref_dump), 10) == 0
+    with Session() as session:
+        isbn10 = (IDType.ISBN10, "1000000079")
+        doc = session.get(Document, db_resolve_docs(session, [isbn10])[isbn10])
+        assert doc.title == "Edition 7"
+        assert doc.isbn13.isbn13 == "9781000000078"
+        assert sorted(a.author for a in doc.authors) == ["Q. Blake", "R. Dahl"]
+        doi = (IDType.DOI, "10.1000/7")
+        doc = session.get(Document, db_resolve_docs(session, [doi])[doi])
+        assert doc.title == "Work 7"
+        assert (
+            session.scalar(
+                sqlalchemy.select(sqlalchemy.func.count(Document.id)).where(
+                    Document.tsv_title.op("@@")(
+                        sqlalchemy.func.plainto_tsquery("hawking")
+                    )
+                )
+            )
+            == 25
+        )
+
+
+@pytest.mark.test_podman_compose
+@pytest.mark.test_slow
+def test_make_doc_authors_benchmark(postgresql):
+    """make_doc() on DOIs with many authors takes two author queries"""
+    engine = sqlalchemy.create_engine(postgresql)
+    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    n_docs, n_authors = 20, 500
+    with Session() as session:
+        start = time.perf_counter()
+        for n in range(n_docs):
+            # Half of the authors are shared with the previous document.
+            authors = [f"A. Author{(n * n_authors // 2) + i}" for i in range(n_authors)]
+            docdata = dict(title=f"Paper {n}", authors=authors, doi=f"10.2000/{n}")
+            statements.clear()
+            doc = make_doc(session, IDType.DOI, docdata)
+            assert len(statements) <= 2
+            assert [a.author for a in doc.authors] == authors
+            session.add(doc)
+            session.flush()
+        elapsed = time.perf_counter() - start
+        session.rollback()
+    print(f"make_doc: {n_docs} DOIs of {n_authors} authors in {elapsed:.2f}s")
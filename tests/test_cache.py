@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import asyncio
+import pytest
+
+from app.cache import SearchCache, normalize_search_term, sizeof
+
+
+class Clock:
+    """A manually advanced clock"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.parametrize(
+    "s, expected",
+    [
+        ("Hawking", "hawking"),
+        ("  HAWKING!  ", "hawking"),
+        ("Black   holes, and thermodynamics.", "black holes and thermodynamics"),
+        ("O'Brien", "o'brien"),
+    ],
+)
+def test_normalize_search_term(s, expected):
+    assert normalize_search_term(s) == expected
+
+
+def test_cache_hit_and_expiration():
+    clock = Clock()
+    cache = SearchCache(ttl=10, max_bytes=1 << 20, clock=clock)
+    calls = []
+
+    async def call():
+        calls.append(None)
+        return ["result"]
+
+    async def run():
+        assert await cache.get("key", call) == ["result"]
+        assert await cache.get("key", call) == ["result"]
+        clock.now = 10
+        assert await cache.get("key", call) == ["result"]
+
+    asyncio.run(run())
+    assert len(calls) == 2
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["expirations"] == 1
+
+
+def test_cache_lru_eviction():
+    value = ["x" * 100]
+    cache = SearchCache(ttl=10, max_bytes=2 * sizeof(value), clock=Clock())
+
+    async def call():
+        return value
+
+    async def run():
+        await cache.get("a", call)
+        await cache.get("b", call)
+        # Use "a" so that "b" becomes the least recently used entry.
+        await cache.get("a", call)
+        await cache.get("c", call)
+
+    asyncio.run(run())
+    assert list(cache.entries) == ["a", "c"]
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] <= cache.max_bytes
+
+
+def test_cache_single_flight():
+    cache = SearchCache(ttl=10, max_bytes=1 << 20, clock=Clock())
+    calls = []
+
+    async def call():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        return ["result"]
+
+    async def run():
+        return await asyncio.gather(*(cache.get("key", call) for _ in range(5)))
+
+    assert asyncio.run(run()) == [["result"]] * 5
+    assert len(calls) == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["coalesced"] == 4
+
+
+def test_cache_does_not_store_failures():
+    cache = SearchCache(ttl=10, max_bytes=1 << 20, clock=Clock())
+
+    async def call():
+        raise RuntimeError
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await cache.get("key", call)
+
+    asyncio.run(run())
+    assert cache.stats()["misses"] == 2
+    assert not cache.entries
+    assert not cache.inflight
@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import asyncio
+import pytest
+import sqlalchemy.exc
+from sqlalchemy.util import greenlet_spawn
+
+from app.conf import DB_POOL_SIZE, DB_POOL_TIMEOUT
+from app.dbpool import InstrumentedPool, create_engine
+
+
+class StubConnection:
+    """A DBAPI connection that does nothing"""
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def in_greenlet(f):
+    """Call f as the async engine calls the pool, within an event loop"""
+
+    async def call():
+        return await greenlet_spawn(f)
+
+    return asyncio.run(call())
+
+
+def test_instrumented_pool_stats():
+    pool = InstrumentedPool(StubConnection, pool_size=1, max_overflow=0, timeout=0.2)
+    assert pool.stats() == dict(
+        size=1,
+        checked_out=0,
+        checked_in=0,
+        overflow=-1,
+        checkouts=0,
+        wait_avg=0.0,
+        wait_max=0.0,
+    )
+
+    def checkouts():
+        connection = pool.connect()
+        assert pool.stats()["checked_out"] == 1
+        # The pool is exhausted; the next checkout waits for the timeout.
+        with pytest.raises(sqlalchemy.exc.TimeoutError):
+            pool.connect()
+        connection.close()
+
+    in_greenlet(checkouts)
+    stats = pool.stats()
+    assert (stats["checked_out"], stats["checked_in"]) == (0, 1)
+    assert stats["checkouts"] == 2
+    assert stats["wait_max"] >= 0.2
+    assert stats["wait_avg"] == pytest.approx(stats["wait_max"] / 2, rel=0.5)
+
+
+def test_create_engine_pool():
+    engine = create_engine("postgresql+psycopg://user@localhost:1/db")
+    pool = engine.pool
+    assert isinstance(pool, InstrumentedPool)
+    assert pool.size() == DB_POOL_SIZE
+    assert pool.timeout() == DB_POOL_TIMEOUT
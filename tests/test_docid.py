@@ -1,9 +1,31 @@
 from __future__ import annotations
 
+import collections
 import pytest
+import requests
+import threading
+import time
+import urllib.parse
 
 from app import docid
+from app.conf import LOOKUP_BATCH_SIZE, LOOKUP_CONCURRENCY
+from app.idparser import IDType
+from app.throttle import CircuitBreaker, TokenBucket
 from fixture_requests import *
+from fixture_http import *
+
+
+class Clock:
+    """A manually advanced clock, advanced by sleep()"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
 
 
 @pytest.mark.parametrize(
@@ -20,41 +42,263 @@ def test_ok_response(response, expected):
 
 def test_lookup_isbn_empty(mocker, isbn_and_author_empty_response):
     isbn_response, author_response, expected = isbn_and_author_empty_response
-    get = mocker.patch("requests.get")
+    get = mocker.patch("app.docid.http.get")
     get.side_effect = [isbn_response, author_response]
     assert docid.lookup_isbn(expected.get("isbn10", {})) == expected
 
 
 def test_lookup_isbn(mocker, isbn_and_author_response):
     isbn_response, author_response, expected = isbn_and_author_response
-    get = mocker.patch("requests.get")
+    get = mocker.patch("app.docid.http.get")
     get.side_effect = [isbn_response, author_response]
     assert docid.lookup_isbn(expected.get("isbn10", {})) == expected
 
 
 def test_lookup_doi_empty(mocker, doi_empty_response):
     response, expected = doi_empty_response
-    get = mocker.patch("requests.get")
+    get = mocker.patch("app.docid.http.get")
     get.return_value = response
     assert docid.lookup_doi(expected.get("doi", {})) == expected
 
 
 def test_lookup_doi(mocker, doi_response):
     response, expected = doi_response
-    get = mocker.patch("requests.get")
+    get = mocker.patch("app.docid.http.get")
     get.return_value = response
     assert docid.lookup_doi(expected.get("doi", {})) == expected
 
 
 def test_lookup_arxiv_empty(mocker, arxiv_response_empty):
     response, expected = arxiv_response_empty
-    get = mocker.patch("requests.get")
+    get = mocker.patch("app.docid.http.get")
     get.return_value = response
     assert docid.lookup_arxiv(expected.get("arxiv", {})) == expected
 
 
 def test_lookup_arxiv(mocker, arxiv_response):
     response, expected = arxiv_response
-    get = mocker.patch("requests.get")
+    get = mocker.patch("app.docid.http.get")
     get.return_value = response
     assert docid.lookup_arxiv(expected.get("arxiv", {})) == expected
+
+
+def test_get_url_keep_alive(http_server):
+    http_server.bodies["/works/10.1038/248030a0"] = b'{"message": {}}'
+    url = f"{http_server.url}/works/10.1038/248030a0"
+    for _ in range(3):
+        response = docid.get_url(url)
+        assert docid.ok_response(response)
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert response.json() == {"message": {}}
+    assert not docid.ok_response(docid.get_url(f"{http_server.url}/missing"))
+    # All requests went over a single connection.
+    assert len(http_server.requests) == 4
+    assert http_server.connections == 1
+
+
+def test_lookup_arxivs(mocker, arxivs_response):
+    response, expected = arxivs_response
+    get = mocker.patch("app.docid.http.get")
+    get.return_value = response
+    assert docid.lookup_arxivs(["1708.05919", "1403.0001", "9999.9999"]) == expected
+    assert get.call_count == 1
+    assert "id_list=1708.05919,1403.0001,9999.9999" in get.call_args.args[0]
+
+
+def test_lookup_isbns(mocker, isbns_response):
+    response, expected = isbns_response
+    get = mocker.patch("app.docid.http.get")
+    get.return_value = response
+    isbns = ["0140328726", "9780000000002", "0000000000"]
+    assert docid.lookup_isbns(isbns) == expected
+    assert get.call_count == 1
+
+
+def test_lookup_dois(mocker, dois_response):
+    response, expected = dois_response
+    get = mocker.patch("app.docid.http.get")
+    get.return_value = response
+    assert docid.lookup_dois(["10.1038/248030a0", "10.1000/missing"]) == expected
+    assert get.call_count == 1
+
+
+def test_lookup_docs(mocker):
+    lock = threading.Lock()
+    running = collections.Counter()
+    most = collections.Counter()
+    batches = []
+
+    def batch_lookup(name):
+        def lookup(docids):
+            with lock:
+                batches.append(docids)
+                running[name] += 1
+                most[name] = max(most[name], running[name])
+            time.sleep(0.05)
+            with lock:
+                running[name] -= 1
+            return {d: dict(title=d) for d in docids if d != "missing"}
+
+        return lookup
+
+    mocker.patch("app.docid.lookup_arxivs", side_effect=batch_lookup("arxiv"))
+    mocker.patch("app.docid.lookup_dois", side_effect=batch_lookup("crossref"))
+    docids = [(IDType.ARXIV, f"{n}") for n in range(3 * LOOKUP_BATCH_SIZE)]
+    docids += [(IDType.DOI, f"10.1000/{n}") for n in range(8 * LOOKUP_BATCH_SIZE)]
+    docids += [(IDType.DOI, "missing"), (IDType.TITLE, "A title")]
+    result = docid.lookup_docs(docids + docids[:2])
+    assert result == {d: dict(title=d[1]) for d in docids[:-2]} | {
+        (IDType.DOI, "missing"): {},
+        (IDType.TITLE, "A title"): {},
+    }
+    assert len(batches) == 3 + 9
+    assert all(len(batch) <= LOOKUP_BATCH_SIZE for batch in batches)
+    assert most["arxiv"] == LOOKUP_CONCURRENCY["arxiv"]
+    assert 1 < most["crossref"] <= LOOKUP_CONCURRENCY["crossref"]
+
+
+def test_lookup_docs_busy_provider(mocker):
+    started, release = threading.Event(), threading.Event()
+
+    def lookup_arxivs(arxivs):
+        started.set()
+        release.wait()
+        return {}
+
+    mocker.patch("app.docid.lookup_arxivs", side_effect=lookup_arxivs)
+    mocker.patch(
+        "app.docid.lookup_dois", side_effect=lambda dois: {d: {} for d in dois}
+    )
+    arxivs = [(IDType.ARXIV, f"{n}") for n in range(20 * LOOKUP_BATCH_SIZE)]
+    thread = threading.Thread(target=docid.lookup_docs, args=(arxivs,))
+    thread.start()
+    try:
+        started.wait()
+        time.sleep(0.1)
+        # The batches waiting for arXiv do not hold up the other providers.
+        found = {}
+        doi = (IDType.DOI, "10.1000/1")
+        other = threading.Thread(target=lambda: found.update(docid.lookup_docs([doi])))
+        other.start()
+        other.join(timeout=5)
+        assert found == {doi: {}}
+    finally:
+        release.set()
+        thread.join()
+
+
+@pytest.mark.parametrize(
+    "failure",
+    [
+        MockResponse(500),
+        MockResponse(429),
+        requests.ConnectionError("refused"),
+        requests.Timeout("timed out"),
+    ],
+)
+def test_lookup_docs_unavailable(mocker, failure):
+    breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+    mocker.patch.dict(docid.provider_breakers, crossref=breaker)
+    get = mocker.patch("app.docid.http.get")
+    if isinstance(failure, Exception):
+        get.side_effect = failure
+    else:
+        get.return_value = failure
+    docids = [(IDType.DOI, "10.1038/248030a0")]
+    for _ in range(3):
+        assert docid.lookup_docs(docids) == {docids[0]: None}
+    # The circuit opened after two failures.
+    assert get.call_count == 2
+    assert breaker.state == "open"
+
+
+def test_lookup_docs_not_found(mocker):
+    get = mocker.patch("app.docid.http.get")
+    get.return_value = MockResponse(404)
+    docids = [(IDType.DOI, "10.1038/248030a0")]
+    assert docid.lookup_docs(docids) == {docids[0]: {}}
+
+
+def test_lookup_docs_rejected_batch(mocker, dois_response):
+    response, expected = dois_response
+    get = mocker.patch("app.docid.http.get")
+    # The batch is refused, and so is the missing DOI looked up alone.
+    get.side_effect = [MockResponse(400), response, MockResponse(400)]
+    docids = [(IDType.DOI, "10.1038/248030a0"), (IDType.DOI, "10.1000/missing")]
+    assert docid.lookup_docs(docids) == {
+        docids[0]: expected["10.1038/248030a0"],
+        docids[1]: {},
+    }
+    assert get.call_count == 3
+
+
+@pytest.mark.parametrize("provider", ["openlibrary", "crossref", "arxiv"])
+def test_lookup_docs_unreadable(mocker, provider):
+    get = mocker.patch("app.docid.http.get")
+    get.return_value = MockResponse(200, data=None, text="<html>")
+    docids = {
+        "openlibrary": [(IDType.ISBN10, "0140328726")],
+        "crossref": [(IDType.DOI, "10.1038/248030a0")],
+        "arxiv": [(IDType.ARXIV, "1708.05919")],
+    }[provider]
+    # An unreadable response is not taken for IDs not found.
+    assert docid.lookup_docs(docids) == {docids[0]: None}
+
+
+def test_lookup_docs_half_open_rate_limited(mocker):
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=1, reset_timeout=60, clock=clock)
+    bucket = TokenBucket(rate=1, burst=1, clock=clock, sleep=clock.sleep)
+    mocker.patch.dict(docid.provider_breakers, crossref=breaker)
+    mocker.patch.dict(docid.provider_buckets, crossref=bucket)
+    mocker.patch("app.docid.LOOKUP_MAX_WAIT", 0)
+    get = mocker.patch("app.docid.http.get")
+    get.return_value = MockResponse(500)
+    docids = [(IDType.DOI, "10.1038/248030a0")]
+    assert docid.lookup_docs(docids) == {docids[0]: None}
+    clock.now += 60
+    # The trial call of the half-open circuit is rate limited, and the
+    # circuit stays half-open.
+    bucket.tokens = 0
+    bucket.updated = clock.now
+    assert docid.lookup_docs(docids) == {docids[0]: None}
+    assert get.call_count == 1
+    assert breaker.state == "half-open"
+    clock.now += 1
+    get.return_value = MockResponse(404)
+    assert docid.lookup_docs(docids) == {docids[0]: {}}
+    assert get.call_count == 2
+    assert breaker.state == "closed"
+
+
+def test_lookup_dois_special_characters(mocker, dois_response):
+    response, expected = dois_response
+    get = mocker.patch("app.docid.http.get")
+    get.return_value = response
+    dois = [
+        "10.1038/248030a0",
+        "10.1002/(SICI)1097-4571(199806)49:8<693::AID-ASI4>3.0.CO;2-#",
+        "10.1000/a&b+c",
+    ]
+    assert docid.lookup_dois(dois) == expected
+    assert get.call_count == 1
+    url, params = get.call_args.args[0], get.call_args.kwargs["params"]
+    prepared = requests.Request("GET", url, params=params).prepare()
+    query = urllib.parse.urlsplit(prepared.url)
+    assert not query.fragment
+    assert urllib.parse.parse_qs(query.query) == dict(
+        filter=[",".join(f"doi:{doi}" for doi in dois)], rows=["3"]
+    )
+
+
+def test_lookup_dois_comma_unavailable(mocker):
+    breaker = CircuitBreaker(threshold=1, reset_timeout=60)
+    mocker.patch.dict(docid.provider_breakers, crossref=breaker)
+    get = mocker.patch("app.docid.http.get")
+    get.return_value = MockResponse(500)
+    docids = [(IDType.DOI, "10.1000/a,b")]
+    # A DOI with a comma is looked up alone, within the circuit breaker.
+    for _ in range(2):
+        assert docid.lookup_docs(docids) == {docids[0]: None}
+    assert get.call_count == 1
+    assert "/works/10.1000/a%2Cb" in get.call_args.args[0]
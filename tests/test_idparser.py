@@ -1,8 +1,24 @@
 from __future__ import annotations
 
+import lark
 import pytest
+import random
+import time
 
-from app.idparser import IDType, idparse
+from app.idparser import (
+    GRAMMAR,
+    IDType,
+    MyTransformer,
+    fast_idparse,
+    grammar_idparse,
+    idparse,
+    idparse_many,
+    parser_cache,
+    isbn_twin,
+    isbn10_to_13,
+    isbn13_to_10,
+    valid_isbn,
+)
 
 
 def test_idparse():
@@ -147,3 +163,176 @@ def test_idparse():
             expected = datum["expected"]
             actual = idparse(input)
             assert expected == actual
+            # The fast path handles every input without internal spaces.
+            if " " not in input or expected[0] == IDType.TITLE:
+                assert fast_idparse(input) == expected
+    inputs = [input for datum in data for input in datum["inputs"]]
+    assert idparse_many(inputs) == [
+        datum["expected"] for datum in data for _ in datum["inputs"]
+    ]
+
+
+@pytest.mark.parametrize(
+    "s, expected",
+    [
+        ("ISBN 0-8044-2957-X", (IDType.ISBN10, "080442957X")),
+        ("080442957x", (IDType.ISBN10, "080442957X")),
+        ("ISBN 979-10-90636-07-1", (IDType.ISBN13, "9791090636071")),
+        # Wrong check digits and numbers that are not ISBNs are titles.
+        ("0691220396", (IDType.TITLE, "0691220396")),
+        ("978-0691220391", (IDType.TITLE, "978-0691220391")),
+        ("2024", (IDType.TITLE, "2024")),
+    ],
+)
+def test_idparse_isbn_check_digit(s, expected):
+    assert idparse(s) == expected
+
+
+@pytest.mark.parametrize(
+    "isbn, expected",
+    [
+        ("0691220395", True),
+        ("080442957X", True),
+        ("9780691220390", True),
+        ("0691220396", False),
+        ("9780691220391", False),
+        ("069122039", False),
+        ("06912203X5", False),
+    ],
+)
+def test_valid_isbn(isbn, expected):
+    assert valid_isbn(isbn) == expected
+
+
+def test_isbn_conversion():
+    assert isbn10_to_13("0691220395") == "9780691220390"
+    assert isbn13_to_10("9780691220390") == "0691220395"
+    assert isbn10_to_13("080442957X") == "9780804429573"
+    assert isbn13_to_10("9780804429573") == "080442957X"
+    assert isbn13_to_10("9791090636071") is None
+    assert isbn_twin(IDType.ISBN10, "0691220395") == (IDType.ISBN13, "9780691220390")
+    assert isbn_twin(IDType.ISBN13, "9780691220390") == (IDType.ISBN10, "0691220395")
+    assert isbn_twin(IDType.ISBN13, "9791090636071") is None
+    assert isbn_twin(IDType.DOI, "10.1000/1") is None
+
+
+# Pieces of identifiers, and of their near misses, that fuzzed inputs
+# are made of.
+FRAGMENTS = [
+    "ISBN", "isbn", "ıſbn", "-", "_", "10", "13", ":", " ", "  ", "X", "x",
+    "0691220395", "978", "0691220390", "069", "1220-395", "2024", "0", "9",
+    "doi:", "DOI:", "doi.org/", "doixorg/", "https://", "http://", "HTTPS://",
+    "www.", "WWW.", "10.1103", "/", "PhysRevD.13.191", ".", "..", "-.",
+    "arXiv:", "arxiv:", "arxiv.org/abs/", "arXiv.org/pdf/", "arxiv.org/",
+    "1403", "5335", "v", "v2", "V2", "[math.CA]", "[", "]", "math", "hep-th",
+    "Advanced", "Électromagnétisme", "٣", "\t", "\n",
+]  # fmt: skip
+
+
+# Inputs of every kind of identifier, see test_idparse().
+SAMPLES = [
+    "ISBN-10: 0691220395",
+    "ISBN 069 1220395",
+    "069-1220395",
+    "ISBN-13: 978-0691220390",
+    "9 7 8 0 6 9 1 2 2 0 3 9 0",
+    "arXiv:1403.5335v1 [math.CA]",
+    "https://www.arXiv.org/abs/1403.5335v2",
+    "arxiv.org/pdf/1403.5335",
+    "doi:10.1103/PhysRevD.13.191",
+    "10.1103/PhysRevD.13.191",
+    "https://doi.org/10.1103/PhysRevD.13.191",
+    "doi.org/10.1103/PhysRevD.13.191/",
+    "Advanced Classical Electromagnetism",
+]
+
+
+def fuzzed_inputs(rng, n):
+    """Yield n random inputs: concatenated fragments and mutated samples"""
+    for _ in range(n):
+        if rng.random() < 0.5:
+            yield "".join(rng.choices(FRAGMENTS, k=rng.randint(1, 6)))
+            continue
+        s = list(rng.choice(SAMPLES))
+        for _ in range(rng.randint(1, 3)):
+            i = rng.randrange(len(s) + 1)
+            piece = rng.choice(FRAGMENTS)
+            match rng.randrange(3):
+                case 0:
+                    s[i:i] = [piece]
+                case 1:
+                    del s[i : i + rng.randint(1, 3)]
+                case 2:
+                    s[i : i + 1] = [piece]
+        yield "".join(s)
+
+
+def test_fast_idparse_differential():
+    # Whatever the fast path identifies, the grammar identifies alike.
+    rng = random.Random(20)
+    identified = 0
+    for s in fuzzed_inputs(rng, 20_000):
+        s = s.strip()
+        fast = fast_idparse(s)
+        if fast is not None:
+            identified += 1
+            assert fast == grammar_idparse(s), s
+    assert identified > 1_000
+
+
+def best_time(f, repeat=5):
+    """The shortest of repeat timings of f() in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@pytest.mark.test_slow
+def test_idparse_benchmark(tmp_path):
+    # Building the parser from its cached grammar analysis is faster
+    # than analysing the grammar.
+    cache = parser_cache(str(tmp_path / "cache"))
+    lark.Lark(GRAMMAR, parser="lalr", transformer=MyTransformer(), cache=cache)
+    build = best_time(lambda: lark.Lark(GRAMMAR, parser="lalr"))
+    cached = best_time(
+        lambda: lark.Lark(
+            GRAMMAR, parser="lalr", transformer=MyTransformer(), cache=cache
+        )
+    )
+    # Parsing with the transformer folded into the parser is faster
+    # than transforming the parse tree afterwards.
+    inputs = SAMPLES * 400
+    tree_parser = lark.Lark(GRAMMAR, parser="lalr")
+
+    def parse_then_transform():
+        for s in inputs:
+            try:
+                MyTransformer().transform(tree_parser.parse(s.strip()))
+            except:
+                pass
+
+    separate = best_time(parse_then_transform)
+    folded = best_time(lambda: [grammar_idparse(s.strip()) for s in inputs])
+    # The fast path is faster still.
+    fast = best_time(lambda: idparse_many(inputs))
+    print(f"build: {build * 1e3:.1f}ms, cached: {cached * 1e3:.1f}ms")
+    print(
+        f"{len(inputs)} tokens: separate {separate:.3f}s, folded {folded:.3f}s,"
+        f" fast path {fast:.3f}s"
+    )
+    assert cached < build
+    assert folded < separate
+    assert fast < folded
+
+
+def test_parser_cache(tmp_path):
+    cache_dir = tmp_path / "cache"
+    assert parser_cache(str(cache_dir)) == str(cache_dir / "idparser.lark")
+    assert cache_dir.stat().st_mode & 0o777 == 0o700
+    # A directory that others may write to is not used.
+    cache_dir.chmod(0o777)
+    assert parser_cache(str(cache_dir)) is False
+    assert parser_cache("") is False
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+
+from app.cgdb import CGUser, LookupCache
+from app.conf import LOOKUP_FAILURE_TTL
+from app.idparser import IDType
+from app.lookupcache import (
+    cached_lookups,
+    count_hits,
+    invalidate_lookups,
+    lookup_cache_stats,
+    store_lookups,
+)
+from fixture_database import *
+
+pytestmark = [pytest.mark.test_podman_compose, pytest.mark.test_slow]
+
+GOOD = (IDType.ARXIV, "1708.05919")
+BAD = (IDType.DOI, "10.1000/bad")
+
+
+@pytest.fixture
+def Session(postgresql):
+    engine = sqlalchemy.create_engine(postgresql)
+    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+    yield Session
+    with Session() as session:
+        invalidate_lookups(session)
+        session.execute(sqlalchemy.delete(CGUser))
+        session.commit()
+
+
+def backoff(session, docid):
+    """The number of seconds until the lookup of docid expires"""
+    row = session.get(LookupCache, docid)
+    delta = session.scalar(sqlalchemy.select(row.expires - sqlalchemy.func.now()))
+    return delta.total_seconds()
+
+
+def test_lookup_cache(Session):
+    docdata = dict(title="A title", authors=["A. Author"], arxiv=GOOD[1])
+    with Session() as session:
+        assert cached_lookups(session, [GOOD, BAD]) == {}
+        store_lookups(session, {GOOD: docdata, BAD: {}})
+        session.commit()
+    with Session() as session:
+        cached = cached_lookups(session, [GOOD, BAD])
+        assert cached == {GOOD: docdata, BAD: {}}
+        count_hits(session, list(cached))
+        session.commit()
+        stats = lookup_cache_stats(session)
+    assert stats == dict(entries=2, failures=1, expired=0, hits=2, lookups=2)
+
+
+def test_lookup_cache_failure_backoff(Session):
+    for n in range(3):
+        with Session() as session:
+            store_lookups(session, {BAD: {}})
+            session.commit()
+            assert backoff(session, BAD) == pytest.approx(
+                LOOKUP_FAILURE_TTL * 2**n, abs=5
+            )
+    with Session() as session:
+        store_lookups(session, {BAD: dict(title="Found")})
+        session.commit()
+        assert session.get(LookupCache, BAD).failures == 0
+
+
+def test_lookup_cache_invalidate(Session):
+    with Session() as session:
+        store_lookups(session, {GOOD: dict(title="A title"), BAD: {}})
+        assert invalidate_lookups(session, failures_only=True) == 1
+        assert invalidate_lookups(session, [GOOD]) == 1
+        session.commit()
+        assert lookup_cache_stats(session)["entries"] == 0
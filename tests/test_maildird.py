@@ -0,0 +1,405 @@
+from __future__ import annotations
+
+import email
+import email.policy
+import pytest
+import threading
+import time
+from email.message import EmailMessage
+
+from app.conf import (
+    MAIL_ATTEMPT_FLAG,
+    MAIL_FAILED_FLAG,
+    MAIL_MAX_ATTEMPTS,
+    MAIL_RETRY_MAX_DELAY,
+)
+from app.parsemail import parse_mail
+
+from maildird.maildird import (
+    Mailbox,
+    fetch_items,
+    mailbox_worker,
+    process_emails,
+    process_mailbox,
+    queue_worker,
+    stored_attempts,
+    text_message,
+    text_sections,
+    uid_set,
+    watch_mailbox,
+    worker_specs,
+)
+from fixture_imap import *
+
+
+def make_mail(n):
+    return (
+        f"From: user{n}@example.invalid\r\n"
+        f"Subject: Subscribe\r\n"
+        f"\r\n"
+        f"arXiv:1403.{n:04}\r\n"
+    ).encode()
+
+
+@pytest.mark.parametrize(
+    "uids, expected",
+    [
+        ([1], "1"),
+        ([1, 2, 3], "1:3"),
+        ([5, 1, 2, 3, 7, 8], "1:3,5,7:8"),
+    ],
+)
+def test_uid_set(uids, expected):
+    assert uid_set(uids) == expected
+
+
+def test_process_mailbox_batch(imap_server):
+    standin, connect = imap_server
+    for n in range(25):
+        standin.append("subscribe", make_mail(n))
+    senders = []
+
+    def action(Session, mail):
+        senders.append(mail["From"])
+
+    mailbox = Mailbox(connect, "subscribe", b"password")
+    assert process_mailbox(mailbox, action, None, batch_size=10) == 10
+    assert process_mailbox(mailbox, action, None, batch_size=10) == 10
+    assert process_mailbox(mailbox, action, None, batch_size=10) == 5
+    assert process_mailbox(mailbox, action, None, batch_size=10) == 0
+    mailbox.close()
+    assert senders == [f"user{n}@example.invalid" for n in range(25)]
+    assert not standin.mailboxes["subscribe"]
+    # One connection, two FETCH (the structure, then the text) and one
+    # EXPUNGE per batch.
+    assert standin.logins == 1
+    assert standin.commands["UID FETCH"] == 6
+    assert standin.commands["UID STORE"] == 3
+    assert standin.commands["EXPUNGE"] == 3
+
+
+def make_attachment_mail(n, text=True, html=True):
+    """A mail with text and HTML alternatives and a large attachment"""
+    message = EmailMessage()
+    message["From"] = f"User {n} <user{n}@example.invalid>"
+    message["Subject"] = "The book"
+    if text:
+        message.set_content(f"arXiv:1403.{n:04}\n0140328726\n")
+    if html:
+        html_body = f"<p>arXiv:1403.{n:04}</p><p>Ébauche</p>"
+        if text:
+            message.add_alternative(html_body, subtype="html")
+        else:
+            message.set_content(html_body, subtype="html", cte="quoted-printable")
+    message.add_attachment(
+        b"%PDF" + bytes(range(256)) * 8192, "application", "pdf", filename="book.pdf"
+    )
+    message.add_attachment("0691220395\n", filename="notes.txt")
+    return message.as_bytes()
+
+
+def test_fetch_text_parts(imap_server):
+    standin, connect = imap_server
+    mails = [
+        make_attachment_mail(0),
+        make_attachment_mail(1, html=False),
+        make_attachment_mail(2, text=False),
+        make_mail(3),
+    ]
+    for raw in mails:
+        standin.append("subscribe", raw)
+    mailbox = Mailbox(connect, "subscribe", b"password")
+    fetched = mailbox.fetch([1, 2, 3, 4])
+    mailbox.close()
+    assert [uid for uid, _ in fetched] == [1, 2, 3, 4]
+    parse = lambda raw: parse_mail(
+        email.message_from_bytes(raw, policy=email.policy.default)
+    )
+    assert [parse(raw) for _, raw in fetched] == [parse(raw) for raw in mails]
+    # The attachments are not fetched; the messages with the same
+    # layout of text parts are fetched together.
+    assert standin.sent < 2_000
+    assert standin.commands["UID FETCH"] == 3
+
+
+def test_fetch_unsolicited(imap_server):
+    standin, connect = imap_server
+    mails = [make_attachment_mail(0), make_mail(1), make_mail(2)]
+    for raw in mails:
+        standin.append("subscribe", raw)
+    standin.unsolicited = True
+    mailbox = Mailbox(connect, "subscribe", b"password")
+    fetched = mailbox.fetch([1, 2])
+    mailbox.close()
+    assert [uid for uid, _ in fetched] == [1, 2]
+    parse = lambda raw: parse_mail(
+        email.message_from_bytes(raw, policy=email.policy.default)
+    )
+    assert [parse(raw) for _, raw in fetched] == [parse(raw) for raw in mails[:2]]
+
+
+def test_fetch_part_size(imap_server, mocker):
+    mocker.patch("maildird.maildird.IMAP_PART_MAX_BYTES", 1_000)
+    standin, connect = imap_server
+    message = EmailMessage()
+    message["From"] = "user@example.invalid"
+    message.set_content("0140328726\n" + "Électromagnétisme\n" * 10_000, cte="base64")
+    standin.append("subscribe", message.as_bytes())
+    mailbox = Mailbox(connect, "subscribe", b"password")
+    [(uid, raw)] = mailbox.fetch([1])
+    mailbox.close()
+    assert standin.sent < 1_100
+    _, body = parse_mail(email.message_from_bytes(raw, policy=email.policy.default))
+    assert body[0] == "0140328726"
+    assert 1 < len(body) < 100
+
+
+def test_fetch_items_literals():
+    # A BODYSTRUCTURE with a filename sent as a literal, and the UID
+    # after the message, as imaplib returns them.
+    data = [
+        (
+            b'7 (BODYSTRUCTURE (("TEXT" "PLAIN" ("CHARSET" "iso-8859-1") NIL NIL'
+            b' "QUOTED-PRINTABLE" 120 3 NIL NIL NIL NIL)("TEXT" "PLAIN" NIL NIL NIL'
+            b' "BASE64" 64 1 NIL ("attachment" ("filename" {9}',
+            b"notes.txt",
+        ),
+        (b')) NIL NIL) "MIXED" ("BOUNDARY" "x\\"y") NIL NIL NIL) RFC822 {3}', b"abc"),
+        b" UID 42)",
+    ]
+    [items] = fetch_items(data)
+    assert items[b"UID"] == b"42"
+    assert items[b"RFC822"] == b"abc"
+    structure = items[b"BODYSTRUCTURE"]
+    assert structure[1][9] == [b"attachment", [b"filename", b"notes.txt"]]
+    assert structure[3] == [b"BOUNDARY", b'x"y']
+    assert text_sections(structure) == [
+        ("1", "plain", "iso-8859-1", "QUOTED-PRINTABLE", 120)
+    ]
+
+
+def test_process_mailbox_failure_is_kept(imap_server, mocker):
+    standin, connect = imap_server
+    standin.append("subscribe", make_mail(0))
+    standin.append("subscribe", make_mail(1))
+    senders = []
+
+    def action(Session, mail):
+        if mail["From"] == "user0@example.invalid":
+            raise RuntimeError
+        senders.append(mail["From"])
+
+    now = [0]
+    mailbox = Mailbox(connect, "subscribe", b"password", clock=lambda: now[0])
+    assert process_mailbox(mailbox, action, None) == 2
+    assert senders == ["user1@example.invalid"]
+    # The failed message is kept, and retried once its delay is over.
+    [(uid, flags, _)] = standin.mailboxes["subscribe"]
+    assert uid == 1 and flags == {f"{MAIL_ATTEMPT_FLAG}1"}
+    assert process_mailbox(mailbox, action, None) == 0
+    for _ in range(MAIL_MAX_ATTEMPTS - 1):
+        now[0] += MAIL_RETRY_MAX_DELAY
+        assert process_mailbox(mailbox, action, None) == 1
+    # After MAIL_MAX_ATTEMPTS, it is flagged and no longer processed.
+    now[0] += MAIL_RETRY_MAX_DELAY
+    assert process_mailbox(mailbox, action, None) == 0
+    mailbox.close()
+    [(uid, flags, _)] = standin.mailboxes["subscribe"]
+    assert MAIL_FAILED_FLAG in flags
+    assert standin.commands["UID FETCH"] == 2 * MAIL_MAX_ATTEMPTS
+
+
+def test_process_mailbox_attempts_survive_restart(imap_server):
+    standin, connect = imap_server
+    standin.append("subscribe", make_mail(0))
+
+    def action(Session, mail):
+        raise RuntimeError
+
+    for _ in range(MAIL_MAX_ATTEMPTS):
+        # A new Mailbox, as after a restart of maildird.
+        mailbox = Mailbox(connect, "subscribe", b"password")
+        assert process_mailbox(mailbox, action, None) == 1
+        mailbox.close()
+    [(uid, flags, _)] = standin.mailboxes["subscribe"]
+    assert MAIL_FAILED_FLAG in flags
+    assert stored_attempts([flag.encode() for flag in flags]) == MAIL_MAX_ATTEMPTS - 1
+
+
+def test_process_mailbox_fetch_failure(imap_server, mocker):
+    standin, connect = imap_server
+    for n in range(3):
+        standin.append("subscribe", make_mail(n))
+
+    def broken(header, sections, bodies):
+        if b"user1@" in header:
+            raise RuntimeError
+        return text_message(header, sections, bodies)
+
+    mocker.patch("maildird.maildird.text_message", broken)
+    senders = []
+    mailbox = Mailbox(connect, "subscribe", b"password")
+    assert process_mailbox(mailbox, lambda S, m: senders.append(m["From"]), None) == 3
+    mailbox.close()
+    # The message that cannot be fetched is set apart and retried.
+    assert senders == ["user0@example.invalid", "user2@example.invalid"]
+    [(uid, flags, _)] = standin.mailboxes["subscribe"]
+    assert uid == 2 and flags == {f"{MAIL_ATTEMPT_FLAG}1"}
+
+
+def test_process_mailbox_shards(imap_server):
+    standin, connect = imap_server
+    for n in range(10):
+        standin.append("subscribe", make_mail(n))
+    senders = {0: [], 1: [], 2: []}
+    mailboxes = [Mailbox(connect, "subscribe", b"password") for _ in range(3)]
+    for k, mailbox in enumerate(mailboxes):
+        action = lambda Session, mail, k=k: senders[k].append(mail["From"])
+        process_mailbox(mailbox, action, None, shard=(k, 3))
+        mailbox.close()
+    # The UIDs start at 1.
+    assert senders == {
+        k: [f"user{uid - 1}@example.invalid" for uid in range(1, 11) if uid % 3 == k]
+        for k in range(3)
+    }
+    assert not standin.mailboxes["subscribe"]
+
+
+def test_worker_specs():
+    specs = worker_specs(b"password", 10, 2)
+    assert list(specs) == [
+        "subscribe/0",
+        "subscribe/1",
+        "unsubscribe/0",
+        "unsubscribe/1",
+        "forget/0",
+        "forget/1",
+        "queue/0",
+    ]
+    target, args = specs["unsubscribe/1"]
+    assert target is mailbox_worker
+    assert args == ("unsubscribe", b"password", 10, (1, 2), True)
+    assert specs["queue/0"] == (queue_worker, ())
+    assert "queue/0" not in worker_specs(b"password", 10, 2, queue_workers=0)
+    _, args = worker_specs(b"password", 10, 2, idle=False)["subscribe/0"]
+    assert args[-1] is False
+
+
+def test_process_emails_backlog(imap_server):
+    standin, connect = imap_server
+    for n in range(3):
+        standin.append("subscribe", make_mail(n))
+    standin.append("forget", make_mail(3))
+    processed = []
+    mailboxes = [
+        (Mailbox(connect, user, b"password"), lambda S, m: processed.append(m["From"]))
+        for user in ["subscribe", "unsubscribe", "forget"]
+    ]
+    assert process_emails(mailboxes, None, batch_size=2)
+    assert not process_emails(mailboxes, None, batch_size=2)
+    assert len(processed) == 4
+    for mailbox, _ in mailboxes:
+        mailbox.close()
+
+
+def watch(connect, fail=(), idle_timeout=0.2, **kwargs):
+    """Watch the subscribe mailbox in a thread, collecting its senders.
+
+    The mails from the senders in fail fail once. kwargs are passed to
+    watch_mailbox()."""
+    senders = []
+    stop = threading.Event()
+    failing = set(fail)
+
+    def action(Session, mail):
+        if mail["From"] in failing:
+            failing.remove(mail["From"])
+            raise RuntimeError
+        senders.append(mail["From"])
+
+    mailbox = Mailbox(connect, "subscribe", b"password")
+    thread = threading.Thread(
+        target=watch_mailbox,
+        args=(mailbox, action, None),
+        kwargs=dict(batch_size=10, idle_timeout=idle_timeout, stop=stop, **kwargs),
+    )
+    thread.start()
+    return senders, stop, thread
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+@pytest.mark.parametrize("idle", [True, False])
+def test_watch_mailbox(imap_server, idle):
+    standin, connect = imap_server
+    standin.idle = idle
+    for n in range(15):
+        standin.append("subscribe", make_mail(n))
+    senders, stop, thread = watch(connect)
+    try:
+        assert wait_for(lambda: len(senders) == 15)
+        standin.append("subscribe", make_mail(15))
+        assert wait_for(lambda: len(senders) == 16)
+    finally:
+        stop.set()
+        thread.join()
+    assert senders == [f"user{n}@example.invalid" for n in range(16)]
+    assert not standin.mailboxes["subscribe"]
+    # The mailbox stays logged in while it is watched.
+    assert standin.logins == 1
+    assert (standin.commands["IDLE"] > 0) == idle
+
+
+def test_watch_mailbox_poll(imap_server, mocker):
+    standin, connect = imap_server
+    mocker.patch("maildird.maildird.IMAP_POLL_MAX_DELAY", 0.05)
+    search, calls = Mailbox.search, []
+
+    def failing_search(self):
+        # The first search fails with an unexpected error.
+        uids = search(self)
+        calls.append(self)
+        if len(calls) == 1:
+            raise RuntimeError
+        return uids
+
+    mocker.patch.object(Mailbox, "search", failing_search)
+    senders, stop, thread = watch(connect, idle=False)
+    try:
+        standin.append("subscribe", make_mail(0))
+        assert wait_for(lambda: senders == ["user0@example.invalid"])
+    finally:
+        stop.set()
+        thread.join()
+    # The mailbox is reopened after the error, and polled although the
+    # server supports IDLE.
+    assert standin.logins == 2
+    assert standin.commands["IDLE"] == 0
+
+
+@pytest.mark.parametrize("idle", [True, False])
+def test_watch_mailbox_retry(imap_server, mocker, idle):
+    standin, connect = imap_server
+    standin.idle = idle
+    mocker.patch("maildird.maildird.MAIL_RETRY_DELAY", 0.2)
+    mocker.patch("maildird.maildird.IMAP_POLL_MIN_DELAY", 60)
+    standin.append("subscribe", make_mail(0))
+    senders, stop, thread = watch(
+        connect, fail=["user0@example.invalid"], idle_timeout=60
+    )
+    try:
+        # The failed mail is retried after MAIL_RETRY_DELAY, although
+        # no other mail arrives.
+        assert wait_for(lambda: senders == ["user0@example.invalid"], timeout=3)
+    finally:
+        stop.set()
+        if idle:
+            # End the IDLE command.
+            standin.append("subscribe", make_mail(1))
+        thread.join()
+    assert (standin.commands["IDLE"] > 0) == idle
@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+
+from app.cgdb import (
+    Arxiv,
+    CGUser,
+    Doi,
+    Document,
+    MailJob,
+    cguser_document_association,
+)
+from app.conf import QUEUE_MAX_ATTEMPTS, QUEUE_RETRY_DELAY
+from app.idparser import IDType
+from app.lookupcache import invalidate_lookups
+from app.mailqueue import (
+    claim_jobs,
+    enqueue_jobs,
+    fail_jobs,
+    finish_jobs,
+    mail_queue_stats,
+)
+from maildird.maildird import db_process_jobs
+from fixture_database import *
+
+pytestmark = [pytest.mark.test_podman_compose, pytest.mark.test_slow]
+
+EMAIL = "user@example.invalid"
+OTHER = "other@example.invalid"
+GOOD = (IDType.ARXIV, "1708.05919")
+BAD = (IDType.DOI, "10.1000/bad")
+
+
+@pytest.fixture
+def Session(postgresql):
+    engine = sqlalchemy.create_engine(postgresql)
+    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+    yield Session
+    with Session() as session:
+        invalidate_lookups(session)
+        for table in [MailJob, Arxiv, Doi, Document, CGUser]:
+            session.execute(sqlalchemy.delete(table))
+        session.commit()
+
+
+def queued(session):
+    """The (email, action, idtype, docid) of the queued jobs, in order"""
+    return session.execute(
+        sqlalchemy.select(
+            MailJob.email, MailJob.action, MailJob.idtype, MailJob.docid
+        ).order_by(MailJob.id)
+    ).all()
+
+
+def test_enqueue_replaces(Session):
+    with Session() as session:
+        enqueue_jobs(session, EMAIL, "subscribe", [GOOD, BAD, GOOD])
+        enqueue_jobs(session, EMAIL, "unsubscribe", [GOOD])
+        enqueue_jobs(session, EMAIL, "subscribe", [])
+        session.commit()
+        assert queued(session) == [
+            (EMAIL, "unsubscribe", *GOOD),
+            (EMAIL, "subscribe", *BAD),
+        ]
+
+
+def test_forget_comes_first(Session):
+    with Session() as session:
+        enqueue_jobs(session, EMAIL, "subscribe", [GOOD])
+        enqueue_jobs(session, OTHER, "subscribe", [GOOD])
+        enqueue_jobs(session, EMAIL, "forget")
+        enqueue_jobs(session, EMAIL, "subscribe", [BAD])
+        session.commit()
+        assert queued(session) == [
+            (OTHER, "subscribe", *GOOD),
+            (EMAIL, "forget", None, None),
+            (EMAIL, "subscribe", *BAD),
+        ]
+        # The subscription queued after the forget waits for it.
+        jobs = claim_jobs(session, 10)
+        session.commit()
+        assert sorted(job.action for job in jobs) == ["forget", "subscribe"]
+        finish_jobs(session, [job.id for job in jobs if job.action == "forget"])
+        session.commit()
+        assert [(job.email, job.docid) for job in claim_jobs(session, 10)] == [
+            (EMAIL, BAD[1])
+        ]
+
+
+def test_claim_skips_locked(Session):
+    with Session() as session:
+        for n in range(3):
+            enqueue_jobs(session, f"user{n}@example.invalid", "subscribe", [GOOD])
+        session.commit()
+    with Session() as first, Session() as second:
+        claimed = claim_jobs(first, 2)
+        # The jobs claimed by the first worker are locked until its
+        # claim is committed.
+        others = claim_jobs(second, 10)
+        assert len(claimed) == 2 and len(others) == 1
+        assert {job.id for job in claimed}.isdisjoint(job.id for job in others)
+        first.commit()
+        second.commit()
+    with Session() as session:
+        # The claimed jobs are due again after the backoff.
+        assert claim_jobs(session, 10) == []
+        delay = session.scalar(
+            sqlalchemy.select(
+                sqlalchemy.func.min(MailJob.next_attempt) - sqlalchemy.func.now()
+            )
+        )
+        assert delay.total_seconds() == pytest.approx(QUEUE_RETRY_DELAY, abs=5)
+        assert mail_queue_stats(session) == dict(
+            jobs=3, due=0, retried=0, failed=0, max_attempts=1
+        )
+
+
+def test_process_jobs(Session, mocker):
+    docdata = dict(title="A title", authors=["A. Author"], arxiv=GOOD[1])
+    # The provider of BAD is unavailable.
+    lookup_docs = mocker.patch(
+        "maildird.maildird.lookup_docs", return_value={GOOD: docdata, BAD: None}
+    )
+    with Session() as session:
+        enqueue_jobs(session, EMAIL, "subscribe", [GOOD, BAD])
+        enqueue_jobs(session, OTHER, "subscribe", [GOOD])
+        session.commit()
+    assert db_process_jobs(Session) == 3
+    # Each ID is looked up once for all the users.
+    lookup_docs.assert_called_once_with([GOOD, BAD])
+    with Session() as session:
+        subscribers = session.scalars(
+            sqlalchemy.select(cguser_document_association.c.email)
+        ).all()
+        assert sorted(subscribers) == [OTHER, EMAIL]
+        assert queued(session) == [(EMAIL, "subscribe", *BAD)]
+        assert db_process_jobs(Session) == 0
+        enqueue_jobs(session, OTHER, "unsubscribe", [GOOD])
+        enqueue_jobs(session, EMAIL, "forget")
+        session.commit()
+    assert db_process_jobs(Session) == 2
+    with Session() as session:
+        assert queued(session) == []
+        assert session.scalars(sqlalchemy.select(CGUser.email)).all() == []
+
+
+def test_fail_jobs(Session):
+    with Session() as session:
+        enqueue_jobs(session, EMAIL, "subscribe", [GOOD])
+        session.commit()
+        for _ in range(QUEUE_MAX_ATTEMPTS):
+            assert fail_jobs(session) == 0
+            assert [job.docid for job in claim_jobs(session, 10)] == [GOOD[1]]
+            # The job is not finished; make it due again.
+            session.execute(
+                sqlalchemy.update(MailJob).values(next_attempt=sqlalchemy.func.now())
+            )
+            session.commit()
+        assert fail_jobs(session) == 1
+        assert claim_jobs(session, 10) == []
+        session.commit()
+        assert mail_queue_stats(session)["failed"] == 1
+        # Requesting a failed job again attempts it again.
+        enqueue_jobs(session, EMAIL, "subscribe", [GOOD])
+        session.commit()
+        assert mail_queue_stats(session)["failed"] == 0
+        assert [job.docid for job in claim_jobs(session, 10)] == [GOOD[1]]
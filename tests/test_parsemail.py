@@ -1,8 +1,14 @@
 from __future__ import annotations
 
+import email
+import email.policy
 import pytest
+import time
+from email.message import EmailMessage
 
-from app import parsemail
+from app import parsemail, utils
+from app.conf import RATELIMIT_DOCIDS
+from app.idparser import IDType
 
 from fixture_mail import *
 
@@ -36,3 +42,179 @@ def test_parse_mail_alt(mail_alt):
     sender_address, body = parsemail.parse_mail(message)
     assert sender_address == actual["addr"]
     assert body == actual["body"]
+
+
+def whole_lines(message):
+    """The clean lines of all the text/plain parts of message, decoded at once"""
+    text = "".join(
+        part.get_payload(decode=True).decode(part.get_content_charset())
+        for part in message.walk()
+        if part.get_content_type() == "text/plain"
+    )
+    return utils.splitlines_clean(text)
+
+
+@pytest.mark.parametrize("cte", ["base64", "quoted-printable", "8bit", "7bit"])
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64])
+def test_parse_mail_chunks(mocker, cte, chunk_size):
+    mocker.patch("app.parsemail.MAIL_CHUNK_SIZE", chunk_size)
+    text = "Électromagnétisme\r\n0140328726\n\n  10.1038/248030a0 =  \n" * 3
+    if cte == "7bit":
+        text = text.replace("É", "E").replace("é", "e")
+    message = EmailMessage()
+    message["From"] = "user@example.invalid"
+    message.set_content(text, cte=cte)
+    _, body = parsemail.parse_mail(message)
+    assert body == whole_lines(message)
+    assert body[1:3] == ["0140328726", "10.1038/248030a0 ="]
+
+
+def test_mail_to_docid_normalized():
+    message = EmailMessage()
+    message["From"] = "user@example.invalid"
+    message.set_content("doi:10.1103/PhysRevD.13.191\n0-14-032872-6\n")
+    _, docids = parsemail.mail_to_docid(message)
+    assert docids == [
+        (IDType.DOI, "10.1103/physrevd.13.191"),
+        (IDType.ISBN10, "0140328726"),
+    ]
+
+
+def test_parse_mail_html_chunks(mocker, mail_html):
+    mocker.patch("app.parsemail.MAIL_CHUNK_SIZE", 5)
+    message, actual = mail_html
+    _, body = parsemail.parse_mail(message)
+    assert body == actual["body"]
+
+
+def test_parse_mail_max_lines(mocker):
+    message = EmailMessage()
+    message["From"] = "user@example.invalid"
+    message.set_content("".join(f"line {i}\n" for i in range(1000)))
+    _, body = parsemail.parse_mail(message, max_lines=3)
+    assert body == ["line 0", "line 1", "line 2"]
+    # A mail without line breaks is read up to MAIL_MAX_TEXT characters.
+    mocker.patch("app.parsemail.MAIL_MAX_TEXT", 10)
+    mocker.patch("app.parsemail.MAIL_CHUNK_SIZE", 4)
+    message = EmailMessage()
+    message["From"] = "user@example.invalid"
+    message.set_content("x" * 1000, cte="8bit")
+    _, body = parsemail.parse_mail(message)
+    assert body == ["x" * 12]
+
+
+def test_parse_mail_attachment():
+    """Text attachments are not part of the body"""
+    message = EmailMessage()
+    message["From"] = "user@example.invalid"
+    message.set_content("<p>0140328726</p>", subtype="html")
+    message.add_attachment("10.1038/248030a0\n", filename="notes.txt")
+    _, body = parsemail.parse_mail(message)
+    assert body == ["0140328726"]
+
+
+@pytest.mark.parametrize(
+    "html",
+    [
+        "<p>0140328726</p>\n<p>10.1038/248030a0, 1708.05919</p>",
+        "<div>0140328726<br>10.1038/248030a0, <b>1708.05919</b></div>",
+        "<html><head><title>Subscribe</title><style>p {}</style></head>"
+        "<body><script>var x = 1;</script>0140328726<br/>"
+        "<span>10.1038/248030a0,</span>\n<a href='x'>1708.05919</a></body></html>",
+        "<pre>0140328726\n10.1038/248030a0, 1708.05919\n</pre>",
+        "<p>0140328726</p><p>10.1038/248030a0, 1708.05919</p>"
+        "<div class='gmail_quote'>On Monday wrote:<div><div>0691220395</div></div>"
+        "<blockquote>9780691220390</blockquote></div>",
+        "<p>0140328726<br>10.1038/248030a0, 1708.05919</p>"
+        "<blockquote><blockquote>0691220395</blockquote>0691220395</blockquote>",
+        "<p>0140328726</p><p>10.1038/248030a0,&nbsp;1708.05919</p>"
+        "<p>-- <br>0691220395</p>",
+    ],
+)
+def test_parse_mail_html_lines(html):
+    """HTML e-mails have the lines of the same e-mail in text"""
+    message = EmailMessage()
+    message["From"] = "user@example.invalid"
+    message.set_content(html, subtype="html")
+    _, body = parsemail.parse_mail(message)
+    assert body == ["0140328726", "10.1038/248030a0, 1708.05919"]
+
+
+def test_parse_mail_html_budget(mocker):
+    mocker.patch("app.parsemail.MAIL_CHUNK_SIZE", 64)
+    feed = mocker.spy(parsemail.MyHTMLParser, "feed")
+    message = EmailMessage()
+    message["From"] = "user@example.invalid"
+    message.set_content("<p>0140328726, 0691220395</p>" * 1000, subtype="html")
+    _, body = parsemail.parse_mail(message, max_tokens=5)
+    assert body == ["0140328726, 0691220395"] * 3
+    # Feeding stops once the parser has enough tokens.
+    assert feed.call_count < 5
+    _, body = parsemail.parse_mail(message, max_lines=2)
+    assert body == ["0140328726, 0691220395"] * 2
+
+
+def parse_mail_whole(mail):
+    """parse_mail() decoding and parsing every part in full"""
+    plain_body = ""
+    html_body = ""
+    for part in mail.walk():
+        charset = part.get_content_charset() or "utf-8"
+        match part.get_content_type():
+            case "text/plain":
+                plain_body += part.get_payload(decode=True).decode(charset)
+            case "text/html":
+                html_body += part.get_payload(decode=True).decode(charset)
+    if plain_body:
+        return utils.splitlines_clean(plain_body)
+    parser = parsemail.MyHTMLParser()
+    try:
+        parser.feed(html_body)
+        parser.end_line()
+    except parsemail.EnoughText:
+        pass
+    return parser.data
+
+
+def large_mails():
+    """Mails of about 20 MB, some of them adversarial"""
+    ids = "0140328726, 10.1038/248030a0, 1708.05919\n"
+    mails = dict(
+        plain=("text", ids * 500_000, "base64"),
+        html=("html", f"<p>{ids}</p>" * 500_000, "base64"),
+        newlines=("text", ids + "\n" * 20_000_000, "8bit"),
+        one_line=("text", "," * 20_000_000, "8bit"),
+        tags=("html", "<br>" * 2_000_000, "quoted-printable"),
+        thread=(
+            "html",
+            f"<p>{ids}</p>-- <br>" + "<blockquote><p>Re: earlier</p>" * 500_000,
+            "base64",
+        ),
+    )
+    for name, (subtype, text, cte) in mails.items():
+        message = EmailMessage()
+        message["From"] = "user@example.invalid"
+        if subtype == "text":
+            message.set_content(text, cte=cte)
+        else:
+            message.set_content(text, subtype=subtype, cte=cte)
+        message.add_attachment(b"\0" * 20_000_000, "application", "octet-stream")
+        yield name, email.message_from_bytes(
+            message.as_bytes(), policy=email.policy.default
+        )
+
+
+@pytest.mark.test_slow
+def test_parse_mail_benchmark():
+    for name, message in large_mails():
+        start = time.perf_counter()
+        _, body = parsemail.parse_mail(message, max_lines=RATELIMIT_DOCIDS)
+        bounded = time.perf_counter() - start
+        start = time.perf_counter()
+        whole = parse_mail_whole(message)
+        full = time.perf_counter() - start
+        print(f"{name}: bounded {bounded * 1e3:.1f}ms, whole {full * 1e3:.1f}ms")
+        # A line is cut at MAIL_MAX_TEXT characters.
+        assert len(body) == len(whole[:RATELIMIT_DOCIDS])
+        assert all(line.startswith(x) for x, line in zip(body, whole))
+        assert bounded < full / 2
@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import asyncio
+import time
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy import desc, func, select, true
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from app.cgdb import Document
+from app.conf import RECENT_DOCUMENTS
+from app.search import (
+    doc_authors_expr,
+    doc_id_expr,
+    parse_after,
+    sample_emails,
+    search_documents,
+    search_recent,
+    search_stmt,
+)
+from app.utils import strip_to_alphanum
+from maildird.maildird import db_backfill_search
+from fixture_database import *
+
+pytestmark = [pytest.mark.test_podman_compose, pytest.mark.test_slow]
+
+# Number of documents in the seeded database; one in every RARE_EVERY
+# documents has the word "thermodynamics" in its title.
+N_DOCUMENTS = 1_000_000
+RARE_EVERY = 10_000
+
+
+@pytest.fixture(scope="module")
+def seeded(postgresql):
+    """Seed the database with N_DOCUMENTS documents.
+
+    Every document is subscribed to by a single user, so that no
+    document is skipped for lack of subscribers."""
+    engine = sqlalchemy.create_engine(postgresql)
+    with engine.begin() as connection:
+        connection.exec_driver_sql(f"""
+            INSERT INTO document (title, tsv_title)
+            SELECT t.title, to_tsvector('english', t.title)
+            FROM (
+                SELECT CASE WHEN i % {RARE_EVERY} = 0
+                            THEN 'Thermodynamics volume ' || i
+                            ELSE 'Volume ' || i END AS title
+                FROM generate_series(1, {N_DOCUMENTS}) AS i
+            ) AS t
+            """)
+        connection.exec_driver_sql(
+            "INSERT INTO cguser (email) VALUES ('user@example.invalid')"
+        )
+        connection.exec_driver_sql("""
+            INSERT INTO cguser_document (doc_id, email)
+            SELECT id, 'user@example.invalid' FROM document
+            """)
+    db_backfill_search(sqlalchemy.orm.sessionmaker(bind=engine), batch_size=100_000)
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT")
+        connection.exec_driver_sql("VACUUM ANALYZE")
+    return postgresql
+
+
+def explain(db_url, stmt):
+    """Return the query plan of stmt as a single string."""
+    engine = sqlalchemy.create_engine(db_url)
+    sql = stmt.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True})
+    with engine.connect() as connection:
+        rows = connection.exec_driver_sql(f"EXPLAIN {sql}").all()
+    return "\n".join(row[0] for row in rows)
+
+
+def join_search_stmt(search_term, limit=100):
+    """The search over the document tables that document_search replaces.
+
+    The matches are found through the idx_tsv_title GIN index of the
+    document table; the ID, the authors and the subscribers of each
+    match are then read from their own tables."""
+    query = func.plainto_tsquery(strip_to_alphanum(search_term))
+    rank = func.ts_rank_cd(Document.tsv_title, query)
+    # fmt: off
+    matches = (
+        select(Document.id, rank.label("rank"))
+        .where(Document.tsv_title.bool_op("@@")(query))
+        .order_by(desc(rank), desc(Document.id))
+        .limit(limit)
+        .subquery()
+    )
+    emails = sample_emails(matches.c.id)
+    return (
+        select(
+            matches.c.id.label("doc_id"),
+            matches.c.rank,
+            Document.title,
+            doc_id_expr(matches.c.id).label("docid"),
+            doc_authors_expr(matches.c.id).label("authors"),
+            func.array_agg(emails.c.email).label("emails"),
+        )
+        .select_from(
+            matches
+            .join(Document, Document.id == matches.c.id)
+            .join(emails, true())
+        )
+        .group_by(matches.c.id, matches.c.rank, Document.title)
+        .order_by(desc(matches.c.rank), desc(matches.c.id))
+    )
+    # fmt: on
+
+
+def test_search_uses_tsv_index(seeded):
+    plan = explain(seeded, search_stmt("thermodynamics"))
+    assert "idx_document_search_tsv_title" in plan
+    assert "Seq Scan" not in plan
+
+
+def test_search_pagination(seeded):
+    async def search_all():
+        engine = create_async_engine(seeded)
+        Session = async_sessionmaker(bind=engine)
+        pages = []
+        after = None
+        while True:
+            results, next_after = await search_documents(
+                Session, "thermodynamics", limit=30, after=after
+            )
+            pages.append(results)
+            if next_after is None:
+                break
+            after = parse_after(next_after)
+        await engine.dispose()
+        return pages
+
+    pages = asyncio.run(search_all())
+    titles = [result[0] for page in pages for result in page]
+    assert len(titles) == N_DOCUMENTS // RARE_EVERY
+    assert len(set(titles)) == len(titles)
+    assert all(title.startswith("Thermodynamics") for title in titles)
+
+
+def test_search_recent(seeded):
+    async def recent():
+        engine = create_async_engine(seeded)
+        Session = async_sessionmaker(bind=engine)
+        results = await search_recent(Session)
+        await engine.dispose()
+        return results
+
+    results = asyncio.run(recent())
+    assert [result[0] for result in results] == ["Thermodynamics volume 1000000"] + [
+        f"Volume {i}"
+        for i in range(N_DOCUMENTS - 1, N_DOCUMENTS - RECENT_DOCUMENTS, -1)
+    ]
+    assert all(result[3] == "user@example.invalid" for result in results)
+
+
+def test_search_benchmark(seeded):
+    """Compare the read of document_search against the join-based search.
+
+    Run with -s to see the timings."""
+    repeat = 20
+
+    async def bench(stmt):
+        engine = create_async_engine(seeded)
+        Session = async_sessionmaker(bind=engine)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            async with Session() as session:
+                rows = (await session.execute(stmt)).all()
+        elapsed = time.perf_counter() - start
+        await engine.dispose()
+        return [tuple(row) for row in rows], elapsed / repeat
+
+    join_rows, join_time = asyncio.run(bench(join_search_stmt("thermodynamics")))
+    table_rows, table_time = asyncio.run(bench(search_stmt("thermodynamics")))
+    print(
+        f"Joins: {join_time * 1000:.1f} ms, "
+        f"document_search: {table_time * 1000:.1f} ms"
+    )
+    assert table_rows == join_rows
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import pytest
+import sqlalchemy
+import sqlalchemy.orm
+
+from app.cgdb import (
+    Arxiv,
+    CGUser,
+    Doi,
+    Document,
+    Isbn10,
+    Isbn13,
+    cguser_document_association,
+)
+from app.idparser import IDType
+from maildird.maildird import db_backfill_dois, db_resolve_docs, db_subscribe_docs
+from fixture_database import *
+
+pytestmark = [pytest.mark.test_podman_compose, pytest.mark.test_slow]
+
+EMAIL = "user@example.invalid"
+ISBN10 = (IDType.ISBN10, "0140328726")
+ISBN13 = (IDType.ISBN13, "9780140328721")
+DOI = (IDType.DOI, "10.1038/248030a0")
+ARXIV = (IDType.ARXIV, "1708.05919")
+BOOK = dict(
+    title="Fantastic Mr. Fox",
+    subtitle="",
+    authors=["R. Dahl"],
+    isbn10=ISBN10[1],
+    isbn13=ISBN13[1],
+)
+
+
+@pytest.fixture
+def Session(postgresql):
+    engine = sqlalchemy.create_engine(postgresql)
+    Session = sqlalchemy.orm.sessionmaker(bind=engine)
+    yield Session
+    with Session() as session:
+        for table in [Isbn10, Isbn13, Doi, Arxiv, Document]:
+            session.execute(sqlalchemy.delete(table))
+        session.execute(sqlalchemy.delete(CGUser))
+        session.commit()
+
+
+def subscriptions(session):
+    return session.scalar(
+        sqlalchemy.select(sqlalchemy.func.count()).select_from(
+            cguser_document_association
+        )
+    )
+
+
+def test_resolve_docs_single_query(Session):
+    looked_up = {
+        ISBN10: BOOK,
+        DOI: dict(title="Letter", authors=["S. Hawking"], doi=DOI[1]),
+        ARXIV: dict(title="Rigidity", authors=["A. Iosevich"], arxiv=ARXIV[1]),
+    }
+    with Session() as session:
+        db_subscribe_docs(session, EMAIL, list(looked_up), looked_up)
+        session.commit()
+    engine = Session.kw["bind"]
+    statements = []
+
+    @sqlalchemy.event.listens_for(engine, "before_cursor_execute")
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    missing = (IDType.DOI, "10.1000/missing")
+    with Session() as session:
+        resolved = db_resolve_docs(session, [ISBN10, ISBN13, DOI, ARXIV, missing])
+    assert len(statements) == 1
+    assert set(resolved) == {ISBN10, ISBN13, DOI, ARXIV}
+    assert resolved[ISBN10] == resolved[ISBN13]
+    assert len(set(resolved.values())) == 3
+
+
+def test_subscribe_isbn_twins_in_one_mail(Session):
+    # Both ISBNs of a new book in the same mail make a single document.
+    with Session() as session:
+        db_subscribe_docs(
+            session, EMAIL, [ISBN10, ISBN13], {ISBN10: BOOK, ISBN13: BOOK}
+        )
+        session.commit()
+        assert (
+            session.scalar(sqlalchemy.select(sqlalchemy.func.count(Document.id))) == 1
+        )
+        assert subscriptions(session) == 1
+
+
+def test_subscribe_isbn_twin_in_database(Session):
+    book13 = dict(BOOK, isbn10=None)
+    with Session() as session:
+        db_subscribe_docs(session, EMAIL, [ISBN13], {ISBN13: book13})
+        session.commit()
+    # The ISBN-10 of the document is computed from its ISBN-13, and
+    # the document is found under either.
+    with Session() as session:
+        db_subscribe_docs(session, "other@example.invalid", [ISBN10], {ISBN10: BOOK})
+        # Subscribing again changes nothing.
+        db_subscribe_docs(session, EMAIL, [ISBN13], {})
+        session.commit()
+        doc = session.get(Document, db_resolve_docs(session, [ISBN10])[ISBN10])
+        assert doc.isbn13.isbn13 == ISBN13[1]
+        assert (
+            session.scalar(sqlalchemy.select(sqlalchemy.func.count(Document.id))) == 1
+        )
+        assert subscriptions(session) == 2
+
+
+def test_subscribe_known_under_other_identifier(Session):
+    # The lookup of an ISBN names an ISBN-13 already in the database,
+    # which is not the conversion of the ISBN.
+    other = (IDType.ISBN10, "080442957X")
+    with Session() as session:
+        db_subscribe_docs(session, EMAIL, [ISBN13], {ISBN13: BOOK})
+        db_subscribe_docs(session, EMAIL, [other], {other: dict(BOOK, isbn10=other[1])})
+        session.commit()
+        assert (
+            session.scalar(sqlalchemy.select(sqlalchemy.func.count(Document.id))) == 1
+        )
+        assert subscriptions(session) == 1
+
+
+def test_backfill_dois(Session):
+    letter = dict(title="Letter", authors=["S. Hawking"])
+    upper = (IDType.DOI, "10.1038/248030A0")
+    alone = (IDType.DOI, "10.1000/ABC")
+    with Session() as session:
+        # DOIs stored with their case, before they were normalized.
+        db_subscribe_docs(
+            session,
+            EMAIL,
+            [upper, alone],
+            {upper: dict(letter, doi=upper[1]), alone: dict(letter, doi=alone[1])},
+        )
+        db_subscribe_docs(
+            session, "other@example.invalid", [DOI], {DOI: dict(letter, doi=DOI[1])}
+        )
+        session.commit()
+        assert session.scalar(sqlalchemy.select(sqlalchemy.func.count(Doi.doi))) == 3
+    assert db_backfill_dois(Session, batch_size=1) == 1
+    with Session() as session:
+        assert sorted(session.scalars(sqlalchemy.select(Doi.doi))) == [
+            "10.1000/abc",
+            DOI[1],
+        ]
+        # Both users are subscribed to the merged document.
+        doc_id = db_resolve_docs(session, [DOI])[DOI]
+        assert sorted(
+            session.scalars(
+                sqlalchemy.select(cguser_document_association.c.email).where(
+                    cguser_document_association.c.doc_id == doc_id
+                )
+            )
+        ) == [EMAIL, "other@example.invalid"]
+        assert subscriptions(session) == 3
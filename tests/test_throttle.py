@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import pytest
+
+from app.throttle import CircuitBreaker, TokenBucket
+
+
+class Clock:
+    """A manually advanced clock, advanced by sleep()"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock, sleep=clock.sleep)
+    for _ in range(3):
+        assert bucket.acquire()
+    assert clock.now == 0
+    # The burst is spent; the next tokens come every half second.
+    assert bucket.acquire()
+    assert clock.now == pytest.approx(0.5)
+    assert not bucket.acquire(timeout=0.1)
+    assert bucket.acquire(timeout=0.5)
+    assert clock.now == pytest.approx(1.0)
+    # The bucket refills up to the burst.
+    clock.now += 10
+    for _ in range(3):
+        assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+
+
+def test_circuit_breaker():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=3, reset_timeout=60, clock=clock)
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.failure()
+    breaker.success()
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    clock.now += 60
+    assert breaker.state == "half-open"
+    # A single trial call is let through.
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open"
+    clock.now += 60
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_circuit_breaker_cancel():
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=1, reset_timeout=60, clock=clock)
+    breaker.failure()
+    clock.now += 60
+    assert breaker.allow()
+    assert breaker.state == "open"
+    # The trial call was not made; another one is allowed.
+    breaker.cancel()
+    assert breaker.state == "half-open"
+    assert breaker.allow()